@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Modbus stack micro-benchmark.
+
+Measures the CPU cost per transaction of the Modbus stack, by exchanging frames with a simulated
+slave over an infinitely fast loopback line. The cost of the slave simulation is measured apart,
+and subtracted from the figures of the other cases.
+"""
+
+import argparse
+import time
+
+import pycstbox.minimalmodbus as minimalmodbus
+import pycstbox.modbussim as modbussim
+
+PORT = 'bench'
+SLAVE_ADDRESS = 1
+
+
+def case_slave(instrument, args):
+    """ simulated slave alone """
+    slave = instrument.transport.slaves[SLAVE_ADDRESS]
+    request = instrument.prepare(3, args.address, numberOfRegisters=args.registers, payloadformat='registers').request
+    if not isinstance(request, bytes):
+        request = bytes(request, encoding='latin1')
+    return lambda: slave(request)
+
+
+def case_generic(instrument, args):
+    """ read_registers() """
+    return lambda: instrument.read_registers(args.address, args.registers)
+
+
+def case_prepared(instrument, args):
+    """ prepared read_registers() """
+    return instrument.prepare(3, args.address, numberOfRegisters=args.registers, payloadformat='registers')
+
+
+def case_prepared_str(instrument, args):
+    """ prepared read_registers(), str frames """
+    prepared = instrument.prepare(3, args.address, numberOfRegisters=args.registers, payloadformat='registers')
+    prepared.raw_request = None     # forces the frame conversions of the pre-bytes path
+    return prepared
+
+
+CASES = [
+    ('slave', case_slave),
+    ('generic', case_generic),
+    ('prepared-str', case_prepared_str),
+    ('prepared', case_prepared),
+]
+
+
+def run(func, count):
+    start = time.time()
+    for _ in range(count):
+        func()
+    return (time.time() - start) / count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CSTBox Modbus stack micro-benchmark')
+    parser.add_argument('-n', '--count', type=int, default=10000,
+                        help='number of transactions per case (default: %(default)s)')
+    parser.add_argument('-r', '--registers', type=int, default=10,
+                        help='number of registers read per transaction (default: %(default)s)')
+    parser.add_argument('-a', '--address', type=int, default=0,
+                        help='address of the first register (default: %(default)s)')
+    parser.add_argument('cases', nargs='*', metavar='CASE',
+                        help='cases to be run, among %s (default: all)' % ', '.join(name for name, _ in CASES))
+    args = parser.parse_args()
+    unknown = set(args.cases) - set(name for name, _ in CASES)
+    if unknown:
+        parser.error('unknown cases: %s' % ', '.join(sorted(unknown)))
+
+    transport = modbussim.LoopbackTransport(PORT, baudrate=None)
+    transport.attach(SLAVE_ADDRESS, modbussim.SimulatedSlave(
+        SLAVE_ADDRESS, dict((addr, addr) for addr in range(args.address, args.address + args.registers))
+    ))
+    minimalmodbus.register_transport(PORT, transport)
+    instrument = minimalmodbus.Instrument(PORT, SLAVE_ADDRESS)
+
+    slave_cost = run(case_slave(instrument, args), args.count)
+    print('%-12s %-40s %8.1f us/transaction' % ('slave', case_slave.__doc__.strip(), slave_cost * 1e6))
+    for name, case in CASES:
+        if name == 'slave' or (args.cases and name not in args.cases):
+            continue
+        cost = run(case(instrument, args), args.count) - slave_cost
+        print('%-12s %-40s %8.1f us/transaction' % (name, case.__doc__.strip(), cost * 1e6))
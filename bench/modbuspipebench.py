@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Modbus TCP pipelining benchmark.
+
+Measures the time needed for reading a batch of register blocks through a simulated Modbus TCP
+gateway, with a given number of transactions in flight. The gateway answers each request after
+a turnaround time, processing pipelined requests concurrently as gateways fronting independent
+RTU segments do. One transaction in flight is the lock-step behaviour.
+"""
+
+import argparse
+import time
+
+import pycstbox.minimalmodbus as minimalmodbus
+import pycstbox.modbussim as modbussim
+
+SLAVE_ADDRESS = 1
+
+
+def run(port, reads, max_in_flight, count):
+    start = time.time()
+    for _ in range(count):
+        for data in minimalmodbus.read_registers_batch(port, reads, max_in_flight):
+            if isinstance(data, Exception):
+                raise data
+    return (time.time() - start) / count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CSTBox Modbus TCP pipelining benchmark')
+    parser.add_argument('-n', '--count', type=int, default=20,
+                        help='number of batches per case (default: %(default)s)')
+    parser.add_argument('-b', '--blocks', type=int, default=8,
+                        help='number of blocks read per batch (default: %(default)s)')
+    parser.add_argument('-r', '--registers', type=int, default=10,
+                        help='number of registers per block (default: %(default)s)')
+    parser.add_argument('-t', '--turnaround', type=float, default=0.01,
+                        help='gateway turnaround time in seconds (default: %(default)s)')
+    parser.add_argument('in_flight', nargs='*', type=int, metavar='IN_FLIGHT',
+                        help='numbers of transactions in flight to be compared (default: 1 and the number of blocks)')
+    args = parser.parse_args()
+
+    gateway = modbussim.SimulatedTcpGateway(turnaround_time=args.turnaround)
+    size = args.blocks * args.registers
+    gateway.attach(modbussim.SimulatedSlave(SLAVE_ADDRESS, dict((addr, addr) for addr in range(size))))
+    gateway.start()
+    minimalmodbus.register_tcp_gateway(gateway.url)
+    reads = [minimalmodbus.BatchRead(SLAVE_ADDRESS, addr, args.registers, 3)
+             for addr in range(0, size, args.registers)]
+
+    try:
+        for max_in_flight in args.in_flight or [1, args.blocks]:
+            cost = run(gateway.url, reads, max_in_flight, args.count)
+            print('%3d in flight  %3d blocks  %8.1f ms/batch' % (max_in_flight, args.blocks, cost * 1e3))
+    finally:
+        gateway.stop()
@@ -33,13 +33,15 @@ if __name__ == '__main__':
     log.setup_logging(os.path.basename(__file__))
 
     parser = cli.get_argument_parser('CSTBox ModBus HAL')
+    parser.add_argument('--poller', choices=modbus.POLLERS, default=modbus.POLLER_SEQUENTIAL,
+                        help='devices polling strategy (default: %(default)s)')
     args = parser.parse_args()
 
     try:
         dbuslib.dbus_init()
 
         cfg = devcfg.DeviceNetworkConfiguration(autoload=True)
-        svc = modbus.ModbusSvc(dbuslib.get_bus())
+        svc = modbus.ModbusSvc(dbuslib.get_bus(), poller=args.poller)
 
         svc.log_setLevel_from_args(args)
 
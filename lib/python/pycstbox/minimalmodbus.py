@@ -24,10 +24,18 @@ MinimalModbus: A Python driver for the Modbus RTU and Modbus ASCII protocols via
 Modified by E. PASCUAL (eric.pascual@cstb.fr) for local adaptations 
 """
 
+from collections import namedtuple
+from contextlib import contextmanager
+import array
+import bisect
+import heapq
+import itertools
 import os
 import serial
+import socket
 import struct
 import sys
+import threading
 import time
 
 __author__ = 'Jonas Berg'
@@ -50,11 +58,22 @@ _NUMBER_OF_BYTES_PER_REGISTER = 2
 _SECONDS_TO_MILLISECONDS = 1000
 _ASCII_HEADER = ':'
 _ASCII_FOOTER = '\r\n'
+_BITTIMES_PER_CHARACTERTIME = 11
+_EMPTY_FRAME = b''
+_DEFAULT_NUMBER_OF_BYTES_TO_READ = 1000
+_RECEIVE_BUFFER_SIZE = 260  # The largest Modbus frame (TCP ADU)
+_MBAP_PROTOCOL_ID = 0
+
+# Python3 executes the prepared requests on bytes, without converting the frames to str
+_BYTES_NATIVE = sys.version_info[0] > 2
 
 # Several instrument instances can share the same serialport
 _SERIALPORTS = {}
 _LATEST_READ_TIMES = {}
 
+# Transports carrying the frames, keyed by port name
+_TRANSPORTS = {}
+
 ##################
 # Default values #
 ##################
@@ -77,12 +96,94 @@ TIMEOUT = 0.05
 CLOSE_PORT_AFTER_EACH_CALL = False
 """Default value for port closure setting."""
 
+TCP_PORT = 502
+"""Default value for the Modbus TCP port of gateways (int)."""
+
+TCP_TIMEOUT = 1.0
+"""Default value for the Modbus TCP response timeout in seconds (float)."""
+
+MAX_IN_FLIGHT = 4
+"""Default value for the maximum number of pipelined Modbus TCP transactions per connection (int)."""
+
+BROADCAST_TURNAROUND_DELAY = 0.1
+"""Default value for the time in seconds given to the slaves for processing a broadcast request (float)."""
+
 ###################
 # Named constants #
 ###################
 
 MODE_RTU = 'rtu'
 MODE_ASCII = 'ascii'
+MODE_TCP = 'tcp'
+
+BROADCAST_ADDRESS = 0
+"""Slave address of the requests addressed to all the slaves of a serial line, which do not answer them."""
+
+TCP_URL_PREFIX = 'tcp://'
+"""Prefix of the port names designating Modbus TCP gateways, as in ``tcp://192.168.0.10:502``."""
+
+MBAP_HEADER_SIZE = 7
+"""Size of the header of the Modbus TCP frames, including the unit identifier (int)."""
+
+# Transaction priorities (the lower the value, the higher the priority)
+PRIORITY_CONTROL = 0
+"""Priority of the writes (control actions)."""
+PRIORITY_POLL = 1
+"""Priority of the routine reads."""
+PRIORITY_CONFIG = 2
+"""Priority of the configuration reads."""
+
+
+##############
+# Exceptions #
+##############
+
+class ModbusError(Exception):
+    """Base class of the errors of the Modbus transactions.
+
+    The errors are also subclasses of the built-in exceptions raised before they were introduced
+    (IOError or ValueError), so that the existing error handling keeps working.
+
+    """
+
+
+class NoResponseError(ModbusError, IOError):
+    """The slave did not answer before the timeout."""
+
+
+class InvalidResponseError(ModbusError, ValueError):
+    """The response is malformed (framing error), or does not match the request."""
+
+
+class ChecksumError(InvalidResponseError):
+    """The checksum (CRC or LRC) of the response is wrong."""
+
+
+class SlaveReportedException(ModbusError, ValueError):
+    """The slave answered with a Modbus exception response.
+
+    The line and the slave are then working correctly, but the slave could not process the request.
+
+    Args:
+        * message (str): The error message.
+        * functioncode (int): The function code of the request.
+        * exception_code (int): The exception code given by the slave.
+
+    """
+    ILLEGAL_FUNCTION = 1
+    ILLEGAL_DATA_ADDRESS = 2
+    ILLEGAL_DATA_VALUE = 3
+    SLAVE_DEVICE_FAILURE = 4
+    ACKNOWLEDGE = 5
+    SLAVE_DEVICE_BUSY = 6
+    MEMORY_PARITY_ERROR = 8
+    GATEWAY_PATH_UNAVAILABLE = 10
+    GATEWAY_TARGET_FAILED_TO_RESPOND = 11
+
+    def __init__(self, message, functioncode, exception_code):
+        super(SlaveReportedException, self).__init__(message)
+        self.functioncode = functioncode
+        self.exception_code = exception_code
 
 
 ####################################
@@ -97,9 +198,10 @@ def register_serial_port(port,
         sp = _SERIALPORTS[port]
     except KeyError:
         _SERIALPORTS[port] = sp = serial.Serial(port=port, **settings)
+        _TRANSPORTS[port] = SerialTransport(sp)
         if logger:
             logger.info('serial port %s registered with settings :', port)
-            for k, v in settings.iteritems():
+            for k, v in settings.items():
                 logger.info('- %-10s : %s', k, v)
 
         time.sleep(0.5)
@@ -122,6 +224,902 @@ def get_serial_port(port):
     return _SERIALPORTS[port]
 
 
+def register_tcp_gateway(port, timeout=TCP_TIMEOUT, logger=None):
+    """Register a Modbus TCP gateway, so that instruments can be attached to it.
+
+    Args:
+        * port (str): The gateway URL, as ``tcp://host[:port]`` (the TCP port defaults to :data:`TCP_PORT`).
+        * timeout (float): The response timeout in seconds.
+        * logger: An optional logger.
+
+    Returns:
+        The :class:`TcpTransport` of the gateway.
+
+    Raises:
+        ValueError if the URL is invalid.
+
+    """
+    try:
+        transport = _TRANSPORTS[port]
+    except KeyError:
+        if not port.startswith(TCP_URL_PREFIX):
+            raise ValueError('invalid Modbus TCP gateway URL: %s' % port)
+        host, _, tcp_port = port[len(TCP_URL_PREFIX):].partition(':')
+        try:
+            tcp_port = int(tcp_port) if tcp_port else TCP_PORT
+        except ValueError:
+            raise ValueError('invalid Modbus TCP gateway URL: %s' % port)
+
+        _TRANSPORTS[port] = transport = TcpTransport(host, tcp_port, timeout=timeout, name=port)
+        if logger:
+            logger.info('Modbus TCP gateway %s registered (host=%s port=%d timeout=%s)', port, host, tcp_port, timeout)
+
+    else:
+        if logger:
+            logger.info('Modbus TCP gateway %s already registered', port)
+
+    return transport
+
+
+def register_transport(port, transport):
+    """Register a transport under a port name, so that instruments can be attached to it.
+
+    Args:
+        * port (str): The name used for attaching instruments to the transport.
+        * transport (:class:`Transport`): The transport.
+
+    Returns:
+        The transport.
+
+    Raises:
+        ValueError if an other transport is already registered with this name.
+
+    """
+    registered = _TRANSPORTS.setdefault(port, transport)
+    if registered is not transport:
+        raise ValueError('port %s already registered with an other transport' % port)
+    return transport
+
+
+def get_transport(port):
+    return _TRANSPORTS[port]
+
+
+class BatchRead(namedtuple('BatchRead', ['slaveaddress', 'registeraddress', 'numberOfRegisters', 'functioncode'])):
+    """Description of a registers read to be executed by :func:`read_registers_batch`.
+
+    The function code defaults to 3.
+    """
+    __slots__ = ()
+
+    def __new__(cls, slaveaddress, registeraddress, numberOfRegisters, functioncode=3):
+        return super(BatchRead, cls).__new__(cls, slaveaddress, registeraddress, numberOfRegisters, functioncode)
+
+
+def read_registers_batch(port, reads, max_in_flight=MAX_IN_FLIGHT):
+    """Read several blocks of registers in a single pipelined exchange with a Modbus TCP gateway.
+
+    The reads can address different slaves, which lets gateways fronting several RTU
+    segments process them concurrently.
+
+    Args:
+        * port (str or :class:`TcpTransport`): The name of a Modbus TCP gateway, as registered with
+          :func:`register_tcp_gateway`, or its transport.
+        * reads (list of :class:`BatchRead`): The reads to be performed (function code 3 or 4).
+        * max_in_flight (int): The maximum number of transactions sent ahead of their responses.
+
+    Returns:
+        A list with, for each read and in the same order, either the raw content of the registers
+        (bytes for Python3, str for Python2),
+        or the exception (ValueError or IOError) which prevented to obtain it.
+
+    Raises:
+        TypeError, ValueError if a read is invalid, IOError in case of connection problem.
+
+    """
+    transport = port if isinstance(port, Transport) else _TRANSPORTS[port]
+    if transport.mode != MODE_TCP:
+        raise ValueError('port {} is not a Modbus TCP gateway'.format(port))
+
+    prepared_reads = [_preparedBatchRead(transport, read) for read in reads]
+    transaction_ids = [transport.next_transaction_id() for _ in reads]
+    requests = [prepared.frame(transaction_id) for prepared, transaction_id in zip(prepared_reads, transaction_ids)]
+
+    with transport.arbiter.transaction(PRIORITY_POLL):
+        responses = transport.transact_many(requests, max_in_flight)
+
+    results = []
+    for prepared, transaction_id, response in zip(prepared_reads, transaction_ids, responses):
+        try:
+            if not response:
+                raise NoResponseError('No communication with the instrument (no answer)')
+            registerdata = prepared.parse_response(response, transaction_id, _copyRegisterData)
+        except (IOError, ValueError) as err:
+            results.append(err)
+        else:
+            results.append(registerdata)
+    return results
+
+
+def _preparedBatchRead(transport, read):
+    """Return the prepared request of a :class:`BatchRead`, creating it if needed.
+
+    The prepared requests are kept by the transport, since the same reads are most often sent
+    on each poll cycle.
+
+    """
+    try:
+        return transport.batch_reads[read]
+    except KeyError:
+        pass
+    _checkFunctioncode(read.functioncode, [3, 4])
+    _checkInt(read.numberOfRegisters, minvalue=1, maxvalue=125, description='number of registers')
+    prepared = Instrument(transport, read.slaveaddress).prepare(read.functioncode, read.registeraddress,
+                                                                numberOfRegisters=read.numberOfRegisters,
+                                                                payloadformat='raw')
+    transport.batch_reads[read] = prepared
+    return prepared
+
+
+def _copyRegisterData(registerdata):
+    """Decoder returning a copy of the register data, which is valid during the decoding only."""
+    return memoryview(registerdata).tobytes()
+
+
+def broadcast(port, functioncode, registeraddress, value, numberOfDecimals=0, numberOfRegisters=1, signed=False,
+              payloadformat=None, numberOfBits=1, turnaround_delay=BROADCAST_TURNAROUND_DELAY):
+    """Send a write request to all the slaves of a serial line at once.
+
+    The request is sent to the :data:`BROADCAST_ADDRESS`. Since the slaves do not answer it, there is
+    no confirmation that they received and executed it. The line is then kept silent for
+    *turnaround_delay*, so that the slaves have processed the request before the next one
+    is sent.
+
+    The arguments not described below are the ones of :meth:`Instrument._genericCommand`.
+
+    Args:
+        * port (str or :class:`Transport`): The name of a serial port, as registered with
+          :func:`register_serial_port`, or its transport.
+        * functioncode (int): Modbus function code. Can be 5, 6, 15 or 16.
+        * turnaround_delay (float): The time in seconds given to the slaves for processing the request.
+
+    Raises:
+        TypeError, ValueError, IOError
+
+    """
+    transport = port if isinstance(port, Transport) else _TRANSPORTS[port]
+    if transport.mode == MODE_TCP:
+        raise ValueError('port {} is not a serial line, broadcast is not supported'.format(port))
+
+    _checkFunctioncode(functioncode, [5, 6, 15, 16])
+    _checkNumerical(turnaround_delay, minvalue=0, description='turnaround delay')
+    payloadToSlave, _ = _buildCommandPayload(functioncode, registeraddress, value, numberOfDecimals,
+                                             numberOfRegisters, signed, payloadformat, numberOfBits)
+    # the broadcast address is not a valid slave address, and is thus rejected by _embedPayload
+    request = _buildRequest(BROADCAST_ADDRESS, transport.mode, functioncode, payloadToSlave)
+    if sys.version_info[0] > 2:
+        request = bytes(request, encoding='latin1')  # Convert types to make it Python3 compatible
+
+    with transport.arbiter.transaction(PRIORITY_CONTROL):
+        transport.write(request)
+        # the delay starts once the request is on the wire
+        if transport.baudrate:
+            turnaround_delay += len(request) * _BITTIMES_PER_CHARACTERTIME / float(transport.baudrate)
+        time.sleep(turnaround_delay)
+        transport.flush_input()     # discards the local echo if any
+        transport.mark_read()
+
+
+##############
+# Statistics #
+##############
+
+class ExchangeStats(object):
+    """Statistics of the frames exchanged over a transport, or with an instrument.
+
+    The round trip times are counted in a histogram, whose buckets are delimited by
+    :attr:`LATENCY_BUCKETS`, plus a last bucket for the longer ones.
+
+    """
+    LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+    """Upper bounds (in seconds) of the round trip time histogram buckets."""
+
+    def __init__(self):
+        self.exchanges = 0
+        """Number of exchanges (int)."""
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.silent_time = 0.
+        """Time spent waiting for the silent period before sending the requests (float, in seconds)."""
+        self.roundtrip_time = 0.
+        """Cumulated round trip time (float, in seconds)."""
+        self.latency_histogram = [0] * (len(self.LATENCY_BUCKETS) + 1)
+
+    def record(self, sent, received, roundtrip, silent_time=0.):
+        """Count an exchange.
+
+        Args:
+            * sent (int): The number of bytes sent.
+            * received (int): The number of bytes received.
+            * roundtrip (float): The time in seconds between the end of the write and the end of the read.
+            * silent_time (float): The time in seconds waited for the silent period before the write.
+
+        """
+        self.exchanges += 1
+        self.bytes_sent += sent
+        self.bytes_received += received
+        self.silent_time += silent_time
+        self.roundtrip_time += roundtrip
+        self.latency_histogram[bisect.bisect_left(self.LATENCY_BUCKETS, roundtrip)] += 1
+
+    def latency_percentile(self, percent):
+        """Give an upper bound of a percentile of the round trip times.
+
+        Args:
+            percent (float): The percentile, 0 to 100.
+
+        Returns:
+            The upper bound (float, in seconds) of the histogram bucket holding the percentile,
+            None for the last bucket or if there was no exchange.
+
+        """
+        rank = self.exchanges * percent / 100.
+        count = 0
+        for bound, bucket_count in zip(self.LATENCY_BUCKETS, self.latency_histogram):
+            count += bucket_count
+            if count and count >= rank:
+                return bound
+        return None
+
+    def summary(self):
+        """Give a one line summary of the statistics (str)."""
+        if not self.exchanges:
+            return 'no exchange'
+
+        def bound(value):
+            return '>{:.0f}ms'.format(self.LATENCY_BUCKETS[-1] * 1000) if value is None else \
+                '<={:.0f}ms'.format(value * 1000)
+
+        return '{} exchanges, {} bytes sent, {} bytes received, round trip avg {:.1f}ms p50 {} p95 {}, ' \
+               'silent periods {:.2f}s'.format(
+                   self.exchanges, self.bytes_sent, self.bytes_received,
+                   self.roundtrip_time / self.exchanges * 1000,
+                   bound(self.latency_percentile(50)), bound(self.latency_percentile(95)),
+                   self.silent_time)
+
+
+###################
+# Bus arbitration #
+###################
+
+class BusArbiter(object):
+    """Serializes the transactions on a transport shared by several instruments and threads.
+
+    The transport is granted to one thread at a time, the waiting ones being served by priority
+    (see :data:`PRIORITY_CONTROL`, :data:`PRIORITY_POLL` and :data:`PRIORITY_CONFIG`), then in
+    arrival order. A control write thus waits at most for the end of the current transaction,
+    whatever the polling load. To avoid starvation, a request waiting for more than
+    :attr:`max_wait` seconds is served before the others. The silent period between frames is
+    enforced when the transport is granted.
+
+    The arbiter is reentrant: a thread owning the transport can acquire it again.
+
+    Args:
+        transport (:class:`Transport`): The arbitrated transport.
+
+    """
+
+    MAX_WAIT = 2.0
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.max_wait = self.MAX_WAIT
+        """The wait time (in seconds) after which a request is served whatever its priority."""
+        self._lock = threading.Lock()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._busy = False
+        self._owner = None
+        self._depth = 0
+        self._local = threading.local()
+
+    def request(self, priority, grant):
+        """Request the transport without waiting.
+
+        Args:
+            * priority (int): The priority of the request.
+            * grant (callable): Called without argument when the transport is granted, if not immediately.
+
+        Returns:
+            True if the transport is granted immediately, False if the request is queued.
+
+        The transport must be released with :meth:`release` once granted.
+
+        """
+        with self._lock:
+            if not self._busy:
+                self._busy = True
+                return True
+            heapq.heappush(self._queue, (priority, next(self._sequence), time.time(), grant))
+            return False
+
+    def acquire(self, priority=PRIORITY_POLL):
+        """Wait until the transport is granted to the calling thread.
+
+        Args:
+            priority (int): The priority of the request, unless overridden with :meth:`priority`.
+
+        """
+        me = threading.current_thread()
+        if self._owner is me:
+            self._depth += 1
+            return
+
+        override = getattr(self._local, 'priority', None)
+        if override is not None:
+            priority = override
+        with self._lock:
+            # the event is only allocated when the transport is busy
+            granted = None
+            if self._busy:
+                granted = threading.Event()
+                heapq.heappush(self._queue, (priority, next(self._sequence), time.time(), granted.set))
+            self._busy = True
+        if granted is not None:
+            granted.wait()
+        self._owner = me
+        self._depth = 1
+
+    def release(self):
+        """Release the transport, handing it over to the next waiting request if any."""
+        if self._owner is threading.current_thread():
+            self._depth -= 1
+            if self._depth:
+                return
+            self._owner = None
+
+        with self._lock:
+            if not self._queue:
+                self._busy = False
+                return
+            oldest = min(self._queue, key=lambda entry: entry[1])
+            if time.time() - oldest[2] > self.max_wait:
+                self._queue.remove(oldest)
+                heapq.heapify(self._queue)
+                grant = oldest[3]
+            else:
+                grant = heapq.heappop(self._queue)[3]
+        grant()
+
+    def wait_silence(self):
+        """Sleep until the silent period since the latest read has elapsed.
+
+        Returns:
+            The time slept (in seconds).
+
+        """
+        sleep_time = self.transport.silent_period - self.transport.time_since_read()
+        if sleep_time <= 0:
+            return 0
+        time.sleep(sleep_time)
+        return sleep_time
+
+    @contextmanager
+    def transaction(self, priority=PRIORITY_POLL):
+        """Context manager owning the transport for a transaction, the silent period being respected.
+
+        Args:
+            priority (int): The priority of the transaction, unless overridden with :meth:`priority`.
+
+        The context value is the time slept for respecting the silent period.
+
+        """
+        self.acquire(priority)
+        try:
+            yield self.wait_silence()
+        finally:
+            self.release()
+
+    @contextmanager
+    def suspended(self, priority=PRIORITY_POLL):
+        """Context manager handing the transport over to the other threads while the calling one waits.
+
+        Args:
+            priority (int): The priority of the request acquiring the transport again, unless overridden
+                with :meth:`priority`.
+
+        If the calling thread owns the transport, it is released whatever the number of nested
+        acquisitions, then acquired again with the same nesting on exit, the silent period being
+        respected. Does nothing otherwise.
+
+        """
+        if self._owner is not threading.current_thread():
+            yield
+            return
+        depth = self._depth
+        self._depth = 1
+        self.release()
+        try:
+            yield
+        finally:
+            self.acquire(priority)
+            self._depth = depth
+            self.wait_silence()
+
+    @contextmanager
+    def priority(self, priority):
+        """Context manager overriding the priority of the transactions done by the calling thread.
+
+        Args:
+            priority (int or None): The priority to be used. None for keeping the default ones.
+
+        """
+        previous = getattr(self._local, 'priority', None)
+        self._local.priority = priority if priority is not None else previous
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+
+def is_write_functioncode(functioncode):
+    """Tell if a function code changes the state of the slave (write or read/write functions)."""
+    return functioncode in _WRITE_FUNCTIONCODES
+
+
+def _transactionPriority(functioncode):
+    """Return the default priority of the transactions using a function code."""
+    return PRIORITY_CONTROL if is_write_functioncode(functioncode) else PRIORITY_POLL
+
+
+##############
+# Transports #
+##############
+
+class Transport(object):
+    """Base class of the links carrying the Modbus frames between the master and the slaves.
+
+    Transports are shared by all the instruments attached to the same port. They provide
+    the raw I/O and the timing information needed for enforcing the silent period between
+    frames. Frames are exchanged as bytes for Python3 and as bytestrings for Python2.
+
+    """
+
+    serial = None
+    """The underlying pySerial object if any."""
+
+    mode = MODE_RTU
+    """The Modbus mode used by default by the instruments attached to the transport."""
+
+    baudrate = None
+    """The line speed in Baud, or None if not relevant."""
+
+    timeout = TIMEOUT
+    """The read timeout in seconds (float)."""
+
+    end_of_frame_silence = None
+    """The inter-character silence (in seconds) marking the end of a frame of unknown size,
+    or None for using the silent period. A longer value may be needed with USB adapters
+    delivering the received data in bursts."""
+
+    def __init__(self, name):
+        self.name = name
+        self.arbiter = BusArbiter(self)
+        """The :class:`BusArbiter` serializing the transactions."""
+        self.receive_buffer = bytearray(_RECEIVE_BUFFER_SIZE)
+        """Preallocated buffer for receiving the responses (see :meth:`Instrument._exchange`).
+        Its content belongs to the owner of the :attr:`arbiter`."""
+        self.stats = ExchangeStats()
+        """The :class:`ExchangeStats` of the exchanges of all the instruments of the port."""
+        self._latest_read_time = 0
+
+    def __repr__(self):
+        return "{}<name={}>".format(self.__class__.__name__, self.name)
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def is_open(self):
+        return True
+
+    def flush_input(self):
+        pass
+
+    def flush_output(self):
+        pass
+
+    def write(self, data):
+        """Send a frame.
+
+        Args:
+            data (bytes): The raw frame.
+
+        """
+        raise NotImplementedError()
+
+    def read(self, size):
+        """Read a frame.
+
+        Args:
+            size (int): The number of bytes to be read.
+
+        Returns:
+            The bytes received (less than *size* if the timeout expired).
+
+        """
+        raise NotImplementedError()
+
+    def readinto(self, buffer):
+        """Read a frame into a buffer.
+
+        Args:
+            buffer (bytearray or memoryview): The buffer, whose size is the number of bytes to be read.
+
+        Returns:
+            The number of bytes received (less than the buffer size if the timeout expired).
+
+        The default implementation copies the bytes returned by :meth:`read`.
+
+        """
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read_until_silence(self, size):
+        """Read a frame of unknown size, whose end is detected by the inter-character silence.
+
+        Args:
+            size (int): The maximum number of bytes to be read.
+
+        Returns:
+            The bytes received (nothing if the timeout expired before the first one).
+
+        The default implementation reads until *size* bytes or the timeout.
+
+        """
+        return self.read(size)
+
+    @property
+    def frame_silence(self):
+        """The inter-character silence (in seconds) marking the end of a frame."""
+        return self.end_of_frame_silence or self.silent_period
+
+    @property
+    def silent_period(self):
+        """The minimum silence (in seconds) to be respected between frames."""
+        return 0
+
+    def time_since_read(self):
+        """Timing hook giving the time elapsed (in seconds) since the end of the latest read."""
+        return time.time() - self._latest_read_time
+
+    def mark_read(self):
+        """Timing hook called when a read is complete."""
+        self._latest_read_time = time.time()
+
+
+class SerialTransport(Transport):
+    """Transport over a serial line (RS485 or RS232), using a pySerial object.
+
+    Args:
+        serial_port (serial.Serial): The serial port.
+
+    """
+
+    def __init__(self, serial_port):
+        super(SerialTransport, self).__init__(serial_port.port)
+        self.serial = serial_port
+        if self.serial.port is None:
+            self.serial.open()
+
+    def __repr__(self):
+        return "{}<serial={}>".format(self.__class__.__name__, self.serial)
+
+    @property
+    def baudrate(self):
+        return self.serial.baudrate
+
+    @property
+    def timeout(self):
+        return self.serial.timeout
+
+    def open(self):
+        self.serial.open()
+
+    def close(self):
+        self.serial.close()
+
+    def is_open(self):
+        return self.serial.isOpen()
+
+    def flush_input(self):
+        self.serial.flushInput()
+
+    def flush_output(self):
+        self.serial.flushOutput()
+
+    def write(self, data):
+        self.serial.write(data)
+
+    def read(self, size):
+        return self.serial.read(size)
+
+    def readinto(self, buffer):
+        if not hasattr(self.serial, 'readinto'):
+            # older pySerial versions
+            return super(SerialTransport, self).readinto(buffer)
+        return self.serial.readinto(buffer)
+
+    def read_until_silence(self, size):
+        # The read timeout is used as the inter-character one once the first byte is received,
+        # bytes being then read as they arrive. The pySerial inter-byte timeout is not used, since its
+        # POSIX implementation relies on VTIME, whose resolution (0.1 s) is far too coarse.
+        frame = self.serial.read(1)
+        if not frame:
+            return frame
+
+        timeout = self.serial.timeout
+        self.serial.timeout = self.frame_silence
+        try:
+            while len(frame) < size:
+                chunk = self.serial.read(min(max(1, self.serial.inWaiting()), size - len(frame)))
+                if not chunk:
+                    break
+                frame += chunk
+        finally:
+            self.serial.timeout = timeout
+        return frame
+
+    @property
+    def silent_period(self):
+        return _calculate_minimum_silent_period(self.serial.baudrate)
+
+    def time_since_read(self):
+        return time.time() - _LATEST_READ_TIMES.get(self.serial.port, 0)
+
+    def mark_read(self):
+        _LATEST_READ_TIMES[self.serial.port] = time.time()
+
+
+class TcpTransport(Transport):
+    """Transport to a Modbus TCP gateway (or device), using a persistent connection.
+
+    The connection is opened on first use and re-opened after any socket error. There is no
+    silent period between frames.
+
+    Args:
+        * host (str): The gateway host name or IP address.
+        * port (int): The gateway TCP port.
+        * timeout (float): The response timeout in seconds.
+        * name (str): The port name (defaults to the gateway URL).
+
+    """
+
+    mode = MODE_TCP
+
+    def __init__(self, host, port=TCP_PORT, timeout=TCP_TIMEOUT, name=None):
+        super(TcpTransport, self).__init__(name or '{}{}:{}'.format(TCP_URL_PREFIX, host, port))
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._socket = None
+        self.batch_reads = {}
+        """The prepared requests of the reads done by :func:`read_registers_batch`, keyed by :class:`BatchRead`."""
+        self._transaction_id = 0
+        # the ids are allocated outside of the arbiter (batches, prepared requests)
+        self._transaction_id_lock = threading.Lock()
+        self._expected_transaction_id = None
+
+    def __repr__(self):
+        return "{}<host={}, port={}, connected={}>".format(self.__class__.__name__, self.host, self.port,
+                                                          self._socket is not None)
+
+    def open(self):
+        if self._socket is None:
+            try:
+                self._socket = socket.create_connection((self.host, self.port), self.timeout)
+            except socket.error as err:
+                raise IOError('Cannot connect to Modbus TCP gateway {}:{} ({})'.format(self.host, self.port, err))
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            finally:
+                self._socket = None
+
+    def is_open(self):
+        return self._socket is not None
+
+    def flush_input(self):
+        if self._socket is None:
+            return
+        self._socket.setblocking(False)
+        try:
+            while self._socket.recv(4096):
+                pass
+        except socket.error:
+            pass
+        finally:
+            if self._socket is not None:
+                self._socket.settimeout(self.timeout)
+
+    def next_transaction_id(self):
+        """Return the transaction identifier to be used for the next request.
+
+        It can be called from several threads at a time.
+
+        """
+        with self._transaction_id_lock:
+            self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+            return self._transaction_id
+
+    def write(self, data):
+        self.open()
+        self._expected_transaction_id = struct.unpack('>H', data[:2])[0]
+        try:
+            self._socket.sendall(data)
+        except socket.error as err:
+            self.close()
+            raise IOError('Modbus TCP gateway {} write error ({})'.format(self.name, err))
+
+    def read(self, size):
+        """Read a frame.
+
+        The MBAP header gives the actual frame length, so that *size* is just a hint. Frames
+        answering an other transaction than the latest request (e.g. late responses to timed
+        out requests) are discarded.
+
+        """
+        if self._socket is None:
+            raise IOError('Modbus TCP gateway {} not connected'.format(self.name))
+
+        deadline = time.time() + self.timeout
+        while True:
+            transaction_id, frame = self._read_frame(deadline)
+            if transaction_id is None or transaction_id == self._expected_transaction_id \
+                    or self._expected_transaction_id is None:
+                return frame
+
+    def readinto(self, buffer):
+        """Read a frame into a buffer.
+
+        As for :meth:`read`, the MBAP header gives the actual frame length, the buffer having to
+        be large enough for any frame (see :data:`_RECEIVE_BUFFER_SIZE`).
+
+        """
+        if self._socket is None:
+            raise IOError('Modbus TCP gateway {} not connected'.format(self.name))
+
+        view = memoryview(buffer)
+        deadline = time.time() + self.timeout
+        while True:
+            transaction_id, count = self._read_frame_into(view, deadline)
+            if transaction_id is None or transaction_id == self._expected_transaction_id \
+                    or self._expected_transaction_id is None:
+                return count
+
+    def transact_many(self, requests, max_in_flight=MAX_IN_FLIGHT):
+        """Perform several transactions, with up to *max_in_flight* requests sent ahead of their responses.
+
+        Responses are matched with the requests by their MBAP transaction identifier, so that the
+        gateway can reply in any order. The timeout applies to the delay between two consecutive responses.
+
+        Args:
+            * requests (list of bytes): The request frames, with distinct transaction identifiers.
+            * max_in_flight (int): The maximum number of pending requests.
+
+        Returns:
+            The list of the response frames in the order of the requests (None for requests without response).
+
+        Raises:
+            IOError in case of connection problem.
+
+        """
+        _checkInt(max_in_flight, minvalue=1, description='max in flight')
+
+        self.open()
+        self._expected_transaction_id = None
+        responses = [None] * len(requests)
+        pending = {}
+        next_request = 0
+        deadline = time.time() + self.timeout
+
+        while next_request < len(requests) or pending:
+            if self._socket is None:
+                # closed after an incomplete frame, the pending transactions being given up
+                self.open()
+            while next_request < len(requests) and len(pending) < max_in_flight:
+                request = requests[next_request]
+                pending[struct.unpack('>H', request[:2])[0]] = next_request
+                try:
+                    self._socket.sendall(request)
+                except socket.error as err:
+                    self.close()
+                    raise IOError('Modbus TCP gateway {} write error ({})'.format(self.name, err))
+                next_request += 1
+
+            transaction_id, frame = self._read_frame(deadline)
+            if transaction_id is None:
+                # timeout or incomplete frame: give up the pending transactions (their late responses
+                # will be ignored)
+                pending.clear()
+                deadline = time.time() + self.timeout
+                continue
+
+            index = pending.pop(transaction_id, None)
+            if index is not None:
+                responses[index] = frame
+                deadline = time.time() + self.timeout
+
+        return responses
+
+    def _read_frame(self, deadline):
+        """Read a whole frame.
+
+        Returns:
+            A tuple (transaction id, frame). The transaction id is None and the frame is
+            incomplete if the deadline is reached before the end of the frame.
+
+        """
+        buffer = bytearray(_RECEIVE_BUFFER_SIZE)
+        transaction_id, count = self._read_frame_into(memoryview(buffer), deadline)
+        return transaction_id, bytes(buffer[:count])
+
+    def _read_frame_into(self, view, deadline):
+        """Read a whole frame into a buffer.
+
+        Returns:
+            A tuple (transaction id, number of bytes received). The transaction id is None and
+            the frame is incomplete if the deadline is reached before the end of the frame.
+
+        """
+        if self._socket is None:
+            raise IOError('Modbus TCP gateway {} not connected'.format(self.name))
+        count = self._receive_into(view[:MBAP_HEADER_SIZE], deadline)
+        if count < MBAP_HEADER_SIZE:
+            return None, count
+        transaction_id, _, length = struct.unpack_from('>HHH', view)
+        size = MBAP_HEADER_SIZE + length - 1
+        if size > len(view):
+            self.close()
+            raise IOError('Modbus TCP gateway {} sent a too long frame ({} bytes)'.format(self.name, size))
+        count += self._receive_into(view[MBAP_HEADER_SIZE:size], deadline)
+        if count < size:
+            # the header is consumed, so that the rest of the frame would be taken for the next header
+            self.close()
+            return None, count
+        return transaction_id, count
+
+    def _receive_into(self, view, deadline):
+        received = 0
+        while received < len(view):
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                self._socket.settimeout(timeout)
+                count = self._socket.recv_into(view[received:])
+            except socket.timeout:
+                break
+            except socket.error as err:
+                self.close()
+                raise IOError('Modbus TCP gateway {} read error ({})'.format(self.name, err))
+            if not count:
+                self.close()
+                raise IOError('Modbus TCP gateway {} closed the connection'.format(self.name))
+            received += count
+
+        if received and received < len(view):
+            # the stream is out of sync, the only way to recover is to reconnect
+            self.close()
+        return received
+
+
 ############################
 # Modbus instrument object #
 ############################
@@ -132,21 +1130,26 @@ class Instrument(object):
 
     Args:
         * port (str): The serial port name, for example ``/dev/ttyUSB0`` (Linux), ``/dev/tty.usbserial`` (OS X) or ``COM4`` (Windows).
+          It can also be the name of a transport registered with :func:`register_transport`, or the
+          :class:`Transport` instance itself.
         * slaveaddress (int): Slave address in the range 1 to 247 (use decimal numbers, not hex).
-        * mode (str): Mode selection. Can be MODE_RTU or MODE_ASCII.
+        * mode (str): Mode selection. Can be MODE_RTU, MODE_ASCII or MODE_TCP. Defaults to the mode of the transport
+          (MODE_TCP for Modbus TCP gateways registered with :func:`register_tcp_gateway`, MODE_RTU otherwise).
 
     """
 
-    def __init__(self, port, slaveaddress, mode=MODE_RTU):
-        self.serial = _SERIALPORTS[port]
-        if self.serial.port is None:
-            self.serial.open()
+    def __init__(self, port, slaveaddress, mode=None):
+        self.transport = port if isinstance(port, Transport) else _TRANSPORTS[port]
+        """The :class:`Transport` carrying the frames, shared by all the instruments of the port."""
+
+        self.serial = self.transport.serial
+        """The pySerial object of the port, or None if the transport is not a serial one."""
 
         self.address = slaveaddress
         """Slave address (int). Most often set by the constructor (see the class documentation). """
 
-        self.mode = mode
-        """Slave mode (str), can be MODE_RTU or MODE_ASCII.  Most often set by the constructor (see the class documentation).
+        self.mode = mode or self.transport.mode
+        """Slave mode (str), can be MODE_RTU, MODE_ASCII or MODE_TCP.  Most often set by the constructor (see the class documentation).
 
         New in version 0.6.
         """
@@ -163,10 +1166,17 @@ class Instrument(object):
         self.precalculate_read_size = True
         """ If this is :const:`False`, the serial port reads until timeout
         instead of just reading a specific number of bytes. Defaults to :const:`True`.
+        In RTU mode, the end of the responses is then detected by the inter-character silence
+        (see :meth:`Transport.read_until_silence`), which is also the case for the responses
+        whose size cannot be precalculated.
 
         New in version 0.5.
         """
 
+        self.stats = None
+        """Set this to an :class:`ExchangeStats` for collecting the statistics of the exchanges with the instrument.
+        Defaults to :const:`None`."""
+
         self.handle_local_echo = False
         """ Set to to :const:`True` if your RS-485 adaptor has local echo enabled. 
         Then the transmitted message will immediately appear at the receive line of the RS-485 adaptor.
@@ -177,12 +1187,12 @@ class Instrument(object):
         """
 
         if self.close_port_after_each_call:
-            self.serial.close()
+            self.transport.close()
 
     def __repr__(self):
         """ String representation of the :class:`.Instrument` object. """
         return "{}.{}<id=0x{:x}, address={}, mode={}, close_port_after_each_call={}, precalculate_read_size={}, " \
-               "debug={}, serial={}>".format(
+               "debug={}, transport={}>".format(
             self.__module__,
             self.__class__.__name__,
             id(self),
@@ -191,7 +1201,7 @@ class Instrument(object):
             self.close_port_after_each_call,
             self.precalculate_read_size,
             self.debug,
-            self.serial,
+            self.transport,
         )
 
     ####################################
@@ -215,13 +1225,55 @@ class Instrument(object):
         _checkFunctioncode(functioncode, [1, 2])
         return self._genericCommand(functioncode, registeraddress)
 
-    def write_bit(self, registeraddress, value, functioncode=5):
-        """Write one bit to the slave.
+    def write_bit(self, registeraddress, value, functioncode=5):
+        """Write one bit to the slave.
+
+        Args:
+            * registeraddress (int): The slave register address (use decimal numbers, not hex).
+            * value (int): 0 or 1
+            * functioncode (int): Modbus function code. Can be 5 or 15.
+
+        Returns:
+            None
+
+        Raises:
+            ValueError, TypeError, IOError
+
+        """
+        _checkFunctioncode(functioncode, [5, 15])
+        _checkInt(value, minvalue=0, maxvalue=1, description='input value')
+        return self._genericCommand(functioncode, registeraddress, value)
+
+    def read_bits(self, registeraddress, numberOfBits, functioncode=2, packed=False):
+        """Read consecutive bits from the slave, in a single transaction.
+
+        Args:
+            * registeraddress (int): The slave address of the first bit (use decimal numbers, not hex).
+            * numberOfBits (int): The number of bits to read (1 to 2000).
+            * functioncode (int): Modbus function code. Can be 1 or 2.
+            * packed (bool): Whether the bits should be returned as they are packed in the response.
+
+        Returns:
+            The bit values 0 or 1 (list of int), or if *packed* is True the packed bits (bytes), the
+            first bit being the least significant bit of the first byte.
+
+        Raises:
+            ValueError, TypeError, IOError
+
+        """
+        _checkFunctioncode(functioncode, [1, 2])
+        _checkInt(numberOfBits, minvalue=1, maxvalue=_MAX_NUMBER_OF_BITS_TO_READ, description='number of bits')
+        return self._genericCommand(functioncode, registeraddress, numberOfBits=numberOfBits,
+                                    payloadformat=_PAYLOADFORMAT_RAW if packed else _PAYLOADFORMAT_BITS)
+
+    def write_bits(self, registeraddress, values):
+        """Write consecutive bits to the slave, in a single transaction.
+
+        Uses Modbus function code 15.
 
         Args:
-            * registeraddress (int): The slave register address (use decimal numbers, not hex).
-            * value (int): 0 or 1
-            * functioncode (int): Modbus function code. Can be 5 or 15.
+            * registeraddress (int): The slave address of the first bit (use decimal numbers, not hex).
+            * values (list of int): The bit values 0 or 1 (1 to 1968 values).
 
         Returns:
             None
@@ -230,9 +1282,11 @@ class Instrument(object):
             ValueError, TypeError, IOError
 
         """
-        _checkFunctioncode(functioncode, [5, 15])
-        _checkInt(value, minvalue=0, maxvalue=1, description='input value')
-        self._genericCommand(functioncode, registeraddress, value)
+        if not isinstance(values, list):
+            raise TypeError('The "values parameter" must be a list. Given: {0!r}'.format(values))
+        _checkInt(len(values), minvalue=1, maxvalue=_MAX_NUMBER_OF_BITS_TO_WRITE, description='number of bits')
+        return self._genericCommand(15, registeraddress, values, numberOfBits=len(values),
+                                    payloadformat=_PAYLOADFORMAT_BITS)
 
     def read_register(self, registeraddress, numberOfDecimals=0, functioncode=3, signed=False):
         """Read an integer from one 16-bit register in the slave, possibly scaling it.
@@ -313,7 +1367,34 @@ class Instrument(object):
         _checkBool(signed, description='signed')
         _checkNumerical(value, description='input value')
 
-        self._genericCommand(functioncode, registeraddress, value, numberOfDecimals, signed=signed)
+        return self._genericCommand(functioncode, registeraddress, value, numberOfDecimals, signed=signed)
+
+    def mask_write_register(self, registeraddress, andMask, orMask):
+        """Modify bits of one 16-bit register in the slave, in a single transaction.
+
+        Uses Modbus function code 22. The slave computes the new register content as
+        ``(current AND andMask) OR (orMask AND (NOT andMask))``, so that bits can be set or cleared
+        without reading the register first, and without the risk of overwriting a change
+        done by another master in between.
+
+        For example ``andMask=0xFFFB`` and ``orMask=0x0004`` sets the bit 2, and ``andMask=0xFFFB``
+        and ``orMask=0`` clears it.
+
+        Args:
+            * registeraddress (int): The slave register address (use decimal numbers, not hex).
+            * andMask (int): The AND mask, 0 to 65535. Its bits at 0 designate the bits to be modified.
+            * orMask (int): The OR mask, 0 to 65535. It gives the new value of the modified bits.
+
+        Returns:
+            None
+
+        Raises:
+            ValueError, TypeError, IOError
+
+        """
+        _checkInt(andMask, minvalue=0, maxvalue=0xFFFF, description='AND mask')
+        _checkInt(orMask, minvalue=0, maxvalue=0xFFFF, description='OR mask')
+        return self._genericCommand(22, registeraddress, (andMask, orMask))
 
     def read_long(self, registeraddress, functioncode=3, signed=False):
         """Read a long integer (32 bits) from the slave.
@@ -371,7 +1452,7 @@ class Instrument(object):
 
         _checkInt(value, minvalue=MIN_VALUE_LONG, maxvalue=MAX_VALUE_LONG, description='input value')
         _checkBool(signed, description='signed')
-        self._genericCommand(16, registeraddress, value, numberOfRegisters=2, signed=signed, payloadformat='long')
+        return self._genericCommand(16, registeraddress, value, numberOfRegisters=2, signed=signed, payloadformat='long')
 
     def read_float(self, registeraddress, functioncode=3, numberOfRegisters=2):
         """Read a floating point number from the slave.
@@ -433,8 +1514,8 @@ class Instrument(object):
         """
         _checkNumerical(value, description='input value')
         _checkInt(numberOfRegisters, minvalue=2, maxvalue=4, description='number of registers')
-        self._genericCommand(16, registeraddress, value, \
-                             numberOfRegisters=numberOfRegisters, payloadformat='float')
+        return self._genericCommand(16, registeraddress, value, \
+                                    numberOfRegisters=numberOfRegisters, payloadformat='float')
 
     def read_string(self, registeraddress, numberOfRegisters=16, functioncode=3):
         """Read a string from the slave.
@@ -484,8 +1565,8 @@ class Instrument(object):
         """
         _checkInt(numberOfRegisters, minvalue=1, description='number of registers for write string')
         _checkString(textstring, 'input string', minlength=1, maxlength=2 * numberOfRegisters)
-        self._genericCommand(16, registeraddress, textstring, \
-                             numberOfRegisters=numberOfRegisters, payloadformat='string')
+        return self._genericCommand(16, registeraddress, textstring, \
+                                    numberOfRegisters=numberOfRegisters, payloadformat='string')
 
     def read_registers(self, registeraddress, numberOfRegisters, functioncode=3):
         """Read integers from 16-bit registers in the slave.
@@ -512,6 +1593,54 @@ class Instrument(object):
         return self._genericCommand(functioncode, registeraddress, \
                                     numberOfRegisters=numberOfRegisters, payloadformat='registers')
 
+    def read_write_registers(self, readaddress, numberOfReadRegisters, writeaddress, values):
+        """Write integers to 16-bit registers in the slave, and read 16-bit registers, in a single transaction.
+
+        Uses Modbus function code 23. The slave performs the write before the read, so
+        that this can be used for writing a setpoint and reading back the resulting status,
+        for the cost of a single transaction.
+
+        Args:
+            * readaddress (int): The slave register start address of the read (use decimal numbers, not hex).
+            * numberOfReadRegisters (int): The number of registers to read (1 to 125).
+            * writeaddress (int): The slave register start address of the write (use decimal numbers, not hex).
+            * values (list of int): The values to store in the slave registers (1 to 121 values).
+
+        Returns:
+            The read register data (a list of int).
+
+        Raises:
+            ValueError, TypeError, IOError
+
+        """
+        _checkInt(numberOfReadRegisters, minvalue=1, maxvalue=_MAX_NUMBER_OF_READ_WRITE_READ_REGISTERS,
+                  description='number of registers to read')
+        return self._genericCommand(23, readaddress, (writeaddress, values), \
+                                    numberOfRegisters=numberOfReadRegisters, payloadformat='registers')
+
+    def read_raw_registers(self, registeraddress, numberOfRegisters, functioncode=3):
+        """Read a block of 16-bit registers in the slave, without any conversion.
+
+        Args:
+            * registeraddress (int): The slave register start address (use decimal numbers, not hex).
+            * numberOfRegisters (int): The number of registers to read.
+            * functioncode (int): Modbus function code. Can be 3 or 4.
+
+        This is intended for decoding the registers with :mod:`struct`, the data being the ones
+        sent by the slave (two bytes per register, most significant byte first).
+
+        Returns:
+            The register data (bytes for Python3, str for Python2).
+
+        Raises:
+            ValueError, TypeError, IOError
+
+        """
+        _checkFunctioncode(functioncode, [3, 4])
+        _checkInt(numberOfRegisters, minvalue=1, description='number of registers')
+        return self._genericCommand(functioncode, registeraddress, \
+                                    numberOfRegisters=numberOfRegisters, payloadformat='raw')
+
     def write_registers(self, registeraddress, values):
         """Write integers to 16-bit registers in the slave.
 
@@ -540,24 +1669,58 @@ class Instrument(object):
         _checkInt(len(values), minvalue=1, description='length of input list')
         # Note: The content of the list is checked at content conversion.
 
-        self._genericCommand(16, registeraddress, values, numberOfRegisters=len(values), payloadformat='registers')
+        return self._genericCommand(16, registeraddress, values, numberOfRegisters=len(values), payloadformat='registers')
+
+    #####################
+    # Prepared requests #
+    #####################
+
+    def prepare(self, functioncode, registeraddress, value=None,
+                numberOfDecimals=0, numberOfRegisters=1, signed=False, payloadformat=None, numberOfBits=1):
+        """Prepare a command for being executed repeatedly.
+
+        The arguments are the ones of :meth:`_genericCommand`. They are validated once, and the
+        request frame is built once, so that executing the returned :class:`PreparedRequest` costs
+        only the I/O and the checks of the response. This is intended for the polling loops,
+        sending the same requests on each cycle.
+
+        For example, ``instrument.prepare(3, 289, numberOfRegisters=10, payloadformat='registers')``
+        prepares the equivalent of ``instrument.read_registers(289, 10)``.
+
+        The request is prepared for the current :attr:`address` and :attr:`mode` of the instrument.
+
+        Returns:
+            The :class:`PreparedRequest`.
+
+        Raises:
+            ValueError, TypeError
+
+        """
+        return PreparedRequest(self, functioncode, registeraddress, value,
+                               numberOfDecimals, numberOfRegisters, signed, payloadformat, numberOfBits)
 
     ###################
     # Generic command #
     ###################
 
     def _genericCommand(self, functioncode, registeraddress, value=None, \
-                        numberOfDecimals=0, numberOfRegisters=1, signed=False, payloadformat=None):
+                        numberOfDecimals=0, numberOfRegisters=1, signed=False, payloadformat=None, numberOfBits=1):
         """Generic command for reading and writing registers and bits.
 
         Args:
             * functioncode (int): Modbus function code.
             * registeraddress (int): The register address  (use decimal numbers, not hex).
             * value (numerical or string or None or list of int): The value to store in the register. Depends on payloadformat.
+              For function code 15 with payloadformat='bits', the list of the bit values.
+              For function code 22, a tuple (AND mask, OR mask).
+              For function code 23, a tuple (write start address, list of int) describing the write.
             * numberOfDecimals (int): The number of decimals for content conversion. Only for a single register.
             * numberOfRegisters (int): The number of registers to read/write. Only certain values allowed, depends on payloadformat.
+              For function code 23, the number of registers to read.
             * signed (bool): Whether the data should be interpreted as unsigned or signed. Only for a single register or for payloadformat='long'.
-            * payloadformat (None or string): None, 'long', 'float', 'string', 'register', 'registers'. Not necessary for single registers or bits.
+            * payloadformat (None or string): None, 'long', 'float', 'string', 'register', 'registers', 'bits', 'raw'. Not necessary for single registers or bits.
+            * numberOfBits (int): The number of bits to read/write, for the function codes 1, 2 and 15.
+              More than a single bit requires payloadformat='bits' (list of int), or 'raw' (the packed bits) for reads.
 
         If a value of 77.0 is stored internally in the slave register as 770,
         then use ``numberOfDecimals=1`` which will divide the received data from the slave by 10
@@ -566,396 +1729,782 @@ class Instrument(object):
         when writing data to the slave.
 
         Returns:
-            The register data in numerical value (int or float), or the bit value 0 or 1 (int), or ``None``.
+            The register data in numerical value (int or float), or the bit value(s) 0 or 1 (int), or ``None``.
 
         Raises:
             ValueError, TypeError, IOError
 
         """
-        NUMBER_OF_BITS = 1
-        NUMBER_OF_BYTES_FOR_ONE_BIT = 1
-        NUMBER_OF_BYTES_BEFORE_REGISTERDATA = 1
-        ALL_ALLOWED_FUNCTIONCODES = list(range(1, 7)) + [15, 16]  # To comply with both Python2 and Python3
-        MAX_NUMBER_OF_REGISTERS = 255
-
-        # Payload format constants, so datatypes can be told apart.
-        # Note that bit datatype not is included, because it uses other functioncodes.
-        PAYLOADFORMAT_LONG = 'long'
-        PAYLOADFORMAT_FLOAT = 'float'
-        PAYLOADFORMAT_STRING = 'string'
-        PAYLOADFORMAT_REGISTER = 'register'
-        PAYLOADFORMAT_REGISTERS = 'registers'
-
-        ALL_PAYLOADFORMATS = [PAYLOADFORMAT_LONG, PAYLOADFORMAT_FLOAT, \
-                              PAYLOADFORMAT_STRING, PAYLOADFORMAT_REGISTER, PAYLOADFORMAT_REGISTERS]
-
-        ## Check input values ##
-        _checkFunctioncode(functioncode,
-                           ALL_ALLOWED_FUNCTIONCODES)  # Note: The calling facade functions should validate this
-        _checkRegisteraddress(registeraddress)
-        _checkInt(numberOfDecimals, minvalue=0, description='number of decimals')
-        _checkInt(numberOfRegisters, minvalue=1, maxvalue=MAX_NUMBER_OF_REGISTERS, description='number of registers')
-        _checkBool(signed, description='signed')
+        payloadToSlave, payloadformat = _buildCommandPayload(functioncode, registeraddress, value, numberOfDecimals,
+                                                             numberOfRegisters, signed, payloadformat, numberOfBits)
 
-        if payloadformat is not None:
-            if payloadformat not in ALL_PAYLOADFORMATS:
-                raise ValueError('Wrong payload format variable. Given: {0!r}'.format(payloadformat))
+        # Communicate
+        payloadFromSlave = self._performCommand(functioncode, payloadToSlave)
 
-        ## Check combinations of input parameters ##
-        numberOfRegisterBytes = numberOfRegisters * _NUMBER_OF_BYTES_PER_REGISTER
+        return _parseCommandResponse(functioncode, registeraddress, value, numberOfDecimals,
+                                     numberOfRegisters, signed, payloadformat, payloadFromSlave, numberOfBits)
 
-        # Payload format
-        if functioncode in [3, 4, 6, 16] and payloadformat is None:
-            payloadformat = PAYLOADFORMAT_REGISTER
+    ########################################
+    # Communication implementation details #
+    ########################################
 
-        if functioncode in [3, 4, 6, 16]:
-            if payloadformat not in ALL_PAYLOADFORMATS:
-                raise ValueError('The payload format is unknown. Given format: {0!r}, functioncode: {1!r}.'. \
-                                 format(payloadformat, functioncode))
-        else:
-            if payloadformat is not None:
-                raise ValueError('The payload format given is not allowed for this function code. ' + \
-                                 'Given format: {0!r}, functioncode: {1!r}.'.format(payloadformat, functioncode))
-
-                # Signed and numberOfDecimals
-        if signed:
-            if payloadformat not in [PAYLOADFORMAT_REGISTER, PAYLOADFORMAT_LONG]:
-                raise ValueError('The "signed" parameter can not be used for this data format. ' + \
-                                 'Given format: {0!r}.'.format(payloadformat))
-
-        if numberOfDecimals > 0 and payloadformat != PAYLOADFORMAT_REGISTER:
-            raise ValueError('The "numberOfDecimals" parameter can not be used for this data format. ' + \
-                             'Given format: {0!r}.'.format(payloadformat))
+    def _performCommand(self, functioncode, payloadToSlave):
+        """Performs the command having the *functioncode*.
+
+        Args:
+            * functioncode (int): The function code for the command to be performed. Can for example be 'Write register' = 16.
+            * payloadToSlave (str): Data to be transmitted to the slave (will be embedded in slaveaddress, CRC etc)
 
-            # Number of registers
-        if functioncode not in [3, 4, 16] and numberOfRegisters != 1:
-            raise ValueError('The numberOfRegisters is not valid for this function code. ' + \
-                             'NumberOfRegisters: {0!r}, functioncode {1}.'.format(numberOfRegisters, functioncode))
+        Returns:
+            The extracted data payload from the slave (a string). It has been stripped of CRC etc.
 
-        if functioncode == 16 and payloadformat == PAYLOADFORMAT_REGISTER and numberOfRegisters != 1:
-            raise ValueError('Wrong numberOfRegisters when writing to a ' + \
-                             'single register. Given {0!r}.'.format(numberOfRegisters))
-            # Note: For function code 16 there is checking also in the content conversion functions.
+        Raises:
+            ValueError, TypeError.
 
-            # Value
-        if functioncode in [5, 6, 15, 16] and value is None:
-            raise ValueError('The input value is not valid for this function code. ' + \
-                             'Given {0!r} and {1}.'.format(value, functioncode))
+        Makes use of the :meth:`_communicate` method. The request is generated
+        with the :func:`_embedPayload` function, and the parsing of the
+        response is done with the :func:`_extractPayload` function.
 
-        if functioncode == 16 and payloadformat in [PAYLOADFORMAT_REGISTER, PAYLOADFORMAT_FLOAT, PAYLOADFORMAT_LONG]:
-            _checkNumerical(value, description='input value')
+        """
+        _checkFunctioncode(functioncode, None)
+        _checkString(payloadToSlave, description='payload')
 
-        if functioncode == 6 and payloadformat == PAYLOADFORMAT_REGISTER:
-            _checkNumerical(value, description='input value')
+        # Build request
+        transaction_id = self.transport.next_transaction_id() if self.mode == MODE_TCP else 0
+        request = _embedPayload(self.address, self.mode, functioncode, payloadToSlave, transaction_id)
 
-            # Value for string
-        if functioncode == 16 and payloadformat == PAYLOADFORMAT_STRING:
-            _checkString(value, 'input string', minlength=1, maxlength=numberOfRegisterBytes)
-            # Note: The string might be padded later, so the length might be shorter than numberOfRegisterBytes.
+        # Calculate number of bytes to read (None if unknown)
+        number_of_bytes_to_read = None
+        if self.precalculate_read_size:
+            try:
+                number_of_bytes_to_read = _predictResponseSize(self.mode, functioncode, payloadToSlave)
+            except:
+                if self.debug:
+                    template = 'MinimalModbus debug mode. Could not precalculate response size for Modbus {} mode. ' + \
+                               'Will read until end of frame. request: {!r}'
+                    _print_out(template.format(self.mode, request))
 
-            # Value for registers
-        if functioncode == 16 and payloadformat == PAYLOADFORMAT_REGISTERS:
-            if not isinstance(value, list):
-                raise TypeError('The value parameter must be a list. Given {0!r}.'.format(value))
+        # Communicate
+        response = self._communicate(request, number_of_bytes_to_read, _transactionPriority(functioncode))
 
-            if len(value) != numberOfRegisters:
-                raise ValueError('The list length does not match number of registers. ' + \
-                                 'List: {0!r},  Number of registers: {1!r}.'.format(value, numberOfRegisters))
+        # Extract payload
+        payloadFromSlave = _extractPayload(response, self.address, self.mode, functioncode, transaction_id)
+        return payloadFromSlave
 
-        ## Build payload to slave ##
-        if functioncode in [1, 2]:
-            payloadToSlave = _numToTwoByteString(registeraddress) + \
-                             _numToTwoByteString(NUMBER_OF_BITS)
+    def _executePrepared(self, prepared, decoder=None):
+        """Execute a :class:`PreparedRequest`.
 
-        elif functioncode in [3, 4]:
-            payloadToSlave = _numToTwoByteString(registeraddress) + \
-                             _numToTwoByteString(numberOfRegisters)
+        Args:
+            * prepared (:class:`PreparedRequest`): The request.
+            * decoder (callable or None): The decoder of the register data (see :meth:`PreparedRequest.execute`).
 
-        elif functioncode == 5:
-            payloadToSlave = _numToTwoByteString(registeraddress) + \
-                             _createBitpattern(functioncode, value)
+        Returns:
+            The value returned by the prepared command, or by the decoder.
 
-        elif functioncode == 6:
-            payloadToSlave = _numToTwoByteString(registeraddress) + \
-                             _numToTwoByteString(value, numberOfDecimals, signed=signed)
+        Raises:
+            ValueError, TypeError, IOError
 
-        elif functioncode == 15:
-            payloadToSlave = _numToTwoByteString(registeraddress) + \
-                             _numToTwoByteString(NUMBER_OF_BITS) + \
-                             _numToOneByteString(NUMBER_OF_BYTES_FOR_ONE_BIT) + \
-                             _createBitpattern(functioncode, value)
+        If the request has a raw form (see :attr:`PreparedRequest.raw_request`), the frames
+        are handled as bytes from end to end, without being converted to str. The response
+        is then received in the buffer of the transport, and decoded in place.
 
-        elif functioncode == 16:
-            if payloadformat == PAYLOADFORMAT_REGISTER:
-                registerdata = _numToTwoByteString(value, numberOfDecimals, signed=signed)
+        """
+        if prepared.raw_request is not None:
+            transaction_id = self.transport.next_transaction_id() if self.mode == MODE_TCP else 0
+            return self._exchange(prepared.frame(transaction_id), prepared.number_of_bytes_to_read, prepared.priority,
+                                  self.transport.receive_buffer,
+                                  lambda response: prepared.parse_response(response, transaction_id, decoder))
 
-            elif payloadformat == PAYLOADFORMAT_STRING:
-                registerdata = _textstringToBytestring(value, numberOfRegisters)
+        request = prepared.request
+        transaction_id = 0
+        if self.mode == MODE_TCP:
+            transaction_id = self.transport.next_transaction_id()
+            request = _numToTwoByteString(transaction_id) + request[2:]
 
-            elif payloadformat == PAYLOADFORMAT_LONG:
-                registerdata = _longToBytestring(value, signed, numberOfRegisters)
+        response = self._communicate(request, prepared.number_of_bytes_to_read, prepared.priority)
 
-            elif payloadformat == PAYLOADFORMAT_FLOAT:
-                registerdata = _floatToBytestring(value, numberOfRegisters)
+        payloadFromSlave = _extractPayload(response, prepared.slaveaddress, prepared.mode, prepared.functioncode,
+                                           transaction_id)
+        if decoder is not None:
+            return prepared.parse_bytes(bytearray(_stringToFrame(payloadFromSlave)), decoder)
+        return prepared.parse(payloadFromSlave)
 
-            elif payloadformat == PAYLOADFORMAT_REGISTERS:
-                registerdata = _valuelistToBytestring(value, numberOfRegisters)
+    def _communicate(self, request, number_of_bytes_to_read, priority=PRIORITY_POLL):
+        """Talk to the slave via the transport of the instrument (most often a serial port).
 
-            assert len(registerdata) == numberOfRegisterBytes
-            payloadToSlave = _numToTwoByteString(registeraddress) + \
-                             _numToTwoByteString(numberOfRegisters) + \
-                             _numToOneByteString(numberOfRegisterBytes) + \
-                             registerdata
+        Args:
+            request (str): The raw request that is to be sent to the slave.
+            number_of_bytes_to_read (int or None): number of bytes to read, None if unknown
+            priority (int): The priority of the transaction for the :class:`BusArbiter` of the transport.
 
-        # Communicate
-        payloadFromSlave = self._performCommand(functioncode, payloadToSlave)
+        Returns:
+            The raw data (string) returned from the slave.
 
-        # Check the contents in the response payload
-        if functioncode in [1, 2, 3, 4]:
-            _checkResponseByteCount(payloadFromSlave)  # response byte count
+        Raises:
+            TypeError, ValueError, IOError
 
-        if functioncode in [5, 6, 15, 16]:
-            _checkResponseRegisterAddress(payloadFromSlave, registeraddress)  # response register address
+        Note that the answer might have strange ASCII control signs, which
+        makes it difficult to print it in the promt (messes up a bit).
+        Use repr() to make the string printable (shows ASCII values for control signs.)
 
-        if functioncode == 5:
-            _checkResponseWriteData(payloadFromSlave, _createBitpattern(functioncode, value))  # response write data
+        Will block until reaching *number_of_bytes_to_read* or timeout. In RTU mode, the
+        response is read incrementally, so that it returns as soon as an exception or
+        short response is complete (see :func:`_readRtuFrame`). If the number of bytes
+        is unknown, the end of an RTU response is detected by the inter-character silence.
 
-        if functioncode == 6:
-            _checkResponseWriteData(payloadFromSlave, \
-                                    _numToTwoByteString(value, numberOfDecimals, signed=signed))  # response write data
+        The I/O and the timing information are delegated to the :class:`Transport` of the instrument,
+        which is owned for the duration of the transaction through its :class:`BusArbiter`.
 
-        if functioncode == 15:
-            _checkResponseNumberOfRegisters(payloadFromSlave, NUMBER_OF_BITS)  # response number of bits
+        If the attribute :attr:`Instrument.debug` is :const:`True`, the communication details are printed.
 
-        if functioncode == 16:
-            _checkResponseNumberOfRegisters(payloadFromSlave, numberOfRegisters)  # response number of registers
+        If the attribute :attr:`Instrument.close_port_after_each_call` is :const:`True` the
+        serial port is closed after each call.
 
-        # Calculate return value
-        if functioncode in [1, 2]:
-            registerdata = payloadFromSlave[NUMBER_OF_BYTES_BEFORE_REGISTERDATA:]
-            if len(registerdata) != NUMBER_OF_BYTES_FOR_ONE_BIT:
-                raise ValueError('The registerdata length does not match NUMBER_OF_BYTES_FOR_ONE_BIT. ' + \
-                                 'Given {0}.'.format(len(registerdata)))
+        Timing::
 
-            return _bitResponseToValue(registerdata)
+                                                  Request from master (Master is writing)
+                                                  |
+                                                  |       Response from slave (Master is reading)
+                                                  |       |
+            ----W----R----------------------------W-------R----------------------------------------
+                     |                            |       |
+                     |<----- Silent period ------>|       |
+                                                  |       |
+                             Roundtrip time  ---->|-------|<--
+
+        The resolution for Python's time.time() is lower on Windows than on Linux.
+        It is about 16 ms on Windows according to
+        http://stackoverflow.com/questions/157359/accurate-timestamping-in-python
 
-        if functioncode in [3, 4]:
-            registerdata = payloadFromSlave[NUMBER_OF_BYTES_BEFORE_REGISTERDATA:]
-            if len(registerdata) != numberOfRegisterBytes:
-                raise ValueError('The registerdata length does not match number of register bytes. ' + \
-                                 'Given {0!r} and {1!r}.'.format(len(registerdata), numberOfRegisterBytes))
+        For Python3, the information sent to and from pySerial should be of the type bytes.
+        This is taken care of automatically by MinimalModbus, the frames being exchanged
+        by :meth:`_exchange`.
 
-            if payloadformat == PAYLOADFORMAT_STRING:
-                return _bytestringToTextstring(registerdata, numberOfRegisters)
+        """
 
-            elif payloadformat == PAYLOADFORMAT_LONG:
-                return _bytestringToLong(registerdata, signed, numberOfRegisters)
+        _checkString(request, minlength=1, description='request')
+        if number_of_bytes_to_read is not None:
+            _checkInt(number_of_bytes_to_read)
 
-            elif payloadformat == PAYLOADFORMAT_FLOAT:
-                return _bytestringToFloat(registerdata, numberOfRegisters)
+        if sys.version_info[0] > 2:
+            request = bytes(request, encoding='latin1')  # Convert types to make it Python3 compatible
 
-            elif payloadformat == PAYLOADFORMAT_REGISTERS:
-                return _bytestringToValuelist(registerdata, numberOfRegisters)
+        answer = self._exchange(request, number_of_bytes_to_read, priority)
 
-            elif payloadformat == PAYLOADFORMAT_REGISTER:
-                return _twoByteStringToNum(registerdata, numberOfDecimals, signed=signed)
+        if sys.version_info[0] > 2:
+            answer = str(answer, encoding='latin1')  # Convert types to make it Python3 compatible
 
-            raise ValueError('Wrong payloadformat for return value generation. ' + \
-                             'Given {0}'.format(payloadformat))
+        return answer
 
-    ########################################
-    # Communication implementation details #
-    ########################################
+    def _exchange(self, request, number_of_bytes_to_read, priority=PRIORITY_POLL, buffer=None, handler=None):
+        """Exchange raw frames with the slave, as described for :meth:`_communicate`.
+
+        Args:
+            request (bytes): The raw request, in the type of the transport (str for Python2).
+            number_of_bytes_to_read (int or None): number of bytes to read, None if unknown
+            priority (int): The priority of the transaction for the :class:`BusArbiter` of the transport.
+            buffer (bytearray or None): The buffer receiving the response, if any.
+            handler (callable or None): Called with the response before the end of the transaction, if any.
+
+        Returns:
+            The raw data returned from the slave, in the type of the transport (bytes for Python3),
+            or a memoryview on the part of *buffer* holding it. If a *handler* is given, the value
+            it returns.
+
+        Raises:
+            IOError
+
+        The frames are not converted, so that the Python3 callers handling bytes (see
+        :meth:`_executePrepared`) do not pay for a conversion to str and back.
+
+        When a *buffer* is given, the response is read in place when its size is known,
+        without any allocation. This is meant for the :attr:`Transport.receive_buffer`
+        of the transport, whose content is valid until the end of the transaction only:
+        the response must then be processed by the *handler*.
+
+        """
+        if self.debug:
+            _print_out('\nMinimalModbus debug mode. Writing to instrument (expecting {} bytes back): {!r} ({})'. \
+                       format(number_of_bytes_to_read, request, _hexlify(_frameToString(request))))
+
+        # The arbiter of the transport sleeps to make sure 3.5 character times have passed
+        with self.transport.arbiter.transaction(priority) as sleep_time:
+            if self.close_port_after_each_call:
+                self.transport.open()
+
+            if self.debug:
+                template = 'MinimalModbus debug mode. Slept for {:.1f} ms before write. ' + \
+                           'Minimum silent period: {:.2f} ms.'
+                text = template.format(
+                    sleep_time * _SECONDS_TO_MILLISECONDS,
+                    self.transport.silent_period * _SECONDS_TO_MILLISECONDS)
+                _print_out(text)
+
+            # Write request
+            latest_write_time = time.time()
+
+            self.transport.write(request)
+
+            # Read and discard local echo
+            if self.handle_local_echo:
+                localEchoToDiscard = self.transport.read(len(request))
+                if self.debug:
+                    template = 'MinimalModbus debug mode. Discarding this local echo: {!r} ({} bytes).'
+                    text = template.format(localEchoToDiscard, len(localEchoToDiscard))
+                    _print_out(text)
+                if localEchoToDiscard != request:
+                    template = 'Local echo handling is enabled, but the local echo does not match the sent request. ' + \
+                               'Request: {!r} ({} bytes), local echo: {!r} ({} bytes).'
+                    text = template.format(request, len(request), localEchoToDiscard, len(localEchoToDiscard))
+                    raise IOError(text)
+
+            # Read response
+            if number_of_bytes_to_read is None:
+                if self.mode == MODE_RTU:
+                    answer = self.transport.read_until_silence(_DEFAULT_NUMBER_OF_BYTES_TO_READ)
+                else:
+                    answer = self.transport.read(_DEFAULT_NUMBER_OF_BYTES_TO_READ)
+            elif buffer is not None and number_of_bytes_to_read <= len(buffer):
+                if self.mode == MODE_RTU:
+                    count = _readRtuFrameInto(self.transport, buffer, number_of_bytes_to_read)
+                elif self.mode == MODE_TCP:
+                    count = self.transport.readinto(buffer)  # the frame length is given by the MBAP header
+                else:
+                    count = self.transport.readinto(memoryview(buffer)[:number_of_bytes_to_read])
+                answer = memoryview(buffer)[:count]
+            elif self.mode == MODE_RTU:
+                answer = _readRtuFrame(self.transport, number_of_bytes_to_read)
+            else:
+                answer = self.transport.read(number_of_bytes_to_read)
+            self.transport.mark_read()
+            latest_read_time = time.time()
+
+            roundtrip = latest_read_time - latest_write_time
+            self.transport.stats.record(len(request), len(answer), roundtrip, sleep_time)
+            if self.stats is not None:
+                self.stats.record(len(request), len(answer), roundtrip, sleep_time)
+
+            if self.close_port_after_each_call:
+                self.transport.close()
+
+            if self.debug:
+                template = 'MinimalModbus debug mode. Response from instrument: {!r} ({}) ({} bytes), ' + \
+                           'roundtrip time: {:.1f} ms. Timeout setting: {:.1f} ms.\n'
+                text = template.format(
+                    bytes(answer),
+                    _hexlify(_frameToString(answer)),
+                    len(answer),
+                    roundtrip * _SECONDS_TO_MILLISECONDS,
+                    self.transport.timeout * _SECONDS_TO_MILLISECONDS)
+                _print_out(text)
+
+            if len(answer) == 0:
+                raise NoResponseError('No communication with the instrument (no answer)')
+
+            if handler is not None:
+                return handler(answer)
+            return answer
+
+
+class PreparedRequest(object):
+    """A command validated and built once, for being executed repeatedly.
+
+    Prepared requests are created by :meth:`Instrument.prepare`, and executed by calling
+    :meth:`execute` (or the object itself), which returns what the equivalent call of the
+    instrument method would.
+
+    Args: see :meth:`Instrument.prepare`, *instrument* being the instrument to use.
+
+    """
+
+    def __init__(self, instrument, functioncode, registeraddress, value=None,
+                 numberOfDecimals=0, numberOfRegisters=1, signed=False, payloadformat=None, numberOfBits=1):
+        payloadToSlave, payloadformat = _buildCommandPayload(functioncode, registeraddress, value, numberOfDecimals,
+                                                             numberOfRegisters, signed, payloadformat, numberOfBits)
+        self.instrument = instrument
+        self.slaveaddress = instrument.address
+        self.mode = instrument.mode
+        self.functioncode = functioncode
+        self.priority = _transactionPriority(functioncode)
+        self._parse_args = (functioncode, registeraddress, value, numberOfDecimals,
+                            numberOfRegisters, signed, payloadformat)
+        self._numberOfBits = numberOfBits
+
+        self.request = _embedPayload(self.slaveaddress, self.mode, functioncode, payloadToSlave)
+        """The raw request (str). In MODE_TCP, the transaction id is updated on each execution."""
+
+        self.number_of_bytes_to_read = None
+        """The expected response size (int), or None if unknown."""
+        if instrument.precalculate_read_size:
+            try:
+                self.number_of_bytes_to_read = _predictResponseSize(self.mode, functioncode, payloadToSlave)
+            except ValueError:
+                pass
+
+        self.raw_request = None
+        """The raw request (bytes) for Python3 in MODE_RTU and MODE_TCP, or None.
+
+        When available, the request is executed on bytes from end to end (see :meth:`parse_bytes`).
+        """
+        if _BYTES_NATIVE and self.mode != MODE_ASCII:
+            self.raw_request = bytes(self.request, encoding='latin1')
+
+        self._unpacker = _responseStruct(functioncode, numberOfRegisters, signed, payloadformat)
+
+    def __repr__(self):
+        return "{}<address={}, functioncode={}, request={!r}>".format(
+            self.__class__.__name__, self.slaveaddress, self.functioncode, self.request)
+
+    def execute(self, decoder=None):
+        """Send the request and return the converted response.
+
+        Args:
+            decoder (callable or None): For register reads, a callable decoding the register data
+                instead of the conversion given by the payload format. It is called with a
+                memoryview on the received data, which is valid during the call only.
+
+        Returns:
+            The converted response, or the value returned by *decoder*.
+
+        Raises:
+            ValueError, TypeError, IOError
+
+        """
+        if decoder is not None and self.functioncode not in [3, 4, 23]:
+            raise ValueError('Decoders apply to register reads only. Function code: {}'.format(self.functioncode))
+        return self.instrument._executePrepared(self, decoder)
+
+    __call__ = execute
+
+    def frame(self, transaction_id=0):
+        """Return the request frame to be sent.
+
+        Args:
+            transaction_id (int): The transaction id of the request, for MODE_TCP.
+
+        Returns:
+            The request frame (bytes, str for Python2).
+
+        This is intended for the instruments doing the I/O by themselves, which then hand the
+        response to :meth:`parse_response`.
+
+        """
+        if self.raw_request is None:
+            request = _stringToFrame(self.request)
+        else:
+            request = self.raw_request
+        if self.mode == MODE_TCP:
+            request = _MBAP_TRANSACTION_ID.pack(transaction_id) + request[2:]
+        return request
+
+    def parse_response(self, response, transaction_id=0, decoder=None):
+        """Check a response frame and convert its payload.
+
+        Args:
+            * response (bytes, bytearray or memoryview): The response frame to the request
+              returned by :meth:`frame`.
+            * transaction_id (int): The transaction id of the request, for MODE_TCP.
+            * decoder (callable or None): The decoder of the register data (see :meth:`execute`).
+
+        Returns:
+            The converted response, or the value returned by *decoder*.
+
+        Raises:
+            ValueError, TypeError, IOError
+
+        """
+        if self.raw_request is not None:
+            payloadFromSlave = _extractPayloadBytes(response, self.slaveaddress, self.mode, self.functioncode,
+                                                    transaction_id)
+            return self.parse_bytes(payloadFromSlave, decoder)
+
+        payloadFromSlave = _extractPayload(_frameToString(response), self.slaveaddress, self.mode,
+                                           self.functioncode, transaction_id)
+        if decoder is not None:
+            return self.parse_bytes(bytearray(_stringToFrame(payloadFromSlave)), decoder)
+        return self.parse(payloadFromSlave)
+
+    def parse(self, payloadFromSlave):
+        """Check the response payload and convert it (see :func:`_parseCommandResponse`)."""
+        return _parseCommandResponse(*(self._parse_args + (payloadFromSlave, self._numberOfBits)))
+
+    def parse_bytes(self, payloadFromSlave, decoder=None):
+        """Check the raw response payload and convert it.
+
+        Args:
+            * payloadFromSlave (bytes, bytearray or memoryview): The response payload, as returned
+              by :func:`_extractPayloadBytes`.
+            * decoder (callable or None): The decoder of the register data (see :meth:`execute`).
+
+        The numerical and raw register reads are decoded straight from the raw payload. The other
+        commands are converted to str and handled by :meth:`parse`.
+
+        """
+        if decoder is None and self._unpacker is None:
+            return self.parse(_frameToString(payloadFromSlave))
+
+        registerdata = _registerData(payloadFromSlave, self._parse_args[4])
+        if decoder is not None:
+            return decoder(registerdata)
+
+        values = self._unpacker.unpack(registerdata)
+
+        payloadformat = self._parse_args[6]
+        if payloadformat == _PAYLOADFORMAT_REGISTERS:
+            return list(values)
+
+        value = values[0]
+        numberOfDecimals = self._parse_args[3]
+        if payloadformat == _PAYLOADFORMAT_REGISTER and numberOfDecimals:
+            return value / float(10 ** numberOfDecimals)
+        return value
+
+
+####################
+# Generic commands #
+####################
+
+_NUMBER_OF_BITS = 1
+_NUMBER_OF_BYTES_FOR_ONE_BIT = 1
+_MAX_NUMBER_OF_BITS_TO_READ = 2000  # Function codes 1 and 2 limit
+_MAX_NUMBER_OF_BITS_TO_WRITE = 1968  # Function code 15 limit
+_NUMBER_OF_BYTES_BEFORE_REGISTERDATA = 1
+_ALL_ALLOWED_FUNCTIONCODES = list(range(1, 7)) + [15, 16, 22, 23]  # To comply with both Python2 and Python3
+_WRITE_FUNCTIONCODES = [5, 6, 15, 16, 22, 23]
+_MAX_NUMBER_OF_REGISTERS = 255
+_MAX_NUMBER_OF_READ_WRITE_READ_REGISTERS = 125  # Function code 23 limits
+_MAX_NUMBER_OF_READ_WRITE_WRITE_REGISTERS = 121
+
+# Payload format constants, so datatypes can be told apart.
+# Note that bit datatype not is included, because it uses other functioncodes.
+_PAYLOADFORMAT_LONG = 'long'
+_PAYLOADFORMAT_FLOAT = 'float'
+_PAYLOADFORMAT_STRING = 'string'
+_PAYLOADFORMAT_REGISTER = 'register'
+_PAYLOADFORMAT_REGISTERS = 'registers'
+_PAYLOADFORMAT_BITS = 'bits'
+_PAYLOADFORMAT_RAW = 'raw'
+
+_ALL_PAYLOADFORMATS = [_PAYLOADFORMAT_LONG, _PAYLOADFORMAT_FLOAT, \
+                       _PAYLOADFORMAT_STRING, _PAYLOADFORMAT_REGISTER, _PAYLOADFORMAT_REGISTERS, \
+                       _PAYLOADFORMAT_BITS, _PAYLOADFORMAT_RAW]
+
+
+def _buildCommandPayload(functioncode, registeraddress, value=None,
+                         numberOfDecimals=0, numberOfRegisters=1, signed=False, payloadformat=None, numberOfBits=1):
+    """Validate the parameters of a generic command and build the payload to send to the slave.
+
+    Args: see :meth:`Instrument._genericCommand`.
+
+    Returns:
+        A tuple (payloadToSlave, payloadformat), the payload format being resolved
+        to its default value when not given.
+
+    Raises:
+        ValueError, TypeError
+
+    """
+    ## Check input values ##
+    _checkFunctioncode(functioncode,
+                       _ALL_ALLOWED_FUNCTIONCODES)  # Note: The calling facade functions should validate this
+    _checkRegisteraddress(registeraddress)
+    _checkInt(numberOfDecimals, minvalue=0, description='number of decimals')
+    _checkInt(numberOfRegisters, minvalue=1, maxvalue=_MAX_NUMBER_OF_REGISTERS, description='number of registers')
+    _checkInt(numberOfBits, minvalue=1, maxvalue=_MAX_NUMBER_OF_BITS_TO_READ, description='number of bits')
+    _checkBool(signed, description='signed')
+
+    if payloadformat is not None:
+        if payloadformat not in _ALL_PAYLOADFORMATS:
+            raise ValueError('Wrong payload format variable. Given: {0!r}'.format(payloadformat))
+
+    ## Check combinations of input parameters ##
+    numberOfRegisterBytes = numberOfRegisters * _NUMBER_OF_BYTES_PER_REGISTER
+
+    # Payload format
+    if functioncode in [3, 4, 6, 16] and payloadformat is None:
+        payloadformat = _PAYLOADFORMAT_REGISTER
+
+    if functioncode == 23:
+        if payloadformat is None:
+            payloadformat = _PAYLOADFORMAT_REGISTERS
+        if payloadformat not in [_PAYLOADFORMAT_REGISTERS, _PAYLOADFORMAT_RAW]:
+            raise ValueError('The payload format given is not allowed for this function code. ' + \
+                             'Given format: {0!r}, functioncode: {1!r}.'.format(payloadformat, functioncode))
+
+    elif functioncode in [3, 4, 6, 16]:
+        if payloadformat not in _ALL_PAYLOADFORMATS or payloadformat == _PAYLOADFORMAT_BITS:
+            raise ValueError('The payload format is unknown. Given format: {0!r}, functioncode: {1!r}.'. \
+                             format(payloadformat, functioncode))
+
+    elif functioncode in [1, 2, 15] and payloadformat is not None:
+        allowed = [_PAYLOADFORMAT_BITS, _PAYLOADFORMAT_RAW] if functioncode != 15 else [_PAYLOADFORMAT_BITS]
+        if payloadformat not in allowed:
+            raise ValueError('The payload format given is not allowed for this function code. ' + \
+                             'Given format: {0!r}, functioncode: {1!r}.'.format(payloadformat, functioncode))
+    else:
+        if payloadformat is not None:
+            raise ValueError('The payload format given is not allowed for this function code. ' + \
+                             'Given format: {0!r}, functioncode: {1!r}.'.format(payloadformat, functioncode))
+
+            # Signed and numberOfDecimals
+    if signed:
+        if payloadformat not in [_PAYLOADFORMAT_REGISTER, _PAYLOADFORMAT_LONG]:
+            raise ValueError('The "signed" parameter can not be used for this data format. ' + \
+                             'Given format: {0!r}.'.format(payloadformat))
+
+    if payloadformat == _PAYLOADFORMAT_RAW and functioncode not in [1, 2, 3, 4, 23]:
+        raise ValueError('The raw payload format is only allowed for reading registers or bits. ' + \
+                         'Given functioncode: {0!r}.'.format(functioncode))
+
+    if numberOfDecimals > 0 and payloadformat != _PAYLOADFORMAT_REGISTER:
+        raise ValueError('The "numberOfDecimals" parameter can not be used for this data format. ' + \
+                         'Given format: {0!r}.'.format(payloadformat))
+
+        # Number of registers
+    if functioncode not in [3, 4, 16, 23] and numberOfRegisters != 1:
+        raise ValueError('The numberOfRegisters is not valid for this function code. ' + \
+                         'NumberOfRegisters: {0!r}, functioncode {1}.'.format(numberOfRegisters, functioncode))
+
+    if functioncode == 16 and payloadformat == _PAYLOADFORMAT_REGISTER and numberOfRegisters != 1:
+        raise ValueError('Wrong numberOfRegisters when writing to a ' + \
+                         'single register. Given {0!r}.'.format(numberOfRegisters))
+        # Note: For function code 16 there is checking also in the content conversion functions.
 
-    def _performCommand(self, functioncode, payloadToSlave):
-        """Performs the command having the *functioncode*.
+        # Number of bits
+    if numberOfBits != 1 and (functioncode not in [1, 2, 15] or payloadformat is None):
+        raise ValueError('The numberOfBits is not valid for this function code and payload format. ' + \
+                         'NumberOfBits: {0!r}, functioncode {1}, payload format {2!r}.'.format(
+                             numberOfBits, functioncode, payloadformat))
 
-        Args:
-            * functioncode (int): The function code for the command to be performed. Can for example be 'Write register' = 16.
-            * payloadToSlave (str): Data to be transmitted to the slave (will be embedded in slaveaddress, CRC etc)
+    if functioncode == 15 and numberOfBits > _MAX_NUMBER_OF_BITS_TO_WRITE:
+        raise ValueError('Too many bits to write. NumberOfBits: {0!r}.'.format(numberOfBits))
 
-        Returns:
-            The extracted data payload from the slave (a string). It has been stripped of CRC etc.
+    if functioncode == 23 and numberOfRegisters > _MAX_NUMBER_OF_READ_WRITE_READ_REGISTERS:
+        raise ValueError('Too many registers to read for function code 23. ' + \
+                         'NumberOfRegisters: {0!r}.'.format(numberOfRegisters))
 
-        Raises:
-            ValueError, TypeError.
+        # Value
+    if functioncode in [5, 6, 15, 16, 22, 23] and value is None:
+        raise ValueError('The input value is not valid for this function code. ' + \
+                         'Given {0!r} and {1}.'.format(value, functioncode))
 
-        Makes use of the :meth:`_communicate` method. The request is generated
-        with the :func:`_embedPayload` function, and the parsing of the
-        response is done with the :func:`_extractPayload` function.
+    if functioncode == 16 and payloadformat in [_PAYLOADFORMAT_REGISTER, _PAYLOADFORMAT_FLOAT, _PAYLOADFORMAT_LONG]:
+        _checkNumerical(value, description='input value')
 
-        """
-        DEFAULT_NUMBER_OF_BYTES_TO_READ = 1000
+    if functioncode == 6 and payloadformat == _PAYLOADFORMAT_REGISTER:
+        _checkNumerical(value, description='input value')
 
-        _checkFunctioncode(functioncode, None)
-        _checkString(payloadToSlave, description='payload')
+        # Value for string
+    if functioncode == 16 and payloadformat == _PAYLOADFORMAT_STRING:
+        _checkString(value, 'input string', minlength=1, maxlength=numberOfRegisterBytes)
+        # Note: The string might be padded later, so the length might be shorter than numberOfRegisterBytes.
+
+        # Value for registers
+    if functioncode == 16 and payloadformat == _PAYLOADFORMAT_REGISTERS:
+        if not isinstance(value, list):
+            raise TypeError('The value parameter must be a list. Given {0!r}.'.format(value))
+
+        if len(value) != numberOfRegisters:
+            raise ValueError('The list length does not match number of registers. ' + \
+                             'List: {0!r},  Number of registers: {1!r}.'.format(value, numberOfRegisters))
+
+        # Value for bits
+    if functioncode == 15 and payloadformat == _PAYLOADFORMAT_BITS:
+        if not isinstance(value, list):
+            raise TypeError('The value parameter must be a list. Given {0!r}.'.format(value))
+
+        if len(value) != numberOfBits:
+            raise ValueError('The list length does not match number of bits. ' + \
+                             'List: {0!r},  Number of bits: {1!r}.'.format(value, numberOfBits))
+
+        # Value for mask write register
+    if functioncode == 22:
+        if not isinstance(value, tuple) or len(value) != 2:
+            raise TypeError('The value parameter must be a tuple (AND mask, OR mask). ' + \
+                            'Given {0!r}.'.format(value))
+        for mask in value:
+            _checkInt(mask, minvalue=0, maxvalue=0xFFFF, description='mask')
+
+        # Value for read/write registers
+    if functioncode == 23:
+        if not isinstance(value, tuple) or len(value) != 2:
+            raise TypeError('The value parameter must be a tuple (write start address, values). ' + \
+                            'Given {0!r}.'.format(value))
+        _checkRegisteraddress(value[0])
+        if not isinstance(value[1], list):
+            raise TypeError('The values to write must be a list. Given {0!r}.'.format(value[1]))
+        _checkInt(len(value[1]), minvalue=1, maxvalue=_MAX_NUMBER_OF_READ_WRITE_WRITE_REGISTERS,
+                  description='number of registers to write')
+
+    ## Build payload to slave ##
+    if functioncode in [1, 2]:
+        payloadToSlave = _numToTwoByteString(registeraddress) + \
+                         _numToTwoByteString(numberOfBits)
+
+    elif functioncode in [3, 4]:
+        payloadToSlave = _numToTwoByteString(registeraddress) + \
+                         _numToTwoByteString(numberOfRegisters)
+
+    elif functioncode == 5:
+        payloadToSlave = _numToTwoByteString(registeraddress) + \
+                         _createBitpattern(functioncode, value)
+
+    elif functioncode == 6:
+        payloadToSlave = _numToTwoByteString(registeraddress) + \
+                         _numToTwoByteString(value, numberOfDecimals, signed=signed)
 
-        # Build request
-        request = _embedPayload(self.address, self.mode, functioncode, payloadToSlave)
+    elif functioncode == 15:
+        if payloadformat == _PAYLOADFORMAT_BITS:
+            bitdata = _bitlistToBytestring(value)
+        else:
+            bitdata = _createBitpattern(functioncode, value)
 
-        # Calculate number of bytes to read
-        number_of_bytes_to_read = DEFAULT_NUMBER_OF_BYTES_TO_READ
-        if self.precalculate_read_size:
-            try:
-                number_of_bytes_to_read = _predictResponseSize(self.mode, functioncode, payloadToSlave)
-            except:
-                if self.debug:
-                    template = 'MinimalModbus debug mode. Could not precalculate response size for Modbus {} mode. ' + \
-                               'Will read {} bytes. request: {!r}'
-                    _print_out(template.format(self.mode, number_of_bytes_to_read, request))
+        payloadToSlave = _numToTwoByteString(registeraddress) + \
+                         _numToTwoByteString(numberOfBits) + \
+                         _numToOneByteString(len(bitdata)) + \
+                         bitdata
 
-        # Communicate
-        response = self._communicate(request, number_of_bytes_to_read)
+    elif functioncode == 16:
+        if payloadformat == _PAYLOADFORMAT_REGISTER:
+            registerdata = _numToTwoByteString(value, numberOfDecimals, signed=signed)
 
-        # Extract payload
-        payloadFromSlave = _extractPayload(response, self.address, self.mode, functioncode)
-        return payloadFromSlave
+        elif payloadformat == _PAYLOADFORMAT_STRING:
+            registerdata = _textstringToBytestring(value, numberOfRegisters)
 
-    def _communicate(self, request, number_of_bytes_to_read):
-        """Talk to the slave via a serial port.
+        elif payloadformat == _PAYLOADFORMAT_LONG:
+            registerdata = _longToBytestring(value, signed, numberOfRegisters)
 
-        Args:
-            request (str): The raw request that is to be sent to the slave.
-            number_of_bytes_to_read (int): number of bytes to read
+        elif payloadformat == _PAYLOADFORMAT_FLOAT:
+            registerdata = _floatToBytestring(value, numberOfRegisters)
 
-        Returns:
-            The raw data (string) returned from the slave.
+        elif payloadformat == _PAYLOADFORMAT_REGISTERS:
+            registerdata = _valuelistToBytestring(value, numberOfRegisters)
 
-        Raises:
-            TypeError, ValueError, IOError
+        assert len(registerdata) == numberOfRegisterBytes
+        payloadToSlave = _numToTwoByteString(registeraddress) + \
+                         _numToTwoByteString(numberOfRegisters) + \
+                         _numToOneByteString(numberOfRegisterBytes) + \
+                         registerdata
 
-        Note that the answer might have strange ASCII control signs, which
-        makes it difficult to print it in the promt (messes up a bit).
-        Use repr() to make the string printable (shows ASCII values for control signs.)
+    elif functioncode == 22:
+        payloadToSlave = _numToTwoByteString(registeraddress) + \
+                         _numToTwoByteString(value[0]) + \
+                         _numToTwoByteString(value[1])
 
-        Will block until reaching *number_of_bytes_to_read* or timeout.
+    elif functioncode == 23:
+        writeaddress, values = value
+        payloadToSlave = _numToTwoByteString(registeraddress) + \
+                         _numToTwoByteString(numberOfRegisters) + \
+                         _numToTwoByteString(writeaddress) + \
+                         _numToTwoByteString(len(values)) + \
+                         _numToOneByteString(len(values) * _NUMBER_OF_BYTES_PER_REGISTER) + \
+                         _valuelistToBytestring(values, len(values))
 
-        If the attribute :attr:`Instrument.debug` is :const:`True`, the communication details are printed.
+    return payloadToSlave, payloadformat
 
-        If the attribute :attr:`Instrument.close_port_after_each_call` is :const:`True` the
-        serial port is closed after each call.
 
-        Timing::
+def _parseCommandResponse(functioncode, registeraddress, value, numberOfDecimals,
+                          numberOfRegisters, signed, payloadformat, payloadFromSlave, numberOfBits=1):
+    """Check the payload of the slave response to a generic command and convert it to the return value.
 
-                                                  Request from master (Master is writing)
-                                                  |
-                                                  |       Response from slave (Master is reading)
-                                                  |       |
-            ----W----R----------------------------W-------R----------------------------------------
-                     |                            |       |
-                     |<----- Silent period ------>|       |
-                                                  |       |
-                             Roundtrip time  ---->|-------|<--
+    Args: see :meth:`Instrument._genericCommand`, *payloadformat* being the one
+    returned by :func:`_buildCommandPayload` and *payloadFromSlave* the response
+    payload stripped of its header and checksum.
 
-        The resolution for Python's time.time() is lower on Windows than on Linux.
-        It is about 16 ms on Windows according to
-        http://stackoverflow.com/questions/157359/accurate-timestamping-in-python
+    Returns:
+        The register data in numerical value (int or float), or the bit value(s) 0 or 1 (int), or ``None``.
 
-        For Python3, the information sent to and from pySerial should be of the type bytes.
-        This is taken care of automatically by MinimalModbus.
-        
-        
+    Raises:
+        ValueError, TypeError
 
-        """
+    """
+    numberOfRegisterBytes = numberOfRegisters * _NUMBER_OF_BYTES_PER_REGISTER
 
-        _checkString(request, minlength=1, description='request')
-        _checkInt(number_of_bytes_to_read)
+    # Check the contents in the response payload
+    if functioncode in [1, 2, 3, 4, 23]:
+        _checkResponseByteCount(payloadFromSlave)  # response byte count
 
-        if self.debug:
-            _print_out('\nMinimalModbus debug mode. Writing to instrument (expecting {} bytes back): {!r} ({})'. \
-                       format(number_of_bytes_to_read, request, _hexlify(request)))
+    if functioncode in [5, 6, 15, 16, 22]:
+        _checkResponseRegisterAddress(payloadFromSlave, registeraddress)  # response register address
 
-        if self.close_port_after_each_call:
-            self.serial.open()
+    if functioncode == 5:
+        _checkResponseWriteData(payloadFromSlave, _createBitpattern(functioncode, value))  # response write data
 
-        # self.serial.flushInput() TODO
+    if functioncode == 6:
+        _checkResponseWriteData(payloadFromSlave, \
+                                _numToTwoByteString(value, numberOfDecimals, signed=signed))  # response write data
 
-        if sys.version_info[0] > 2:
-            request = bytes(request, encoding='latin1')  # Convert types to make it Python3 compatible
+    if functioncode == 15:
+        _checkResponseNumberOfRegisters(payloadFromSlave, numberOfBits)  # response number of bits
 
-        # Sleep to make sure 3.5 character times have passed
-        minimum_silent_period = _calculate_minimum_silent_period(self.serial.baudrate)
-        time_since_read = time.time() - _LATEST_READ_TIMES.get(self.serial.port, 0)
+    if functioncode == 16:
+        _checkResponseNumberOfRegisters(payloadFromSlave, numberOfRegisters)  # response number of registers
 
-        if time_since_read < minimum_silent_period:
-            sleep_time = minimum_silent_period - time_since_read
+    if functioncode == 22:
+        _checkResponseWriteData(payloadFromSlave[:4], _numToTwoByteString(value[0]))  # response AND mask
+        _checkResponseWriteData(payloadFromSlave[2:], _numToTwoByteString(value[1]))  # response OR mask
 
-            if self.debug:
-                template = 'MinimalModbus debug mode. Sleeping for {:.1f} ms. ' + \
-                           'Minimum silent period: {:.1f} ms, time since read: {:.1f} ms.'
-                text = template.format(
-                    sleep_time * _SECONDS_TO_MILLISECONDS,
-                    minimum_silent_period * _SECONDS_TO_MILLISECONDS,
-                    time_since_read * _SECONDS_TO_MILLISECONDS)
-                _print_out(text)
+    # Calculate return value
+    if functioncode in [1, 2]:
+        registerdata = payloadFromSlave[_NUMBER_OF_BYTES_BEFORE_REGISTERDATA:]
+        if payloadformat is None:
+            if len(registerdata) != _NUMBER_OF_BYTES_FOR_ONE_BIT:
+                raise InvalidResponseError('The registerdata length does not match _NUMBER_OF_BYTES_FOR_ONE_BIT. ' + \
+                                           'Given {0}.'.format(len(registerdata)))
 
-            time.sleep(sleep_time)
+            return _bitResponseToValue(registerdata)
 
-        elif self.debug:
-            template = 'MinimalModbus debug mode. No sleep required before write. ' + \
-                       'Time since previous read: {:.1f} ms, minimum silent period: {:.2f} ms.'
-            text = template.format(
-                time_since_read * _SECONDS_TO_MILLISECONDS,
-                minimum_silent_period * _SECONDS_TO_MILLISECONDS)
-            _print_out(text)
+        numberOfBitBytes = (numberOfBits + 7) // 8
+        if len(registerdata) != numberOfBitBytes:
+            raise InvalidResponseError('The registerdata length does not match number of bits. ' + \
+                                       'Given {0!r} bytes for {1!r} bits.'.format(len(registerdata), numberOfBits))
 
-        # Write request
-        latest_write_time = time.time()
+        if payloadformat == _PAYLOADFORMAT_RAW:
+            return _stringToFrame(registerdata)
 
-        self.serial.write(request)
+        return _bytestringToBitlist(registerdata, numberOfBits)
 
-        # Read and discard local echo
-        if self.handle_local_echo:
-            localEchoToDiscard = self.serial.read(len(request))
-            if self.debug:
-                template = 'MinimalModbus debug mode. Discarding this local echo: {!r} ({} bytes).'
-                text = template.format(localEchoToDiscard, len(localEchoToDiscard))
-                _print_out(text)
-            if localEchoToDiscard != request:
-                template = 'Local echo handling is enabled, but the local echo does not match the sent request. ' + \
-                           'Request: {!r} ({} bytes), local echo: {!r} ({} bytes).'
-                text = template.format(request, len(request), localEchoToDiscard, len(localEchoToDiscard))
-                raise IOError(text)
-
-        # Read response
-        answer = self.serial.read(number_of_bytes_to_read)
-        _LATEST_READ_TIMES[self.serial.port] = time.time()
+    if functioncode in [3, 4, 23]:
+        registerdata = payloadFromSlave[_NUMBER_OF_BYTES_BEFORE_REGISTERDATA:]
+        if len(registerdata) != numberOfRegisterBytes:
+            raise InvalidResponseError('The registerdata length does not match number of register bytes. ' + \
+                                       'Given {0!r} and {1!r}.'.format(len(registerdata), numberOfRegisterBytes))
 
-        if self.close_port_after_each_call:
-            self.serial.close()
+        if payloadformat == _PAYLOADFORMAT_RAW:
+            return _stringToFrame(registerdata)
 
-        if sys.version_info[0] > 2:
-            answer = str(answer, encoding='latin1')  # Convert types to make it Python3 compatible
+        elif payloadformat == _PAYLOADFORMAT_STRING:
+            return _bytestringToTextstring(registerdata, numberOfRegisters)
 
-        if self.debug:
-            template = 'MinimalModbus debug mode. Response from instrument: {!r} ({}) ({} bytes), ' + \
-                       'roundtrip time: {:.1f} ms. Timeout setting: {:.1f} ms.\n'
-            text = template.format(
-                answer,
-                _hexlify(answer),
-                len(answer),
-                (_LATEST_READ_TIMES.get(self.serial.port, 0) - latest_write_time) * _SECONDS_TO_MILLISECONDS,
-                self.serial.timeout * _SECONDS_TO_MILLISECONDS)
-            _print_out(text)
+        elif payloadformat == _PAYLOADFORMAT_LONG:
+            return _bytestringToLong(registerdata, signed, numberOfRegisters)
 
-        if len(answer) == 0:
-            raise IOError('No communication with the instrument (no answer)')
+        elif payloadformat == _PAYLOADFORMAT_FLOAT:
+            return _bytestringToFloat(registerdata, numberOfRegisters)
 
-        return answer
+        elif payloadformat == _PAYLOADFORMAT_REGISTERS:
+            return _bytestringToValuelist(registerdata, numberOfRegisters)
+
+        elif payloadformat == _PAYLOADFORMAT_REGISTER:
+            return _twoByteStringToNum(registerdata, numberOfDecimals, signed=signed)
+
+        raise ValueError('Wrong payloadformat for return value generation. ' + \
+                         'Given {0}'.format(payloadformat))
 
 
 ####################
 # Payload handling #
 ####################
 
-def _embedPayload(slaveaddress, mode, functioncode, payloaddata):
+def _embedPayload(slaveaddress, mode, functioncode, payloaddata, transaction_id=0):
     """Build a request from the slaveaddress, the function code and the payload data.
 
     Args:
         * slaveaddress (int): The address of the slave.
-        * mode (str): The modbus protcol mode (MODE_RTU or MODE_ASCII)
+        * mode (str): The modbus protcol mode (MODE_RTU, MODE_ASCII or MODE_TCP)
         * functioncode (int): The function code for the command to be performed. Can for example be 16 (Write register).
         * payloaddata (str): The byte string to be sent to the slave.
+        * transaction_id (int): The MBAP transaction identifier (MODE_TCP only).
 
     Returns:
         The built (raw) request string for sending to the slave (including CRC etc).
@@ -966,12 +2515,22 @@ def _embedPayload(slaveaddress, mode, functioncode, payloaddata):
     The resulting request has the format:
      * RTU Mode: slaveaddress byte + functioncode byte + payloaddata + CRC (which is two bytes).
      * ASCII Mode: header (:) + slaveaddress (2 characters) + functioncode (2 characters) + payloaddata + LRC (which is two characters) + footer (CRLF)
+     * TCP Mode: MBAP header (transaction id + protocol id + length) + slaveaddress byte + functioncode byte + payloaddata
 
     The LRC or CRC is calculated from the byte string made up of slaveaddress + functioncode + payloaddata.
     The header, LRC/CRC, and footer are excluded from the calculation.
 
     """
     _checkSlaveaddress(slaveaddress)
+    return _buildRequest(slaveaddress, mode, functioncode, payloaddata, transaction_id)
+
+
+def _buildRequest(slaveaddress, mode, functioncode, payloaddata, transaction_id=0):
+    """Build a request as :func:`_embedPayload` does, without checking the slave address.
+
+    This allows requests to the :data:`BROADCAST_ADDRESS` to be built by :func:`broadcast`.
+
+    """
     _checkMode(mode)
     _checkFunctioncode(functioncode, None)
     _checkString(payloaddata, description='payload')
@@ -983,30 +2542,39 @@ def _embedPayload(slaveaddress, mode, functioncode, payloaddata):
                   _hexencode(firstPart) + \
                   _hexencode(_calculateLrcString(firstPart)) + \
                   _ASCII_FOOTER
+    elif mode == MODE_TCP:
+        request = _numToTwoByteString(transaction_id) + \
+                  _numToTwoByteString(_MBAP_PROTOCOL_ID) + \
+                  _numToTwoByteString(len(firstPart)) + \
+                  firstPart
     else:
         request = firstPart + _calculateCrcString(firstPart)
 
     return request
 
 
-def _extractPayload(response, slaveaddress, mode, functioncode):
+def _extractPayload(response, slaveaddress, mode, functioncode, transaction_id=None):
     """Extract the payload data part from the slave's response.
 
     Args:
         * response (str): The raw response byte string from the slave.
         * slaveaddress (int): The adress of the slave. Used here for error checking only.
-        * mode (str): The modbus protcol mode (MODE_RTU or MODE_ASCII)
+        * mode (str): The modbus protcol mode (MODE_RTU, MODE_ASCII or MODE_TCP)
         * functioncode (int): Used here for error checking only.
+        * transaction_id (int or None): The expected MBAP transaction identifier (MODE_TCP only). Not checked if None.
 
     Returns:
         The payload part of the *response* string.
 
     Raises:
-        ValueError, TypeError. Raises an exception if there is any problem with the received address, the functioncode or the CRC.
+        ValueError, TypeError. Raises an exception if there is any problem with the received address, the functioncode or the CRC:
+        :class:`InvalidResponseError`, :class:`ChecksumError`, or :class:`SlaveReportedException`
+        for an exception response.
 
     The received response should have the format:
     * RTU Mode: slaveaddress byte + functioncode byte + payloaddata + CRC (which is two bytes)
     * ASCII Mode: header (:) + slaveaddress byte + functioncode byte + payloaddata + LRC (which is two characters) + footer (CRLF)
+    * TCP Mode: MBAP header (transaction id + protocol id + length) + slaveaddress byte + functioncode byte + payloaddata
 
     For development purposes, this function can also be used to extract the payload from the request sent TO the slave.
 
@@ -1023,6 +2591,12 @@ def _extractPayload(response, slaveaddress, mode, functioncode):
 
     MINIMAL_RESPONSE_LENGTH_RTU = NUMBER_OF_RESPONSE_STARTBYTES + NUMBER_OF_CRC_BYTES
     MINIMAL_RESPONSE_LENGTH_ASCII = 9
+    MINIMAL_RESPONSE_LENGTH_TCP = MBAP_HEADER_SIZE + 2
+
+    BYTERANGE_FOR_MBAP_TRANSACTION_ID = slice(0, 2)
+    BYTERANGE_FOR_MBAP_PROTOCOL_ID = slice(2, 4)
+    BYTERANGE_FOR_MBAP_LENGTH = slice(4, 6)
+    NUMBER_OF_BYTES_BEFORE_MBAP_LENGTH_COUNT = 6
 
     # Argument validity testing
     _checkString(response, description='response')
@@ -1035,23 +2609,47 @@ def _extractPayload(response, slaveaddress, mode, functioncode):
     # Validate response length
     if mode == MODE_ASCII:
         if len(response) < MINIMAL_RESPONSE_LENGTH_ASCII:
-            raise ValueError('Too short Modbus ASCII response (minimum length {} bytes). Response: {!r}'.format( \
+            raise InvalidResponseError('Too short Modbus ASCII response (minimum length {} bytes). Response: {!r}'.format( \
                 MINIMAL_RESPONSE_LENGTH_ASCII,
                 response))
+    elif mode == MODE_TCP:
+        if len(response) < MINIMAL_RESPONSE_LENGTH_TCP:
+            raise InvalidResponseError('Too short Modbus TCP response (minimum length {} bytes). Response: {!r}'.format( \
+                MINIMAL_RESPONSE_LENGTH_TCP,
+                response))
     elif len(response) < MINIMAL_RESPONSE_LENGTH_RTU:
-        raise ValueError('Too short Modbus RTU response (minimum length {} bytes). Response: {!r}'.format( \
+        raise InvalidResponseError('Too short Modbus RTU response (minimum length {} bytes). Response: {!r}'.format( \
             MINIMAL_RESPONSE_LENGTH_RTU,
             response))
 
+    # Validate and strip the MBAP header, keeping the unit identifier as slave address
+    if mode == MODE_TCP:
+        receivedProtocolId = _twoByteStringToNum(response[BYTERANGE_FOR_MBAP_PROTOCOL_ID])
+        if receivedProtocolId != _MBAP_PROTOCOL_ID:
+            raise InvalidResponseError('Wrong MBAP protocol identifier: {}. The response is: {!r}'.format( \
+                receivedProtocolId, response))
+
+        receivedLength = _twoByteStringToNum(response[BYTERANGE_FOR_MBAP_LENGTH])
+        if receivedLength != len(response) - NUMBER_OF_BYTES_BEFORE_MBAP_LENGTH_COUNT:
+            raise InvalidResponseError('Wrong MBAP length: {} while {} bytes follow. The response is: {!r}'.format( \
+                receivedLength, len(response) - NUMBER_OF_BYTES_BEFORE_MBAP_LENGTH_COUNT, response))
+
+        receivedTransactionId = _twoByteStringToNum(response[BYTERANGE_FOR_MBAP_TRANSACTION_ID])
+        if transaction_id is not None and receivedTransactionId != transaction_id:
+            raise InvalidResponseError('Wrong MBAP transaction identifier: {} instead of {}. The response is: {!r}'.format( \
+                receivedTransactionId, transaction_id, response))
+
+        response = response[NUMBER_OF_BYTES_BEFORE_MBAP_LENGTH_COUNT:]
+
     # Validate the ASCII header and footer.
     if mode == MODE_ASCII:
         if response[BYTEPOSITION_FOR_ASCII_HEADER] != _ASCII_HEADER:
-            raise ValueError(
+            raise InvalidResponseError(
                 'Did not find header ({!r}) as start of ASCII response. The plain response is: {!r}'.format( \
                     _ASCII_HEADER,
                     response))
         elif response[-len(_ASCII_FOOTER):] != _ASCII_FOOTER:
-            raise ValueError('Did not find footer ({!r}) as end of ASCII response. The plain response is: {!r}'.format( \
+            raise InvalidResponseError('Did not find footer ({!r}) as end of ASCII response. The plain response is: {!r}'.format( \
                 _ASCII_FOOTER,
                 response))
 
@@ -1061,61 +2659,230 @@ def _extractPayload(response, slaveaddress, mode, functioncode):
         if len(response) % 2 != 0:
             template = 'Stripped ASCII frames should have an even number of bytes, but is {} bytes. ' + \
                        'The stripped response is: {!r} (plain response: {!r})'
-            raise ValueError(template.format(len(response), response, plainresponse))
+            raise InvalidResponseError(template.format(len(response), response, plainresponse))
 
         # Convert the ASCII (stripped) response string to RTU-like response string
         response = _hexdecode(response)
 
-    # Validate response checksum
+    # Validate response checksum (TCP relies on the transport layer checks)
     if mode == MODE_ASCII:
         calculateChecksum = _calculateLrcString
         numberOfChecksumBytes = NUMBER_OF_LRC_BYTES
+    elif mode == MODE_TCP:
+        calculateChecksum = None
+        numberOfChecksumBytes = 0
     else:
         calculateChecksum = _calculateCrcString
         numberOfChecksumBytes = NUMBER_OF_CRC_BYTES
 
-    receivedChecksum = response[-numberOfChecksumBytes:]
-    responseWithoutChecksum = response[0: len(response) - numberOfChecksumBytes]
-    calculatedChecksum = calculateChecksum(responseWithoutChecksum)
+    if mode == MODE_RTU and _calculateCrc(_stringToFrame(response)) == 0:
+        calculateChecksum = None  # verified by residue
 
-    if receivedChecksum != calculatedChecksum:
-        template = 'Checksum error in {} mode: {!r} instead of {!r} . The response is: {!r} (plain response: {!r})'
-        text = template.format(
-            mode,
-            receivedChecksum,
-            calculatedChecksum,
-            response, plainresponse)
-        raise ValueError(text)
+    if calculateChecksum:
+        receivedChecksum = response[-numberOfChecksumBytes:]
+        responseWithoutChecksum = response[0: len(response) - numberOfChecksumBytes]
+        calculatedChecksum = calculateChecksum(responseWithoutChecksum)
+
+        if receivedChecksum != calculatedChecksum:
+            template = 'Checksum error in {} mode: {!r} instead of {!r} . The response is: {!r} (plain response: {!r})'
+            text = template.format(
+                mode,
+                receivedChecksum,
+                calculatedChecksum,
+                response, plainresponse)
+            raise ChecksumError(text)
 
     # Check slave address
     responseaddress = ord(response[BYTEPOSITION_FOR_SLAVEADDRESS])
 
     if responseaddress != slaveaddress:
-        raise ValueError('Wrong return slave address: {} instead of {}. The response is: {!r}'.format( \
+        raise InvalidResponseError('Wrong return slave address: {} instead of {}. The response is: {!r}'.format( \
             responseaddress, slaveaddress, response))
 
     # Check function code
     receivedFunctioncode = ord(response[BYTEPOSITION_FOR_FUNCTIONCODE])
 
     if receivedFunctioncode == _setBitOn(functioncode, BITNUMBER_FUNCTIONCODE_ERRORINDICATION):
-        raise ValueError('The slave is indicating an error. The response is: {!r}'.format(response))
+        raise SlaveReportedException('The slave is indicating an error. The response is: {!r}'.format(response),
+                                     functioncode, ord(response[NUMBER_OF_RESPONSE_STARTBYTES]))
 
     elif receivedFunctioncode != functioncode:
-        raise ValueError('Wrong functioncode: {} instead of {}. The response is: {!r}'.format( \
+        raise InvalidResponseError('Wrong functioncode: {} instead of {}. The response is: {!r}'.format( \
             receivedFunctioncode, functioncode, response))
 
     # Read data payload
     firstDatabyteNumber = NUMBER_OF_RESPONSE_STARTBYTES
 
-    if mode == MODE_ASCII:
-        lastDatabyteNumber = len(response) - NUMBER_OF_LRC_BYTES
-    else:
-        lastDatabyteNumber = len(response) - NUMBER_OF_CRC_BYTES
+    lastDatabyteNumber = len(response) - numberOfChecksumBytes
 
     payload = response[firstDatabyteNumber:lastDatabyteNumber]
     return payload
 
 
+_MBAP_HEADER = struct.Struct('>HHHBB')  # transaction id, protocol id, length, unit id, function code
+_MBAP_TRANSACTION_ID = struct.Struct('>H')
+_RTU_HEADER = struct.Struct('>BB')  # slave address, function code
+_RTU_CRC = struct.Struct('<H')
+
+
+def _extractPayloadBytes(response, slaveaddress, mode, functioncode, transaction_id=None):
+    """Extract the payload data part from the slave's raw response, for MODE_RTU and MODE_TCP.
+
+    This is the bytes counterpart of :func:`_extractPayload`, with the same checks, used by
+    Python3 for the prepared requests.
+
+    Args:
+        * response (bytes, bytearray or memoryview): The raw response from the slave.
+        * slaveaddress (int): The adress of the slave. Used here for error checking only.
+        * mode (str): The modbus protcol mode (MODE_RTU or MODE_TCP)
+        * functioncode (int): Used here for error checking only.
+        * transaction_id (int or None): The expected MBAP transaction identifier (MODE_TCP only). Not checked if None.
+
+    Returns:
+        The payload part of the *response*, as a memoryview on it (no copy).
+
+    Raises:
+        ValueError. Raises an exception if there is any problem with the received address, the functioncode or the CRC,
+        as for :func:`_extractPayload`.
+
+    """
+    NUMBER_OF_CRC_BYTES = 2
+    NUMBER_OF_BYTES_BEFORE_MBAP_LENGTH_COUNT = 6
+    BITNUMBER_FUNCTIONCODE_ERRORINDICATION = 7
+
+    MINIMAL_RESPONSE_LENGTH_RTU = _RTU_HEADER.size + NUMBER_OF_CRC_BYTES
+    MINIMAL_RESPONSE_LENGTH_TCP = MBAP_HEADER_SIZE + 2
+
+    frame = memoryview(response)
+
+    if mode == MODE_TCP:
+        if len(frame) < MINIMAL_RESPONSE_LENGTH_TCP:
+            raise InvalidResponseError('Too short Modbus TCP response (minimum length {} bytes). Response: {!r}'.format( \
+                MINIMAL_RESPONSE_LENGTH_TCP, bytes(frame)))
+
+        receivedTransactionId, receivedProtocolId, receivedLength, responseaddress, receivedFunctioncode = \
+            _MBAP_HEADER.unpack_from(frame)
+        if receivedProtocolId != _MBAP_PROTOCOL_ID:
+            raise InvalidResponseError('Wrong MBAP protocol identifier: {}. The response is: {!r}'.format( \
+                receivedProtocolId, bytes(frame)))
+
+        if receivedLength != len(frame) - NUMBER_OF_BYTES_BEFORE_MBAP_LENGTH_COUNT:
+            raise InvalidResponseError('Wrong MBAP length: {} while {} bytes follow. The response is: {!r}'.format( \
+                receivedLength, len(frame) - NUMBER_OF_BYTES_BEFORE_MBAP_LENGTH_COUNT, bytes(frame)))
+
+        if transaction_id is not None and receivedTransactionId != transaction_id:
+            raise InvalidResponseError('Wrong MBAP transaction identifier: {} instead of {}. The response is: {!r}'.format( \
+                receivedTransactionId, transaction_id, bytes(frame)))
+
+        firstDatabyteNumber = _MBAP_HEADER.size
+        lastDatabyteNumber = len(frame)
+
+    elif mode == MODE_RTU:
+        if len(frame) < MINIMAL_RESPONSE_LENGTH_RTU:
+            raise InvalidResponseError('Too short Modbus RTU response (minimum length {} bytes). Response: {!r}'.format( \
+                MINIMAL_RESPONSE_LENGTH_RTU, bytes(frame)))
+
+        # Verification by residue, the CRC of the expected header being precomputed. A non null
+        # residue comes from a corrupted frame, or from a valid one with another header (checked below).
+        lastDatabyteNumber = len(frame) - NUMBER_OF_CRC_BYTES
+        if _calculateCrc(frame[_RTU_HEADER.size:], _crcRtuHeader(slaveaddress, functioncode)) != 0 and \
+                _calculateCrc(frame) != 0:
+            receivedChecksum, = _RTU_CRC.unpack_from(frame, lastDatabyteNumber)
+            calculatedChecksum = _calculateCrc(frame[:lastDatabyteNumber])
+            template = 'Checksum error in {} mode: {:04X} instead of {:04X} . The response is: {!r}'
+            raise ChecksumError(template.format(mode, receivedChecksum, calculatedChecksum, bytes(frame)))
+
+        responseaddress, receivedFunctioncode = _RTU_HEADER.unpack_from(frame)
+        firstDatabyteNumber = _RTU_HEADER.size
+
+    else:
+        raise ValueError('Unsupported modbus mode for raw responses: {!r}'.format(mode))
+
+    if responseaddress != slaveaddress:
+        raise InvalidResponseError('Wrong return slave address: {} instead of {}. The response is: {!r}'.format( \
+            responseaddress, slaveaddress, bytes(frame)))
+
+    if receivedFunctioncode == _setBitOn(functioncode, BITNUMBER_FUNCTIONCODE_ERRORINDICATION):
+        raise SlaveReportedException('The slave is indicating an error. The response is: {!r}'.format(bytes(frame)),
+                                     functioncode, bytearray(frame[firstDatabyteNumber:firstDatabyteNumber + 1])[0])
+
+    elif receivedFunctioncode != functioncode:
+        raise InvalidResponseError('Wrong functioncode: {} instead of {}. The response is: {!r}'.format( \
+            receivedFunctioncode, functioncode, bytes(frame)))
+
+    return frame[firstDatabyteNumber:lastDatabyteNumber]
+
+
+def _responseStruct(functioncode, numberOfRegisters, signed, payloadformat):
+    """Give the structure of the register data of a numerical or raw register read.
+
+    Args: see :meth:`Instrument._genericCommand`.
+
+    Returns:
+        The :class:`struct.Struct` decoding the value(s) of the register data, or None if
+        the command is not a numerical or raw register read.
+
+    """
+    if functioncode not in [3, 4, 23]:
+        return None
+
+    if payloadformat == _PAYLOADFORMAT_REGISTERS:
+        formatcode = '{}H'.format(numberOfRegisters)
+    elif payloadformat == _PAYLOADFORMAT_REGISTER:
+        formatcode = 'h' if signed else 'H'
+    elif payloadformat == _PAYLOADFORMAT_LONG:
+        formatcode = 'l' if signed else 'L'
+    elif payloadformat == _PAYLOADFORMAT_FLOAT:
+        formatcode = 'f' if numberOfRegisters == 2 else 'd'
+    elif payloadformat == _PAYLOADFORMAT_RAW:
+        formatcode = '{}s'.format(numberOfRegisters * _NUMBER_OF_BYTES_PER_REGISTER)
+    else:
+        return None
+
+    return struct.Struct('>' + formatcode)
+
+
+def _registerData(payloadFromSlave, numberOfRegisters):
+    """Check the raw payload of a register read response, and give its register data.
+
+    Args:
+        * payloadFromSlave (bytes, bytearray or memoryview): The payload, as returned by :func:`_extractPayloadBytes`.
+        * numberOfRegisters (int): The number of registers read.
+
+    Returns:
+        The register data, as a memoryview on the payload (no copy).
+
+    Raises:
+        ValueError
+
+    """
+    payload = memoryview(payloadFromSlave)
+    countedNumberOfDatabytes = len(payload) - _NUMBER_OF_BYTES_BEFORE_REGISTERDATA
+    if not payload or struct.unpack_from('B', payload)[0] != countedNumberOfDatabytes:
+        _checkResponseByteCount(_frameToString(payload))  # raises the detailed error
+
+    numberOfRegisterBytes = numberOfRegisters * _NUMBER_OF_BYTES_PER_REGISTER
+    if countedNumberOfDatabytes != numberOfRegisterBytes:
+        raise InvalidResponseError('The registerdata length does not match number of register bytes. ' + \
+                                   'Given {0!r} and {1!r}.'.format(countedNumberOfDatabytes, numberOfRegisterBytes))
+
+    return payload[_NUMBER_OF_BYTES_BEFORE_REGISTERDATA:]
+
+
+def _frameToString(frame):
+    """Convert a raw frame (bytes, bytearray or memoryview) to the str used by the payload handling functions."""
+    if sys.version_info[0] > 2:
+        return str(frame, encoding='latin1')
+    return str(bytearray(frame))
+
+
+def _stringToFrame(inputstring):
+    """Convert a str used by the payload handling functions to a raw frame (bytes)."""
+    if sys.version_info[0] > 2:
+        return bytes(inputstring, encoding='latin1')
+    return inputstring
+
+
 ##########################################
 # Serial communication utility functions #
 ##########################################
@@ -1125,7 +2892,7 @@ def _predictResponseSize(mode, functioncode, payloadToSlave):
     """Calculate the number of bytes that should be received from the slave.
 
     Args:
-     * mode (str): The modbus protcol mode (MODE_RTU or MODE_ASCII)
+     * mode (str): The modbus protcol mode (MODE_RTU, MODE_ASCII or MODE_TCP)
      * functioncode (int): Modbus function code.
      * payloadToSlave (str): The raw request that is to be sent to the slave (not hex encoded string)
 
@@ -1140,6 +2907,7 @@ def _predictResponseSize(mode, functioncode, payloadToSlave):
     BYTERANGE_FOR_GIVEN_SIZE = slice(2, 4)  # Within the payload
 
     NUMBER_OF_PAYLOAD_BYTES_IN_WRITE_CONFIRMATION = 4
+    NUMBER_OF_PAYLOAD_BYTES_IN_MASK_WRITE_CONFIRMATION = 6
     NUMBER_OF_PAYLOAD_BYTES_FOR_BYTECOUNTFIELD = 1
 
     RTU_TO_ASCII_PAYLOAD_FACTOR = 2
@@ -1148,6 +2916,7 @@ def _predictResponseSize(mode, functioncode, payloadToSlave):
     NUMBER_OF_RTU_RESPONSE_ENDBYTES = 2
     NUMBER_OF_ASCII_RESPONSE_STARTBYTES = 5
     NUMBER_OF_ASCII_RESPONSE_ENDBYTES = 4
+    NUMBER_OF_TCP_RESPONSE_STARTBYTES = MBAP_HEADER_SIZE + 1
 
     # Argument validity testing
     _checkMode(mode)
@@ -1158,7 +2927,10 @@ def _predictResponseSize(mode, functioncode, payloadToSlave):
     if functioncode in [5, 6, 15, 16]:
         response_payload_size = NUMBER_OF_PAYLOAD_BYTES_IN_WRITE_CONFIRMATION
 
-    elif functioncode in [1, 2, 3, 4]:
+    elif functioncode == 22:
+        response_payload_size = NUMBER_OF_PAYLOAD_BYTES_IN_MASK_WRITE_CONFIRMATION
+
+    elif functioncode in [1, 2, 3, 4, 23]:
         given_size = _twoByteStringToNum(payloadToSlave[BYTERANGE_FOR_GIVEN_SIZE])
         if functioncode == 1 or functioncode == 2:
             # Algorithm from MODBUS APPLICATION PROTOCOL SPECIFICATION V1.1b
@@ -1166,7 +2938,7 @@ def _predictResponseSize(mode, functioncode, payloadToSlave):
             response_payload_size = NUMBER_OF_PAYLOAD_BYTES_FOR_BYTECOUNTFIELD + \
                                     number_of_inputs // 8 + (1 if number_of_inputs % 8 else 0)
 
-        elif functioncode == 3 or functioncode == 4:
+        elif functioncode in [3, 4, 23]:
             number_of_registers = given_size
             response_payload_size = NUMBER_OF_PAYLOAD_BYTES_FOR_BYTECOUNTFIELD + \
                                     number_of_registers * _NUMBER_OF_BYTES_PER_REGISTER
@@ -1180,12 +2952,127 @@ def _predictResponseSize(mode, functioncode, payloadToSlave):
         return NUMBER_OF_ASCII_RESPONSE_STARTBYTES + \
                response_payload_size * RTU_TO_ASCII_PAYLOAD_FACTOR + \
                NUMBER_OF_ASCII_RESPONSE_ENDBYTES
+    elif mode == MODE_TCP:
+        return NUMBER_OF_TCP_RESPONSE_STARTBYTES + \
+               response_payload_size
     else:
         return NUMBER_OF_RTU_RESPONSE_STARTBYTES + \
                response_payload_size + \
                NUMBER_OF_RTU_RESPONSE_ENDBYTES
 
 
+def response_frame_size(frame, number_of_bytes_to_read, mode=MODE_RTU):
+    """Calculate the number of bytes to be received for a response frame, from its first bytes.
+
+    This is intended for the transports reading the responses by themselves.
+
+    Args:
+     * frame (str or bytes): The bytes of the frame received so far.
+     * number_of_bytes_to_read (int or None): The expected size of the response, None if unknown.
+     * mode (str): The Modbus mode of the frame.
+
+    Returns:
+        The size (int) of the frame, or the number of bytes to be received for knowing it in
+        MODE_RTU (see :func:`_rtuFrameSize`). If the size is unknown, the maximum number of
+        bytes to be read, the end of the frame being then detected by other means.
+
+    """
+    if number_of_bytes_to_read is None:
+        return _DEFAULT_NUMBER_OF_BYTES_TO_READ
+    if mode == MODE_RTU:
+        return _rtuFrameSize(frame, number_of_bytes_to_read)
+    return number_of_bytes_to_read
+
+
+def _rtuFrameSize(frame, number_of_bytes_to_read):
+    """Calculate the size of an RTU response frame from its first bytes.
+
+    Args:
+     * frame (str or bytes): The bytes of the frame received so far.
+     * number_of_bytes_to_read (int): The size to be used when the frame does not tell it.
+
+    Returns:
+        The size (int) of the frame if known from the received bytes, else the number of
+        bytes which must be received for knowing it, or *number_of_bytes_to_read* if
+        the frame does not tell its size.
+
+    Exception responses are 5 bytes long, and the responses to the function codes
+    1 to 4 give the number of data bytes in their third byte.
+
+    """
+    NUMBER_OF_RTU_RESPONSE_STARTBYTES = 2
+    NUMBER_OF_RTU_EXCEPTION_RESPONSE_BYTES = 5
+    NUMBER_OF_RTU_BYTECOUNT_RESPONSE_OVERHEAD = 5  # address, function code, byte count and CRC
+    BITNUMBER_FUNCTIONCODE_ERRORINDICATION = 7
+
+    if len(frame) < NUMBER_OF_RTU_RESPONSE_STARTBYTES:
+        return NUMBER_OF_RTU_RESPONSE_STARTBYTES
+
+    header = bytearray(frame[:NUMBER_OF_RTU_RESPONSE_STARTBYTES + 1])
+    if header[1] & (1 << BITNUMBER_FUNCTIONCODE_ERRORINDICATION):
+        return NUMBER_OF_RTU_EXCEPTION_RESPONSE_BYTES
+
+    if header[1] in [1, 2, 3, 4, 23]:
+        if len(header) <= NUMBER_OF_RTU_RESPONSE_STARTBYTES:
+            return NUMBER_OF_RTU_RESPONSE_STARTBYTES + 1
+        return NUMBER_OF_RTU_BYTECOUNT_RESPONSE_OVERHEAD + header[2]
+
+    return number_of_bytes_to_read
+
+
+def _readRtuFrame(transport, number_of_bytes_to_read):
+    """Read an RTU response frame incrementally, reading only the bytes the frame contains.
+
+    Args:
+     * transport (:class:`Transport`): The transport to read from.
+     * number_of_bytes_to_read (int): The expected size of the response.
+
+    Returns:
+        The raw frame (less bytes than expected if the timeout expired).
+
+    The header is read first, so that exception responses and short responses are returned
+    as soon as they are complete, instead of waiting for the timeout.
+
+    """
+    frame = _EMPTY_FRAME
+    size = _rtuFrameSize(frame, number_of_bytes_to_read)
+    while len(frame) < size:
+        wanted = size - len(frame)
+        chunk = transport.read(wanted)
+        frame += chunk
+        if len(chunk) < wanted:
+            # timeout
+            break
+        size = _rtuFrameSize(frame, number_of_bytes_to_read)
+    return frame
+
+
+def _readRtuFrameInto(transport, buffer, number_of_bytes_to_read):
+    """Read an RTU response frame incrementally into a buffer, as :func:`_readRtuFrame` does.
+
+    Args:
+     * transport (:class:`Transport`): The transport to read from.
+     * buffer (bytearray): The buffer receiving the frame.
+     * number_of_bytes_to_read (int): The expected size of the response.
+
+    Returns:
+        The number of bytes received (less than expected if the timeout expired).
+
+    """
+    view = memoryview(buffer)
+    received = 0
+    size = _rtuFrameSize(_EMPTY_FRAME, number_of_bytes_to_read)
+    while received < size:
+        if size > len(view):
+            size = len(view)
+        received += transport.readinto(view[received:size])
+        if received < size:
+            # timeout
+            break
+        size = _rtuFrameSize(view[:received], number_of_bytes_to_read)
+    return received
+
+
 def _calculate_minimum_silent_period(baudrate):
     """Calculate the silent period length to comply with the 3.5 character silence between messages.
 
@@ -1201,11 +3088,10 @@ def _calculate_minimum_silent_period(baudrate):
     """
     _checkNumerical(baudrate, minvalue=1, description='baudrate')  # Avoid division by zero
 
-    BITTIMES_PER_CHARACTERTIME = 11
     MINIMUM_SILENT_CHARACTERTIMES = 3.5
 
     bittime = 1 / float(baudrate)
-    return bittime * BITTIMES_PER_CHARACTERTIME * MINIMUM_SILENT_CHARACTERTIMES
+    return bittime * _BITTIMES_PER_CHARACTERTIME * MINIMUM_SILENT_CHARACTERTIMES
 
 
 ##############################
@@ -1600,13 +3486,8 @@ def _bytestringToValuelist(bytestring, numberOfRegisters):
     numberOfBytes = _NUMBER_OF_BYTES_PER_REGISTER * numberOfRegisters
     _checkString(bytestring, 'byte string', minlength=numberOfBytes, maxlength=numberOfBytes)
 
-    values = []
-    for i in range(numberOfRegisters):
-        offset = _NUMBER_OF_BYTES_PER_REGISTER * i
-        substring = bytestring[offset: offset + _NUMBER_OF_BYTES_PER_REGISTER]
-        values.append(_twoByteStringToNum(substring))
-
-    return values
+    # Decoded in a single call (same as _twoByteStringToNum for each register)
+    return list(struct.unpack('>{}H'.format(numberOfRegisters), _stringToFrame(bytestring)))
 
 
 def _pack(formatstring, value):
@@ -1782,7 +3663,49 @@ def _bitResponseToValue(bytestring):
     elif bytestring == RESPONSE_OFF:
         return 0
     else:
-        raise ValueError('Could not convert bit response to a value. Input: {0!r}'.format(bytestring))
+        raise InvalidResponseError('Could not convert bit response to a value. Input: {0!r}'.format(bytestring))
+
+
+def _bitlistToBytestring(bitlist):
+    """Pack a list of bit values to a bytestring.
+
+    The first bit is the least significant bit of the first byte, and the last byte is padded with zeros.
+
+    Args:
+        bitlist (list of int): The bit values 0 or 1.
+
+    Returns:
+        A bytestring (str). Length = number of bits / 8, rounded up.
+
+    Raises:
+        TypeError, ValueError
+
+    """
+    packed = bytearray((len(bitlist) + 7) // 8)
+    for i, bit in enumerate(bitlist):
+        _checkInt(bit, minvalue=0, maxvalue=1, description='elements in the input bit list')
+        if bit:
+            packed[i >> 3] |= 1 << (i & 7)
+    return _frameToString(packed)
+
+
+def _bytestringToBitlist(bytestring, numberOfBits):
+    """Unpack the bit values of a bytestring.
+
+    Args:
+        * bytestring (str): The packed bits, the first bit being the least significant bit of the first byte.
+        * numberOfBits (int): The number of bits to unpack.
+
+    Returns:
+        The bit values 0 or 1 (list of int).
+
+    Raises:
+        TypeError, ValueError
+
+    """
+    _checkString(bytestring, description='bytestring', minlength=(numberOfBits + 7) // 8)
+    packed = bytearray(_stringToFrame(bytestring))
+    return [(packed[i >> 3] >> (i & 7)) & 1 for i in range(numberOfBits)]
 
 
 def _createBitpattern(functioncode, value):
@@ -1982,6 +3905,24 @@ _CRC16TABLE = (
     """
 
 
+def _buildCrcWordTable():
+    """Build the table computing the CRC-16 for Modbus two bytes at a time.
+
+    The entry for a 16-bit word (made of two bytes, the first one being the least significant)
+    is the register resulting of the processing of both bytes from a null register, so that
+    the processing of a word from any register is ``_CRC16WORDTABLE[register ^ word]``.
+
+    """
+    table = array.array('H')
+    for word in range(0x10000):
+        register = (word >> 8) ^ _CRC16TABLE[word & 0xFF]
+        table.append((register >> 8) ^ _CRC16TABLE[register & 0xFF])
+    return table
+
+
+_CRC16WORDTABLE = _buildCrcWordTable()
+
+
 def _calculateCrcString(inputstring):
     """Calculate CRC-16 for Modbus.
 
@@ -1994,13 +3935,46 @@ def _calculateCrcString(inputstring):
     """
     _checkString(inputstring, description='input CRC string')
 
-    # Preload a 16-bit register with ones
-    register = 0xFFFF
+    return _frameToString(_RTU_CRC.pack(_calculateCrc(_stringToFrame(inputstring))))
+
+
+def _calculateCrc(data, register=0xFFFF):
+    """Calculate CRC-16 for Modbus on raw bytes.
 
-    for char in inputstring:
-        register = (register >> 8) ^ _CRC16TABLE[(register ^ ord(char)) & 0xFF]
+    Args:
+        * data (bytes, bytearray or memoryview): An arbitrary-length message.
+        * register (int): The initial register value, for continuing the CRC of a message
+          whose beginning has already been processed (see :func:`_crcRtuHeader`).
+
+    Returns:
+        The CRC value (int). It is 0 when *data* is a complete frame with a valid CRC.
+
+    The message is processed two bytes at a time with :data:`_CRC16WORDTABLE`.
+
+    """
+    numberOfWords = len(data) // 2
+    for word in struct.unpack_from('<{}H'.format(numberOfWords), data):
+        register = _CRC16WORDTABLE[register ^ word]
+    if len(data) % 2:
+        byte, = struct.unpack_from('B', data, 2 * numberOfWords)
+        register = (register >> 8) ^ _CRC16TABLE[(register ^ byte) & 0xFF]
+    return register
+
+
+def _crcRtuHeader(slaveaddress, functioncode):
+    """Give the CRC-16 register after the processing of an RTU frame header.
 
-    return _numToTwoByteString(register, LsbFirst=True)
+    Args:
+        * slaveaddress (int): The slave address.
+        * functioncode (int): The function code.
+
+    Returns:
+        The register value (int), to be passed to :func:`_calculateCrc` for the rest of the frame.
+
+    The header being two bytes long, its processing is a lookup in the precomputed :data:`_CRC16WORDTABLE`.
+
+    """
+    return _CRC16WORDTABLE[0xFFFF ^ (slaveaddress | functioncode << 8)]
 
 
 def _calculateLrcString(inputstring):
@@ -2040,7 +4014,7 @@ def _checkMode(mode):
     """Check that the Modbus mode is valie.
 
     Args:
-        mode (string): The Modbus mode (MODE_RTU or MODE_ASCII)
+        mode (string): The Modbus mode (MODE_RTU, MODE_ASCII or MODE_TCP)
 
     Raises:
         TypeError, ValueError
@@ -2050,8 +4024,8 @@ def _checkMode(mode):
     if not isinstance(mode, str):
         raise TypeError('The {0} should be a string. Given: {1!r}'.format("mode", mode))
 
-    if mode not in [MODE_RTU, MODE_ASCII]:
-        raise ValueError("Unreconized Modbus mode given. Must be 'rtu' or 'ascii' but {0!r} was given.".format(mode))
+    if mode not in [MODE_RTU, MODE_ASCII, MODE_TCP]:
+        raise ValueError("Unreconized Modbus mode given. Must be 'rtu', 'ascii' or 'tcp' but {0!r} was given.".format(mode))
 
 
 def _checkFunctioncode(functioncode, listOfAllowedValues=[]):
@@ -2096,7 +4070,7 @@ def _checkSlaveaddress(slaveaddress):
 
     """
     SLAVEADDRESS_MAX = 247
-    SLAVEADDRESS_MIN = 0
+    SLAVEADDRESS_MIN = 1    # the broadcast address is only valid for the requests sent by broadcast()
 
     _checkInt(slaveaddress, SLAVEADDRESS_MIN, SLAVEADDRESS_MAX, description='slaveaddress')
 
@@ -2141,7 +4115,7 @@ def _checkResponseByteCount(payload):
         errortemplate = 'Wrong given number of bytes in the response: {0}, but counted is {1} as data payload length is {2}.' + \
                         ' The data payload is: {3!r}'
         errortext = errortemplate.format(givenNumberOfDatabytes, countedNumberOfDatabytes, len(payload), payload)
-        raise ValueError(errortext)
+        raise InvalidResponseError(errortext)
 
 
 def _checkResponseRegisterAddress(payload, registeraddress):
@@ -2166,7 +4140,7 @@ def _checkResponseRegisterAddress(payload, registeraddress):
     receivedStartAddress = _twoByteStringToNum(bytesForStartAddress)
 
     if receivedStartAddress != registeraddress:
-        raise ValueError('Wrong given write start adress: {0}, but commanded is {1}. The data payload is: {2!r}'.format( \
+        raise InvalidResponseError('Wrong given write start adress: {0}, but commanded is {1}. The data payload is: {2!r}'.format( \
             receivedStartAddress, registeraddress, payload))
 
 
@@ -2192,7 +4166,7 @@ def _checkResponseNumberOfRegisters(payload, numberOfRegisters):
     receivedNumberOfWrittenReisters = _twoByteStringToNum(bytesForNumberOfRegisters)
 
     if receivedNumberOfWrittenReisters != numberOfRegisters:
-        raise ValueError(
+        raise InvalidResponseError(
             'Wrong number of registers to write in the response: {0}, but commanded is {1}. The data payload is: {2!r}'.format( \
                 receivedNumberOfWrittenReisters, numberOfRegisters, payload))
 
@@ -2218,7 +4192,7 @@ def _checkResponseWriteData(payload, writedata):
     receivedWritedata = payload[BYTERANGE_FOR_WRITEDATA]
 
     if receivedWritedata != writedata:
-        raise ValueError(
+        raise InvalidResponseError(
             'Wrong write data in the response: {0!r}, but commanded is {1!r}. The data payload is: {2!r}'.format( \
                 receivedWritedata, writedata, payload))
 
@@ -19,41 +19,492 @@
 """ Common definitions and helpers for Modbus devices support."""
 
 from collections import namedtuple
+import array
+import random
+import sys
 import time
 import struct
 import logging
+import threading
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, bulk decoding falls back to the array module
+    numpy = None
 
 from pycstbox.log import Loggable
 from pycstbox.hal import HalError
 from pycstbox.hal.device import PolledDevice, CommunicationError, CRCError
-from pycstbox.minimalmodbus import register_serial_port, Instrument, BAUDRATE, PARITY, BYTESIZE, STOPBITS, TIMEOUT
+from pycstbox.minimalmodbus import register_serial_port, register_tcp_gateway, get_transport, Instrument
+from pycstbox.minimalmodbus import read_registers_batch, BatchRead, is_write_functioncode
+from pycstbox.minimalmodbus import BAUDRATE, PARITY, BYTESIZE, STOPBITS, TIMEOUT, TCP_TIMEOUT, TCP_URL_PREFIX
+from pycstbox.minimalmodbus import MODE_TCP, MAX_IN_FLIGHT, PRIORITY_CONTROL, PRIORITY_CONFIG
+from pycstbox.minimalmodbus import SlaveReportedException, NoResponseError, InvalidResponseError, ExchangeStats
 
 _logger = logging.getLogger('modbus')
 
+# the HAL devices created so far, for the background pollers
+_hal_devices = []
+
+# the communication faults of the devices, by port (see RTUModbusHWDevice.reset_communications)
+_port_faults = {}
+
+
+def get_hal_devices():
+    """ Returns the Modbus HAL devices created so far, in creation order. """
+    return list(_hal_devices)
+
+
+def clear_hal_devices():
+    """ Forgets the Modbus HAL devices created so far and the faults of their ports, before the
+    configuration is (re)loaded.
+    """
+    del _hal_devices[:]
+    _port_faults.clear()
+
+
+class SlaveExceptionError(HalError):
+    """ The device answered a request with a Modbus exception response (illegal address,...).
+
+    Unlike :py:class:`CommunicationError` and :py:class:`CRCError`, this does not denote a line fault,
+    and thus does not call for a communications reset.
+
+    :var unit_id: the address of the device
+    :var int exception_code: the exception code returned by the device
+    """
+    def __init__(self, unit_id, error):
+        super(SlaveExceptionError, self).__init__('device %s : %s' % (unit_id, error))
+        self.unit_id = unit_id
+        self.exception_code = error.exception_code
+        self.error = error
+
+
+class _PortFaults(object):
+    """ The devices of a port, and the ones which needed a communications recovery recently. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = set()
+        self.faults = {}
+        # number of port statistics summaries logged so far (see RTUModbusHWDevice.log_stats)
+        self.stats_logged = 0
+
+    def record(self, unit_id, window):
+        """ Records a fault of a device, and returns the number of devices of the port
+        which had a fault during the last *window* seconds.
+        """
+        now = time.time()
+        with self.lock:
+            self.faults[unit_id] = now
+            return sum(1 for t in self.faults.values() if now - t <= window)
+
+    def clear(self, unit_id=None):
+        """ Forgets the fault of a device, or the faults of all the devices if None. """
+        with self.lock:
+            if unit_id is None:
+                self.faults.clear()
+            else:
+                self.faults.pop(unit_id, None)
+
+
+class DeviceQuarantinedError(HalError):
+    """ The transaction was not attempted, or failed, while the device is quarantined by its
+    :py:class:`CircuitBreaker`.
+
+    This does not denote a line fault, and thus does not call for a communications reset.
+
+    :var unit_id: the address of the device
+    :var float next_probe: the time (as returned by time.time()) of the next transaction attempt
+    """
+    def __init__(self, unit_id, next_probe):
+        super(DeviceQuarantinedError, self).__init__(
+            'device %s quarantined (next probe in %.1fs)' % (unit_id, max(0, next_probe - time.time()))
+        )
+        self.unit_id = unit_id
+        self.next_probe = next_probe
+
+
+class CircuitBreaker(object):
+    """ Isolates a device which stopped answering, so that it does not waste the bus time.
+
+    After *threshold* consecutive timeouts, the device is quarantined: its transactions fail immediately,
+    except when a probe is due. Probes are done after a back-off delay, starting at *min_backoff* and
+    doubling after each failed probe, up to *max_backoff*. The first answer of the device ends the
+    quarantine.
+
+    :param int threshold: the number of consecutive timeouts putting the device in quarantine
+    :param float min_backoff: the initial delay (in seconds) between probes
+    :param float max_backoff: the maximum delay (in seconds) between probes
+    """
+    def __init__(self, threshold=3, min_backoff=5., max_backoff=300.):
+        self.threshold = threshold
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.consecutive_timeouts = 0
+        self.backoff = 0
+        self.next_probe = None
+        """ time of the next probe, or None if the device is not quarantined """
+        self.quarantine_start = None
+        self.quarantines = 0
+        """ number of quarantines so far """
+        self.quarantined_time = 0.
+        """ cumulated duration of the past quarantines (in seconds) """
+
+    @property
+    def quarantined(self):
+        return self.next_probe is not None
+
+    def allow(self):
+        """ Tells if a transaction can be attempted, that is if the device is not quarantined or a probe is due. """
+        return self.next_probe is None or time.time() >= self.next_probe
+
+    def answered(self):
+        """ Records that the device answered (even with an error).
+
+        :return: True if this ends a quarantine
+        """
+        self.consecutive_timeouts = 0
+        if self.next_probe is None:
+            return False
+        self.quarantined_time += time.time() - self.quarantine_start
+        self.next_probe = self.quarantine_start = None
+        return True
+
+    def timed_out(self):
+        """ Records that the device did not answer.
+
+        :return: True if this puts the device in quarantine
+        """
+        self.consecutive_timeouts += 1
+        now = time.time()
+        if self.next_probe is not None:
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            self.next_probe = now + self.backoff
+            return False
+        if self.consecutive_timeouts < self.threshold:
+            return False
+        self.backoff = self.min_backoff
+        self.next_probe = now + self.backoff
+        self.quarantine_start = now
+        self.quarantines += 1
+        return True
+
+
+class RetryPolicy(object):
+    """ Tells if and when a failed transaction is retried, depending on the error.
+
+    The errors are sorted in classes, each one having its own maximum number of retries and back-off delay:
+
+    - TIMEOUT : no answer (:py:class:`pycstbox.minimalmodbus.NoResponseError`)
+    - CORRUPTED : corrupted or malformed response (:py:class:`pycstbox.minimalmodbus.InvalidResponseError`),
+      most often caused by noise on the line
+    - BUSY : the device is busy (Modbus exception 6)
+
+    The other errors, including the other Modbus exceptions which are deterministic, are not retried.
+    This includes ACKNOWLEDGE (exception 5), by which the device tells that it accepted a long running
+    command : sending it again would restart the command.
+
+    The back-off delay doubles at each retry of the same transaction, and is randomized by +/- *jitter*
+    (as a fraction of it), so that the devices do not retry in lockstep. Retries are abandoned when the time
+    spent in the retries of the current poll cycle (or budget period) would exceed *budget*.
+
+    :param dict retries: the maximum number of retries, by error class (merged with the defaults)
+    :param dict backoff: the back-off delay in seconds, by error class (merged with the defaults)
+    :param float jitter: the randomization of the back-off delays
+    :param float budget: the maximum time (in seconds) spent in retries during a poll cycle or budget period
+    """
+    TIMEOUT = 'timeout'
+    CORRUPTED = 'corrupted'
+    BUSY = 'busy'
+
+    DEFAULT_RETRIES = {TIMEOUT: 1, CORRUPTED: 3, BUSY: 3}
+    DEFAULT_BACKOFF = {TIMEOUT: 0., CORRUPTED: 0.005, BUSY: 0.05}
+
+    def __init__(self, retries=None, backoff=None, jitter=0.5, budget=0.5):
+        self.retries = dict(self.DEFAULT_RETRIES)
+        self.retries.update(retries or {})
+        self.backoff = dict(self.DEFAULT_BACKOFF)
+        self.backoff.update(backoff or {})
+        self.jitter = jitter
+        self.budget = budget
+
+    @classmethod
+    def error_class(cls, error):
+        """ Returns the class of an error, or None if it is not to be retried. """
+        if isinstance(error, NoResponseError):
+            return cls.TIMEOUT
+        if isinstance(error, SlaveReportedException):
+            if error.exception_code == SlaveReportedException.SLAVE_DEVICE_BUSY:
+                return cls.BUSY
+            return None
+        if isinstance(error, InvalidResponseError):
+            return cls.CORRUPTED
+        return None
+
+    def delay(self, error, attempt, spent):
+        """ Returns the delay before retrying a failed transaction.
+
+        :param Exception error: the error of the last attempt
+        :param int attempt: the number of retries done so far for the transaction
+        :param float spent: the time (in seconds) spent in retries during the current poll cycle or budget period
+        :return: the delay (in seconds), or None if the transaction must not be retried
+        """
+        error_class = self.error_class(error)
+        if error_class is None or attempt >= self.retries.get(error_class, 0):
+            return None
+        delay = self.backoff[error_class] * (1 << attempt) * random.uniform(1 - self.jitter, 1 + self.jitter)
+        if spent + delay > self.budget:
+            return None
+        return delay
+
+
+def _hal_error(unit_id, error):
+    """ Returns the HAL exception reporting an error raised by a transaction with a device.
+
+    Exception responses are reported as :py:class:`SlaveExceptionError`, timeouts and I/O errors as
+    :py:class:`CommunicationError`, and corrupted or malformed responses (see
+    :py:class:`pycstbox.minimalmodbus.ModbusError`) as :py:class:`CRCError`.
+
+    :param unit_id: the address of the device
+    :param Exception error: the error (IOError or ValueError)
+    :rtype: HalError
+    """
+    if isinstance(error, SlaveReportedException):
+        return SlaveExceptionError(unit_id, error)
+    if isinstance(error, IOError):
+        return CommunicationError(unit_id, error)
+    return CRCError(unit_id, error)
+
+
+class PollResultSlot(object):
+    """ Hand-over point between a background poller and the HAL device it polls on behalf of the framework.
+
+    The poller stores the outcome of a device poll (the events or the error raised) when the slot is
+    empty, and the HAL device takes it when the framework polls it. Taking the result empties the slot
+    and invokes the :py:attr:`wakeup` callback, telling the poller that the device can be polled again.
+    The framework thus gets the outcome of the poll done after its previous request, without waiting
+    for the transactions. If this poll is not over yet, the framework gets nothing for this cycle and
+    the outcome is kept for the next one.
+    """
+    def __init__(self, wakeup=None):
+        """
+        :param callable wakeup: callable invoked (without argument) each time the slot is emptied
+        """
+        self.wakeup = wakeup
+        self._cond = threading.Condition()
+        self._full = False
+        self._events = None
+        self._error = None
+
+    @property
+    def empty(self):
+        """ True if the poller can store a new result. """
+        return not self._full
+
+    def put(self, events=None, error=None):
+        """ Stores the outcome of a poll.
+
+        :param events: the events returned by the poll
+        :param Exception error: the error raised by the poll if any
+        """
+        with self._cond:
+            self._events, self._error, self._full = events, error, True
+            self._cond.notify_all()
+
+    def take(self, timeout=0):
+        """ Takes the stored outcome of the poll, waiting for it if the slot is empty.
+
+        :param float timeout: maximum wait time (in seconds, default: 0, i.e. no wait)
+        :return: the events of the poll, or None if none was available in time
+        :raise Exception: the error raised by the poll
+        """
+        with self._cond:
+            deadline = time.time() + timeout
+            while not self._full:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            events, error = self._events, self._error
+            self._events = self._error = None
+            self._full = False
+
+        if self.wakeup:
+            self.wakeup()
+        if error is not None:
+            raise error
+        return events
+
+
+class ThreadedPoller(object):
+    """ Polls Modbus HAL devices with one worker thread per port.
+
+    Buses attached to different ports are electrically independent, so that polling them
+    concurrently makes the aggregate throughput grow with the number of ports. The devices of
+    a given port are polled in turn by its worker.
+
+    As with :py:class:`pycstbox.modbusaio.AsyncPoller`, each device gets a :py:class:`PollResultSlot`
+    filled with the outcome of a new poll each time the framework has taken the previous one.
+    """
+    def __init__(self, hal_devices, logger=None):
+        """
+        :param hal_devices: the devices to be polled (iterable of :py:class:`RTUModbusHALDevice`)
+        :param logger: the logger to be used (default: module logger)
+        """
+        self.hal_devices = list(hal_devices)
+        self.logger = logger or _logger
+        self._threads = []
+        self._wakeups = []
+        self._terminated = False
+
+    def start(self):
+        """ Starts the workers and delegates the polling of the devices to them. """
+        ports = {}
+        for hal_device in self.hal_devices:
+            ports.setdefault(hal_device.port, []).append(hal_device)
+
+        self._terminated = False
+        for port, hal_devices in ports.items():
+            wakeup = threading.Event()
+            polled = []
+            for hal_device in hal_devices:
+                slot = PollResultSlot(wakeup=wakeup.set)
+                hal_device.attach_poll_slot(slot)
+                polled.append((hal_device, slot))
+
+            thread = threading.Thread(target=self._poll_port, args=(polled, wakeup), name='modbus-poller-%s' % port)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+            self._wakeups.append(wakeup)
+
+        self.logger.info('threaded poller started for %d devices on %d ports', len(self.hal_devices), len(ports))
+
+    def stop(self):
+        """ Stops the workers and goes back to direct polling of the devices. """
+        self._terminated = True
+        for wakeup in self._wakeups:
+            wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads, self._wakeups = [], []
+        for hal_device in self.hal_devices:
+            hal_device.attach_poll_slot(None)
+        self.logger.info('threaded poller stopped')
+
+    def _poll_port(self, polled, wakeup):
+        while not self._terminated:
+            wakeup.clear()
+            idle = True
+            for hal_device, slot in polled:
+                if not slot.empty:
+                    continue
+                idle = False
+                try:
+                    events = hal_device.poll_now()
+                except (HalError, IOError, ValueError) as e:
+                    slot.put(error=e)
+                except Exception as e:
+                    self.logger.exception(e)
+                    slot.put(error=e)
+                else:
+                    slot.put(events)
+            if idle:
+                wakeup.wait()
+
 
 class RTUModbusHALDevice(PolledDevice):
-    """ RTU devices share the serial port on which the RS485 line is connected. """
+    """ RTU devices share the serial port on which the RS485 line is connected.
+
+    Devices behind a Modbus TCP gateway are supported the same way, by using the gateway URL
+    (``tcp://host[:port]``) as the coordinator port.
+
+    If a transport has already been registered under the coordinator port name (for instance
+    a :py:class:`pycstbox.modbussim.LoopbackTransport` for load testing), it is used instead. Loopback lines
+    polled by :py:mod:`pycstbox.modbusaio` need :py:mod:`pycstbox.modbussimaio` to be imported as well.
+
+    The polling can be delegated to a background poller (see :py:class:`ThreadedPoller` and
+    :py:mod:`pycstbox.modbusaio`), which attaches a :py:class:`PollResultSlot` to the device. :py:meth:`poll` returns then the outcome
+    of the last poll done by the poller without waiting for it, and :py:meth:`poll_now` does the actual device poll.
+    """
     def __init__(self, coord_cfg, dev_cfg):
-        # create the shared serial port in minimalmodbus dictionary if not yet known
-        port_cfg = dict(
-            baudrate=getattr(coord_cfg, 'baudrate', BAUDRATE),
-            parity=getattr(coord_cfg, 'parity', PARITY),
-            bytesize=getattr(coord_cfg, 'bytesize', BYTESIZE),
-            stopbits=getattr(coord_cfg, 'stopbits', STOPBITS),
-            timeout=getattr(coord_cfg, 'timeout', TIMEOUT)
-        )
-        register_serial_port(coord_cfg.port, logger=_logger, **port_cfg)
+        try:
+            transport = get_transport(coord_cfg.port)
+        except KeyError:
+            transport = None
+
+        if coord_cfg.port.startswith(TCP_URL_PREFIX):
+            register_tcp_gateway(coord_cfg.port, timeout=getattr(coord_cfg, 'timeout', TCP_TIMEOUT), logger=_logger)
+        elif transport is None or transport.serial is not None:
+            # create the shared serial port in minimalmodbus dictionary if not yet known
+            port_cfg = dict(
+                baudrate=getattr(coord_cfg, 'baudrate', BAUDRATE),
+                parity=getattr(coord_cfg, 'parity', PARITY),
+                bytesize=getattr(coord_cfg, 'bytesize', BYTESIZE),
+                stopbits=getattr(coord_cfg, 'stopbits', STOPBITS),
+                timeout=getattr(coord_cfg, 'timeout', TIMEOUT)
+            )
+            register_serial_port(coord_cfg.port, logger=_logger, **port_cfg)
 
         super(RTUModbusHALDevice, self).__init__(coord_cfg, dev_cfg)
 
+        self.port = coord_cfg.port
+        self._poll_slot = None
+        _hal_devices.append(self)
+
+    @property
+    def hw_device(self):
+        """ The :py:class:`RTUModbusHWDevice` instance of the device. """
+        return getattr(self, '_hwdev', None)
+
+    def attach_poll_slot(self, slot):
+        """ Delegates the polling to a background poller.
+
+        :param PollResultSlot slot: the slot in which the poller stores the outcome of the polls,
+                                    or None to go back to direct polling
+        """
+        self._poll_slot = slot
+
     def poll(self):
+        if self._poll_slot is not None:
+            return self._poll_slot.take()
+        return self.poll_now()
+
+    def poll_now(self):
+        """ Polls the device, whatever the polling is delegated or not.
+
+        The data prefetched during the poll (see :py:meth:`RTUModbusHWDevice.prefetch`) are discarded
+        at its end, so that they are never mistaken for fresh ones by later reads.
+        """
+        hw_device = self.hw_device
+        if isinstance(hw_device, RTUModbusHWDevice):
+            hw_device.start_poll_cycle()
         try:
             return super(RTUModbusHALDevice, self).poll()
         except ValueError as e:
-            # minimalmodbus based HW devices report CRC errors as ValueError
-            raise CRCError(self.device_id, e)
+            # minimalmodbus based HW devices report response errors as ValueError
+            raise _hal_error(self.device_id, e)
+        finally:
+            if isinstance(hw_device, RTUModbusHWDevice):
+                hw_device.clear_prefetch()
 
 
+BIG_ENDIAN = '>'
+LITTLE_ENDIAN = '<'
+
+_DATATYPES = {
+    # name : (struct format code, size in registers)
+    'int16': ('h', 1),
+    'uint16': ('H', 1),
+    'int32': ('i', 2),
+    'uint32': ('I', 2),
+    'int64': ('q', 4),
+    'uint64': ('Q', 4),
+    'float32': ('f', 2),
+    'float64': ('d', 4),
+}
+
 class ModbusRegister(namedtuple('ModbusRegister', ['addr', 'size', 'cfgreg', 'signed'])):
     """ Modbus register description.
 
@@ -61,9 +512,18 @@ class ModbusRegister(namedtuple('ModbusRegister', ['addr', 'size', 'cfgreg', 'si
     :var int size: register size (in 16 bits words)
     :var bool cfgreg: True if this register is a configuration one (default: False)
     :var bool signed: True if the value is signed (default: False)
+
+    The value is a 16 bits integer for single registers, and a 32 bits one made of the first two words
+    otherwise, signed or not according to the signed attribute. See :py:class:`TypedModbusRegister`
+    for the other data types and byte orders.
     """
     __slots__ = ()
 
+    # decoding attributes, set by TypedModbusRegister
+    datatype = None
+    byteorder = BIG_ENDIAN
+    wordswap = False
+
     def __new__(cls, addr, size=1, cfgreg=False, signed=False):
         """ Overridden __new__ allowing default values for tuple attributes. """
         return super(ModbusRegister, cls).__new__(cls, addr, size, cfgreg, signed)
@@ -78,13 +538,371 @@ class ModbusRegister(namedtuple('ModbusRegister', ['addr', 'size', 'cfgreg', 'si
         """
         return raw
 
+    @property
+    def value_type(self):
+        """ The type of the value, taking defaults in account """
+        if self.datatype:
+            return self.datatype
+        value_type = 'int16' if self.size == 1 else 'int32'
+        return value_type if self.signed else 'u' + value_type
+
     @property
     def unpack_format(self):
-        fmt = 'H' if self.size == 1 else 'I'
-        if self.signed:
-            return fmt.lower()
-        else:
-            return fmt
+        """ The :py:mod:`struct` format code of the value, without the byte order prefix """
+        return _DATATYPES[self.value_type][0]
+
+    @property
+    def has_custom_decode(self):
+        """ True if the register class overrides the default :py:meth:`decode` method """
+        return type(self).decode is not ModbusRegister.decode
+
+
+class TypedModbusRegister(namedtuple('TypedModbusRegister', ['addr', 'size', 'cfgreg', 'signed',
+                                                             'datatype', 'byteorder', 'wordswap']),
+                          ModbusRegister):
+    """ Modbus register holding a value of a given data type.
+
+    :var str datatype: the type of the value ('int16', 'uint16', 'int32', 'uint32', 'int64', 'uint64',
+        'float32', 'float64'). If not provided, the value is decoded as for :py:class:`ModbusRegister`.
+    :var str byteorder: the byte order of the value (BIG_ENDIAN or LITTLE_ENDIAN, default: BIG_ENDIAN)
+    :var bool wordswap: True if the 16 bits words of multi-registers values are stored least significant first
+        (default: False)
+
+    The other attributes are the ones of :py:class:`ModbusRegister`, the size defaulting to the one of
+    the data type.
+    """
+    __slots__ = ()
+
+    def __new__(cls, addr, size=None, cfgreg=False, signed=False, datatype=None, byteorder=BIG_ENDIAN,
+                wordswap=False):
+        """ Overridden __new__ allowing default values for tuple attributes. """
+        if datatype is not None:
+            try:
+                _, dt_size = _DATATYPES[datatype]
+            except KeyError:
+                raise ValueError('unsupported data type : %s' % datatype)
+            if size is None:
+                size = dt_size
+            elif size != dt_size:
+                raise ValueError('size %d mismatch with data type %s' % (size, datatype))
+        elif size is None:
+            size = 1
+        if byteorder not in (BIG_ENDIAN, LITTLE_ENDIAN):
+            raise ValueError('invalid byte order : %s' % byteorder)
+        return super(TypedModbusRegister, cls).__new__(cls, addr, size, cfgreg, signed, datatype, byteorder,
+                                                       wordswap)
+
+
+_structs = {}
+
+
+def get_struct(fmt):
+    """ Returns the compiled :py:class:`struct.Struct` for a format, creating it if needed.
+
+    :param str fmt: the format as used by :py:func:`struct.unpack`
+    :rtype: struct.Struct
+    """
+    try:
+        return _structs[fmt]
+    except KeyError:
+        st = _structs[fmt] = struct.Struct(fmt)
+        return st
+
+
+def _swap_words(raw):
+    """ Reverses the order of the 16 bits words of a buffer.
+    """
+    return raw[:0].join(raw[i:i + 2] for i in range(len(raw) - 2, -1, -2))
+
+
+def _swap_value_words(raw, size):
+    """ Reverses the order of the 16 bits words of each value of a buffer made of values of a given size.
+
+    :param raw: the buffer
+    :param int size: the size of the values (in 16 bits words)
+    :rtype: bytearray
+    """
+    raw = memoryview(raw).tobytes()
+    swapped = bytearray(len(raw))
+    step = size * 2
+    for word in range(size):
+        for byte in (0, 1):
+            swapped[word * 2 + byte::step] = raw[(size - 1 - word) * 2 + byte::step]
+    return swapped
+
+
+def _array_typecode(fmt):
+    """ Returns the :py:mod:`array` type code matching a :py:mod:`struct` format code, or None if there is none. """
+    kinds = ('f', 'd') if fmt in 'fd' else ('b', 'h', 'i', 'l', 'q') if fmt.islower() else ('B', 'H', 'I', 'L', 'Q')
+    size = struct.calcsize('=' + fmt)
+    for typecode in kinds:
+        try:
+            if array.array(typecode).itemsize == size:
+                return typecode
+        except ValueError:
+            # 'q' and 'Q' are not available on all versions
+            pass
+    return None
+
+
+_ARRAY_TYPECODES = dict((datatype, _array_typecode(fmt)) for datatype, (fmt, _) in _DATATYPES.items())
+_NATIVE_BYTEORDER = LITTLE_ENDIAN if sys.byteorder == 'little' else BIG_ENDIAN
+
+
+def decode_register_array(raw, datatype='uint16', byteorder=BIG_ENDIAN, wordswap=False, use_numpy=None):
+    """ Decodes a block of registers holding values of the same type in a single call.
+
+    The values are returned as a NumPy array if NumPy is available (and not disabled with
+    *use_numpy*), and as an :py:class:`array.array` otherwise. In both cases, the decoding
+    is done by C code, whatever the number of values.
+
+    :param raw: the raw content of the registers (bytes, bytearray or memoryview)
+    :param str datatype: the type of the values (see :py:class:`ModbusRegister`)
+    :param str byteorder: the byte order of the values (BIG_ENDIAN or LITTLE_ENDIAN)
+    :param bool wordswap: True if the 16 bits words of multi-registers values are stored least significant first
+    :param bool use_numpy: True for returning a NumPy array, False for an array.array, None (default) for
+        using NumPy if available
+    :return: the values, in native byte order
+    :raise ValueError: if the data type or byte order is not supported, or if the raw content length does not
+        match the data type
+    """
+    try:
+        fmt, size = _DATATYPES[datatype]
+    except KeyError:
+        raise ValueError('unsupported data type : %s' % datatype)
+    if byteorder not in (BIG_ENDIAN, LITTLE_ENDIAN):
+        raise ValueError('invalid byte order : %s' % byteorder)
+    if len(raw) % (size * 2):
+        raise ValueError('%d bytes do not make a whole number of %s values' % (len(raw), datatype))
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ValueError('NumPy is not available')
+
+    if wordswap and size > 1:
+        raw = _swap_value_words(raw, size)
+
+    if use_numpy:
+        dtype = numpy.dtype(byteorder + fmt)
+        return numpy.frombuffer(raw, dtype=dtype).astype(dtype.newbyteorder('='))
+
+    typecode = _ARRAY_TYPECODES[datatype]
+    if typecode is None:
+        raise ValueError('data type %s not supported by the array module' % datatype)
+    values = array.array(typecode)
+    if sys.version_info[0] > 2:
+        values.frombytes(raw)
+    else:
+        values.fromstring(memoryview(raw).tobytes())
+    if byteorder != _NATIVE_BYTEORDER:
+        values.byteswap()
+    return values
+
+
+MAX_BLOCK_SIZE = 125
+""" Maximum number of registers which can be read in a single FC3/FC4 transaction (protocol limit) """
+
+DEFAULT_TURNAROUND_TIME = 0.01
+""" Default estimation of the time (in seconds) taken by a slave to process a request before replying """
+
+_RTU_READ_REQUEST_SIZE = 8          # address + function code + start address + count + CRC
+_RTU_READ_RESPONSE_OVERHEAD = 5     # address + function code + byte count + CRC
+_CHARACTER_BITS = 11                # start + 8 data + parity/stop + stop
+_SILENT_PERIOD_CHARACTERS = 3.5
+
+
+class RegisterBlock(namedtuple('RegisterBlock', ['start', 'count', 'functioncode', 'registers'])):
+    """ A contiguous block of registers, read in a single transaction.
+
+    :var int start: address of the first register of the block
+    :var int count: number of 16 bits registers in the block (including bridged gaps)
+    :var int functioncode: the function code used for reading the block (3 or 4)
+    :var tuple registers: the :py:class:`ModbusRegister` instances served by the block
+    """
+    __slots__ = ()
+
+    @property
+    def end(self):
+        """ Address following the last register of the block """
+        return self.start + self.count
+
+    def covers(self, addr, count=1):
+        """ Tells if a range of registers is fully included in the block.
+
+        :param int addr: address of the first register of the range
+        :param int count: number of registers of the range
+        :rtype: bool
+        """
+        return self.start <= addr and addr + count <= self.end
+
+    def slice_of(self, data, addr, count=1):
+        """ Returns the part of a block buffer holding a given range of registers.
+
+        :param data: the raw content of the whole block
+        :param int addr: address of the first register of the range
+        :param int count: number of registers of the range
+        :return: the raw content of the range
+        """
+        offset = (addr - self.start) * 2
+        return data[offset:offset + count * 2]
+
+    def slices(self, data):
+        """ Splits the block buffer into the raw content of each of its registers.
+
+        :param data: the raw content of the whole block
+        :return: a dictionary keyed by the registers of the block, containing their raw content
+        :rtype: dict
+        """
+        return dict((reg, self.slice_of(data, reg.addr, reg.size)) for reg in self.registers)
+
+
+def _decoder_key(block):
+    """ Key of the decoder of a block, telling apart the blocks of registers equal as tuples but of
+    different classes.
+    """
+    return block, tuple(type(reg) for reg in block.registers)
+
+
+class BlockDecoder(object):
+    """ Compiled decoding plan of a register block.
+
+    Registers sharing the block dominant byte order are decoded by a single pre-compiled
+    :py:class:`struct.Struct` covering the whole block, gaps being skipped with pad bytes. Registers
+    which cannot be part of it (word swapped, other byte order, overlapping an other one) are decoded
+    individually with their own pre-compiled structure. The :py:meth:`ModbusRegister.decode` method
+    is only invoked for registers overriding it.
+    """
+    def __init__(self, block):
+        """
+        :param RegisterBlock block: the block to be decoded
+        """
+        self.block = block
+
+        orders = [reg.byteorder for reg in block.registers]
+        byteorder = max(set(orders), key=orders.count) if orders else BIG_ENDIAN
+
+        fields = []
+        self._registers = []
+        self._fixups = []
+        pos = 0
+        for reg in sorted(block.registers, key=lambda r: r.addr):
+            offset = (reg.addr - block.start) * 2
+            length = reg.size * 2
+            if offset < pos or reg.wordswap or reg.byteorder != byteorder:
+                self._fixups.append((reg, offset, length, get_struct(reg.byteorder + reg.unpack_format)))
+                continue
+            if offset > pos:
+                fields.append('%dx' % (offset - pos))
+            fields.append(reg.unpack_format)
+            # registers without data type larger than 2 words are decoded from their first 2 ones
+            value_length = get_struct(byteorder + reg.unpack_format).size
+            if length > value_length:
+                fields.append('%dx' % (length - value_length))
+            self._registers.append(reg)
+            pos = offset + length
+
+        self._struct = get_struct(byteorder + ''.join(fields))
+        self._custom = [reg for reg in block.registers if reg.has_custom_decode]
+
+    def decode(self, data):
+        """ Decodes the raw content of the block.
+
+        :param data: the raw content of the block
+        :return: a dictionary keyed by the registers of the block, containing their value
+        :rtype: dict
+        """
+        values = dict(zip(self._registers, self._struct.unpack_from(data)))
+        for reg, offset, length, st in self._fixups:
+            raw = data[offset:offset + length]
+            if reg.wordswap:
+                raw = _swap_words(bytes(raw))
+            values[reg] = st.unpack_from(raw)[0]
+        for reg in self._custom:
+            values[reg] = reg.decode(values[reg])
+        return values
+
+
+def transaction_cost(baudrate, count, turnaround_time=DEFAULT_TURNAROUND_TIME):
+    """ Estimates the bus time of a FC3/FC4 read transaction on a RTU line.
+
+    It includes the request and response frames, the silent periods before each of them
+    and the time needed by the slave to process the request.
+
+    :param int baudrate: the line baudrate
+    :param int count: the number of registers read
+    :param float turnaround_time: the slave request processing time (in seconds)
+    :return: the transaction estimated duration (in seconds)
+    :rtype: float
+    """
+    char_time = _CHARACTER_BITS / float(baudrate)
+    chars = _RTU_READ_REQUEST_SIZE + _RTU_READ_RESPONSE_OVERHEAD + 2 * _SILENT_PERIOD_CHARACTERS + 2 * count
+    return chars * char_time + turnaround_time
+
+
+def plan_register_blocks(registers, baudrate, functioncode=3, max_block_size=MAX_BLOCK_SIZE, max_gap=0,
+                         turnaround_time=DEFAULT_TURNAROUND_TIME):
+    """ Computes the set of block reads minimizing the bus time needed to fetch a set of registers.
+
+    Registers are grouped into contiguous blocks. Gaps of up to *max_gap* registers are bridged
+    (i.e. read and discarded) when the estimated wire time of the extra words is lower than the
+    one of an additional transaction, as computed by :py:func:`transaction_cost`.
+
+    The plan is optimal with respect to this cost model and is computed by dynamic programming on
+    the registers sorted by address. Since this is done once per register set, its cost is
+    not an issue.
+
+    :param registers: the registers to be read (an iterable of :py:class:`ModbusRegister`)
+    :param int baudrate: the line baudrate
+    :param int functioncode: the function code used for reading the blocks (3 or 4)
+    :param int max_block_size: the maximum number of registers the device accepts to return in a single read
+    :param int max_gap: the maximum number of unused registers which can be bridged (default: 0, i.e.
+        only contiguous registers are merged, since devices may reject reads of unmapped addresses).
+        None leaves the decision to the cost model only.
+    :param float turnaround_time: the slave request processing time (in seconds)
+    :return: the blocks to be read, sorted by start address
+    :rtype: list of RegisterBlock
+    :raise ValueError: if a register does not fit in the maximum block size, or if registers of different
+        classes are equal as tuples (their values could not be told apart in the results)
+    """
+    unique = {}
+    for reg in registers:
+        other = unique.setdefault(reg, reg)
+        if type(other) is not type(reg):
+            raise ValueError('registers %r and %r of different classes are equal' % (other, reg))
+    regs = sorted(unique.values(), key=lambda r: (r.addr, r.size))
+    for reg in regs:
+        if reg.size > max_block_size:
+            raise ValueError('register at %d too large (size=%d, max block size=%d)' % (reg.addr, reg.size, max_block_size))
+
+    # best[i] : (cost, start index of the last block) of the best plan for regs[:i]
+    best = [(0., 0)] + [None] * len(regs)
+    for i in range(1, len(regs) + 1):
+        end = 0
+        for j in range(i - 1, -1, -1):
+            end = max(end, regs[j].addr + regs[j].size)
+            if max_gap is not None and j < i - 1:
+                # unused registers between the register j and the next one of the candidate block
+                gap = regs[j + 1].addr - (regs[j].addr + regs[j].size)
+                if gap > max_gap:
+                    break
+            count = end - regs[j].addr
+            if count > max_block_size:
+                break
+            cost = best[j][0] + transaction_cost(baudrate, count, turnaround_time)
+            if best[i] is None or cost < best[i][0]:
+                best[i] = (cost, j)
+
+    blocks = []
+    i = len(regs)
+    while i > 0:
+        j = best[i][1]
+        members = regs[j:i]
+        start = members[0].addr
+        count = max(r.addr + r.size for r in members) - start
+        blocks.append(RegisterBlock(start, count, functioncode, tuple(members)))
+        i = j
+    blocks.reverse()
+    return blocks
 
 
 class RTUModbusHWDevice(Instrument, Loggable):
@@ -95,12 +913,37 @@ class RTUModbusHWDevice(Instrument, Loggable):
     DEFAULT_RETRIES = 3
     STATS_INTERVAL = 1000
 
+    # the port is reset when this number of devices had a fault during the last PORT_RESET_WINDOW seconds
+    # (or when all the devices of the port had one, if they are less)
+    PORT_RESET_DEVICES = 2
+    PORT_RESET_WINDOW = 30.
+
+    # retries of the transactions which timed out, and the time budget of retries per poll cycle (see RetryPolicy).
+    # The budget is also renewed every RETRY_BUDGET_WINDOW seconds, for the transactions done outside poll cycles.
+    TIMEOUT_RETRIES = 1
+    RETRY_BUDGET = 0.5
+    RETRY_BUDGET_WINDOW = 10.
+
+    # circuit breaker settings (see CircuitBreaker)
+    QUARANTINE_THRESHOLD = 3
+    QUARANTINE_MIN_BACKOFF = 5.
+    QUARANTINE_MAX_BACKOFF = 300.
+    # block reads planning (see plan_register_blocks). Devices known to accept reads of their unmapped
+    # addresses can widen MAX_GAP to save transactions.
+    MAX_BLOCK_SIZE = MAX_BLOCK_SIZE
+    MAX_GAP = 0
+
+    # registers read by each poll (iterable of ModbusRegister), allowing background pollers to
+    # fetch them without blocking (see pycstbox.modbusaio)
+    POLLED_REGISTERS = None
+    POLLED_REGISTERS_FUNCTIONCODE = 3
+
     def __init__(self, port, unit_id, logname, retries=DEFAULT_RETRIES):
         """
-        :param str port: serial port on which the RS485 interface is connected
+        :param str port: serial port on which the RS485 interface is connected, or Modbus TCP gateway URL
         :param int unit_id: the address of the device
         :param str logname: the (short) root for the name of the log
-        :param int retries: number of retries in case of communication errors
+        :param int retries: number of retries in case of corrupted response or busy device (see :py:class:`RetryPolicy`)
         """
         super(RTUModbusHWDevice, self).__init__(port=port, slaveaddress=int(unit_id))
 
@@ -110,8 +953,36 @@ class RTUModbusHWDevice(Instrument, Loggable):
         self.terminate = False
         self.communication_error = False
 
+        # transactions metrics, summarized in the log every STATS_INTERVAL transactions
         self.total_reads = 0
+        self.total_writes = 0       # including the read/write transactions
         self.total_errors = 0
+        self.total_retries = 0
+        self.total_rejected = 0     # requests rejected without any I/O while quarantined
+        self.transactions_by_functioncode = {}
+        self.errors_by_class = {}
+        self.stats = ExchangeStats()
+
+        self.max_block_size = self.MAX_BLOCK_SIZE
+        self.max_gap = self.MAX_GAP
+        self.turnaround_time = DEFAULT_TURNAROUND_TIME
+        self.max_in_flight = MAX_IN_FLIGHT
+        self._block_plans = {}
+        self._decoders = {}
+        self._prefetched = []
+        self._prefetch_installed = False
+        self._prepared = {}
+        self._port_faults = _port_faults.setdefault(self.transport.name, _PortFaults())
+        self._port_faults.devices.add(self.unit_id)
+        self._in_fault = False
+        self.retry_policy = RetryPolicy(
+            retries={RetryPolicy.TIMEOUT: self.TIMEOUT_RETRIES, RetryPolicy.CORRUPTED: retries, RetryPolicy.BUSY: retries},
+            budget=self.RETRY_BUDGET
+        )
+        self._retry_time = 0.
+        self._retry_budget_start = time.time()
+        self.breaker = CircuitBreaker(self.QUARANTINE_THRESHOLD, self.QUARANTINE_MIN_BACKOFF,
+                                      self.QUARANTINE_MAX_BACKOFF)
 
         Loggable.__init__(self, logname='%s-%03d' % (logname, self.unit_id))
 
@@ -122,44 +993,456 @@ class RTUModbusHWDevice(Instrument, Loggable):
         """ The id of the device """
         return self.address
 
-    def _read_registers(self, start_addr=0, reg_count=1):
+    @property
+    def quarantined(self):
+        """ True if the device is quarantined by its circuit breaker """
+        return self.breaker.quarantined
+
+    def _performCommand(self, functioncode, payloadToSlave):
+        return self._guarded(functioncode, super(RTUModbusHWDevice, self)._performCommand, functioncode, payloadToSlave)
+
+    def _executePrepared(self, prepared, decoder=None):
+        return self._guarded(prepared.functioncode, super(RTUModbusHWDevice, self)._executePrepared, prepared, decoder)
+
+    def start_poll_cycle(self):
+        """ Tells that a new poll cycle starts, which renews the time budget of the retries. """
+        self._retry_time = 0.
+        self._retry_budget_start = time.time()
+
+    def _guarded(self, functioncode, transaction, *args):
+        """ Executes a transaction under the control of the circuit breaker of the device, retrying it
+        as told by the retry policy in case of failure.
+
+        Quarantine probes are not retried. The line is resynchronised before retrying a transaction
+        whose response was corrupted, so that its late bytes are not taken for the next response.
+        The bus is handed over to the other devices of the port during the back-off delay.
+
+        :param int functioncode: the function code of the transaction, for the statistics
+        :raise DeviceQuarantinedError: if the device is quarantined and no probe is due, or if the probe failed
+        """
+        self._check_quarantine()
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                result = transaction(*args)
+            except (IOError, ValueError) as e:
+                self._count_transaction(functioncode)
+                self._count_error(e)
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    self._failed(e)
+                    raise
+                attempt += 1
+                self._retrying(e, attempt, delay)
+                if RetryPolicy.error_class(e) == RetryPolicy.CORRUPTED:
+                    self.resync_line()
+                with self.transport.arbiter.suspended():
+                    time.sleep(delay)
+                self._retry_time += time.time() - start
+            else:
+                self._count_transaction(functioncode)
+                break
+        if self.breaker.consecutive_timeouts:
+            self._answered()
+        return result
+
+    def _retry_delay(self, error, attempt):
+        """ Returns the delay before retrying a failed transaction, or None if it must not be retried.
+
+        :param error: the exception raised by the transaction
+        :param int attempt: the number of retries done so far
+        """
+        if self.breaker.quarantined:
+            return None
+        if time.time() - self._retry_budget_start > self.RETRY_BUDGET_WINDOW:
+            self.start_poll_cycle()
+        return self.retry_policy.delay(error, attempt, self._retry_time)
+
+    def _retrying(self, error, attempt, delay):
+        self.total_retries += 1
+        self.log_debug('retry #%d in %.3fs after error : %s', attempt, delay, error)
+
+    def _check_quarantine(self):
+        if not self.breaker.allow():
+            self.total_rejected += 1
+            raise DeviceQuarantinedError(self.unit_id, self.breaker.next_probe)
+
+    def _count_transaction(self, functioncode):
+        if is_write_functioncode(functioncode):
+            self.total_writes += 1
+        else:
+            self.total_reads += 1
+        self.transactions_by_functioncode[functioncode] = self.transactions_by_functioncode.get(functioncode, 0) + 1
+        if (self.total_reads + self.total_writes) % self.STATS_INTERVAL == 0:
+            self.log_stats()
+
+    def _count_error(self, error):
+        self.total_errors += 1
+        error_class = RetryPolicy.error_class(error) or \
+            ('exception' if isinstance(error, SlaveReportedException) else 'other')
+        self.errors_by_class[error_class] = self.errors_by_class.get(error_class, 0) + 1
+
+    def log_stats(self):
+        """ Logs a summary of the transactions metrics of the device, and of its port if
+        :py:attr:`STATS_INTERVAL` exchanges were done on it since the previous port summary.
+
+        The metrics are counted since the creation of the device.
+        """
+        def detail(counts, fmt='%s'):
+            return ' '.join((fmt + '=%d') % (k, counts[k]) for k in sorted(counts)) or '-'
+
+        self.log_info('stats : %d reads, %d writes (%s), %d errors (%s), %d retries, '
+                      '%d quarantines (%.0fs, %d requests rejected), %s',
+                      self.total_reads, self.total_writes, detail(self.transactions_by_functioncode, 'fc%d'),
+                      self.total_errors, detail(self.errors_by_class),
+                      self.total_retries, self.breaker.quarantines, self.breaker.quarantined_time,
+                      self.total_rejected, self.stats.summary())
+
+        port_stats = self.transport.stats
+        with self._port_faults.lock:
+            due = port_stats.exchanges // self.STATS_INTERVAL > self._port_faults.stats_logged
+            if due:
+                self._port_faults.stats_logged = port_stats.exchanges // self.STATS_INTERVAL
+        if due:
+            _logger.info('port %s stats : %s', self.transport.name, port_stats.summary())
+
+    def _failed(self, error):
+        """ Updates the circuit breaker after a failed transaction.
+
+        :raise DeviceQuarantinedError: if the transaction was a failed probe
+        """
+        breaker = self.breaker
+        if isinstance(error, NoResponseError):
+            probing = breaker.quarantined
+            if breaker.timed_out():
+                self.log_warning('no answer to %d consecutive requests, quarantined (next probe in %.1fs)',
+                                 breaker.consecutive_timeouts, breaker.backoff)
+            elif probing:
+                self.log_debug('probe failed, next one in %.1fs', breaker.backoff)
+                raise DeviceQuarantinedError(self.unit_id, breaker.next_probe)
+        elif isinstance(error, (InvalidResponseError, SlaveReportedException)) and breaker.consecutive_timeouts:
+            # the device answered, even if wrongly
+            self._answered()
+
+    def _answered(self):
+        breaker = self.breaker
+        start = breaker.quarantine_start
+        if breaker.answered():
+            self.log_info('answering again, quarantine ended after %.0fs', time.time() - start)
+
+    def _read_registers(self, start_addr=0, reg_count=1, functioncode=3, decoder=None):
         """ Read a bunch of registers and return the resulting raw data buffer
 
+        If the requested registers are part of a block fetched by :py:meth:`prefetch`, the data are
+        taken from there and no transaction occurs.
+
+        If a decoder is given, it is applied to the raw data, which are then passed as a memoryview
+        on the receive buffer of the port, so that they are neither copied nor converted.
+
         :param int start_addr: the address of the first register (default: 0)
         :param int reg_count: the number of 16 bits registers to read (default: 1)
-        :return: the registers content as a string, or None if a communication error occurred
-        :rtype: str
+        :param int functioncode: the function code to be used (3 or 4, default: 3)
+        :param callable decoder: the decoder of the raw data (optional)
+        :return: the registers content as bytes (str for Python 2) or the value returned by the
+            decoder, or None if a communication error occurred
         """
-        if self.serial.isOpen():
-            # ensure no junk is lurking there
-            self.serial.flushInput()
-            self.serial.flushOutput()
+        for block, data in self._prefetched:
+            if block.functioncode == functioncode and block.covers(start_addr, reg_count):
+                data = block.slice_of(data, start_addr, reg_count)
+                return decoder(data) if decoder else data
 
         try:
-            data = self.read_string(start_addr, reg_count)
-        except IOError as e:
-            raise CommunicationError(self.unit_id, e)
-        except ValueError as e:
-            raise CRCError(self.unit_id, e)
+            with self.transport.arbiter.transaction() as sleep_time:
+                # the silent period is waited for here, and not by the nested transaction of the exchange
+                self.transport.stats.silent_time += sleep_time
+                self.stats.silent_time += sleep_time
+                if self.transport.is_open():
+                    # ensure no junk is lurking there
+                    self.transport.flush_input()
+                    self.transport.flush_output()
+
+                data = self._prepared_read(start_addr, reg_count, functioncode).execute(decoder)
+        except (IOError, ValueError) as e:
+            raise _hal_error(self.unit_id, e)
         else:
+            if self._in_fault:
+                self._recovered()
             return data
 
+    def _prepared_read(self, start_addr, reg_count, functioncode):
+        """ Returns the prepared request reading a bunch of registers as raw data, creating it if needed. """
+        key = (start_addr, reg_count, functioncode)
+        try:
+            return self._prepared[key]
+        except KeyError:
+            prepared = self._prepared[key] = self.prepare(functioncode, start_addr,
+                                                          numberOfRegisters=reg_count, payloadformat='raw')
+            return prepared
+
+    def plan_register_reads(self, registers, functioncode=3):
+        """ Returns the block reads plan for a set of registers.
+
+        Plans are computed by :py:func:`plan_register_blocks` using the device settings
+        (:py:attr:`max_block_size`, :py:attr:`max_gap`, :py:attr:`turnaround_time`) and cached,
+        so that this method can be called on each poll.
+
+        :param registers: the registers to be read (an iterable of :py:class:`ModbusRegister`)
+        :param int functioncode: the function code to be used (3 or 4, default: 3)
+        :return: the blocks to be read
+        :rtype: list of RegisterBlock
+        """
+        # registers of different classes (e.g. with a custom decode() method) are equal as tuples
+        key = (frozenset((type(r), r) for r in registers), functioncode)
+        try:
+            return self._block_plans[key]
+        except KeyError:
+            plan = self._block_plans[key] = plan_register_blocks(
+                [r for _, r in key[0]], self.transport.baudrate or BAUDRATE, functioncode,
+                max_block_size=self.max_block_size, max_gap=self.max_gap, turnaround_time=self.turnaround_time
+            )
+            for block in plan:
+                self._decoders[_decoder_key(block)] = BlockDecoder(block)
+            self.log_debug('read plan for %d registers : %s',
+                           len(key[0]), ', '.join('%d+%d' % (b.start, b.count) for b in plan))
+            return plan
+
+    def read_register_blocks(self, registers, functioncode=3):
+        """ Reads a set of registers, using the minimal set of block transactions.
+
+        :param registers: the registers to be read (an iterable of :py:class:`ModbusRegister`)
+        :param int functioncode: the function code to be used (3 or 4, default: 3)
+        :return: a dictionary keyed by the registers, containing their raw content
+        :rtype: dict
+        :raise HalError: in case of read error
+        """
+        result = {}
+        for block, data in self._read_blocks(self.plan_register_reads(registers, functioncode)):
+            result.update(block.slices(data))
+        return result
+
+    def read_register_values(self, registers, functioncode=3):
+        """ Reads and decodes a set of registers, using the minimal set of block transactions.
+
+        Decoding is done with the compiled plans (see :py:class:`BlockDecoder`) built together with
+        the block reads plan.
+
+        :param registers: the registers to be read (an iterable of :py:class:`ModbusRegister`)
+        :param int functioncode: the function code to be used (3 or 4, default: 3)
+        :return: a dictionary keyed by the registers, containing their decoded value
+        :rtype: dict
+        :raise ValueError: if registers of different classes are equal as tuples (see :py:func:`plan_register_blocks`)
+        :raise HalError: in case of read error
+        """
+        result = {}
+        for block, values in self._read_blocks(self.plan_register_reads(registers, functioncode), decode=True):
+            result.update(values)
+        return result
+
+    def prefetch(self, registers, functioncode=3):
+        """ Reads a set of registers in blocks and keeps the result for subsequent reads.
+
+        This allows existing code based on :py:meth:`unpack_registers` to benefit from the block
+        reads planning, by prefetching all the registers it uses at the beginning of the poll. The
+        prefetched data are kept until the next call of this method or :py:meth:`clear_prefetch`, which
+        :py:meth:`RTUModbusHALDevice.poll_now` calls at the end of each poll.
+
+        If data covering the registers have been installed by :py:meth:`install_prefetched`, they
+        are used as is.
+
+        :param registers: the registers to be read (an iterable of :py:class:`ModbusRegister`)
+        :param int functioncode: the function code to be used (3 or 4, default: 3)
+        :raise HalError: in case of read error
+        """
+        blocks = self.plan_register_reads(registers, functioncode)
+        if self._prefetch_installed and all(
+                any(b.functioncode == block.functioncode and b.covers(block.start, block.count)
+                    for b, _ in self._prefetched)
+                for block in blocks):
+            return
+        self.clear_prefetch()
+        self._prefetched = self._read_blocks(blocks)
+
+    def install_prefetched(self, prefetched):
+        """ Installs block data read by a background poller, as if :py:meth:`prefetch` had read them.
+
+        :param list prefetched: the list of (block, raw content) pairs
+        """
+        self._prefetched = prefetched
+        self._prefetch_installed = True
+
+    def clear_prefetch(self):
+        """ Discards the data read by :py:meth:`prefetch` or installed by :py:meth:`install_prefetched`. """
+        self._prefetched = []
+        self._prefetch_installed = False
+
+    def _read_blocks(self, blocks, decode=False):
+        """ Reads the content of register blocks.
+
+        Behind a Modbus TCP gateway, the blocks are read with pipelined transactions (up to
+        :py:attr:`max_in_flight` at a time), and one by one otherwise.
+
+        Blocks made of configuration registers only are read with the lowest priority.
+
+        :param list blocks: the blocks to be read
+        :param bool decode: if True, the blocks are decoded by their :py:class:`BlockDecoder` as
+            they are received, instead of returning their raw content
+        :return: the list of (block, raw content or decoded values) pairs
+        :rtype: list
+        :raise HalError: in case of read error
+        """
+        config_only = all(reg.cfgreg for block in blocks for reg in block.registers)
+        with self.transport.arbiter.priority(PRIORITY_CONFIG if config_only else None):
+            return self._do_read_blocks(blocks, decode)
+
+    def _do_read_blocks(self, blocks, decode=False):
+        if self.mode == MODE_TCP and len(blocks) > 1:
+            self._check_quarantine()
+            received = {}
+            pending = blocks
+            attempt = 0
+            while pending:
+                start = time.time()
+                reads = [BatchRead(self.address, block.start, block.count, block.functioncode) for block in pending]
+                failed = []
+                try:
+                    results = read_registers_batch(self.transport, reads, self.max_in_flight)
+                except (IOError, ValueError) as e:
+                    # the batch could not be sent at all (e.g. unreachable gateway) : all its reads failed
+                    self._count_transaction(pending[0].functioncode)
+                    self._count_error(e)
+                    failed = [(block, e) for block in pending]
+                else:
+                    for block, data in zip(pending, results):
+                        self._count_transaction(block.functioncode)
+                        if isinstance(data, (IOError, ValueError)):
+                            self._count_error(data)
+                            failed.append((block, data))
+                        else:
+                            received[block] = data
+                if not failed:
+                    break
+                # the failed reads are retried together, provided all of them can be
+                delays = [self._retry_delay(error, attempt) for _, error in failed]
+                if None in delays:
+                    error = failed[delays.index(None)][1]
+                    self._failed(error)
+                    raise _hal_error(self.unit_id, error)
+                attempt += 1
+                for (_, error), delay in zip(failed, delays):
+                    self._retrying(error, attempt, delay)
+                if any(RetryPolicy.error_class(error) == RetryPolicy.CORRUPTED for _, error in failed):
+                    self.resync_line()
+                with self.transport.arbiter.suspended():
+                    time.sleep(max(delays))
+                self._retry_time += time.time() - start
+                pending = [block for block, _ in failed]
+
+            if self.breaker.consecutive_timeouts:
+                self._answered()
+            if self._in_fault:
+                self._recovered()
+            if decode:
+                return [(block, self._decoders[_decoder_key(block)].decode(received[block])) for block in blocks]
+            return [(block, received[block]) for block in blocks]
+
+        result = []
+        for block in blocks:
+            decoder = self._decoders[_decoder_key(block)].decode if decode else None
+            data = self._read_registers(block.start, block.count, block.functioncode, decoder)
+            if data is None:
+                raise HalError('read block failed (start=%d count=%d)' % (block.start, block.count))
+            result.append((block, data))
+        return result
+
     def reset(self):
         self.log_warning('resetting communications and device')
         self.reset_communications()
         self.reset_device()
 
     def reset_communications(self):
-        self.serial.close()
-        time.sleep(self.poll_req_interval)
-        self.serial.open()
-        time.sleep(0.1)
-        self.serial.flushInput()
-        self.serial.flushOutput()
+        """ Recovers from a communication fault of the device.
+
+        Since the port is shared with the other devices, it is not closed: the line is only
+        resynchronised (see :py:meth:`resync_line`). The port is reset (see :py:meth:`reset_port`) only
+        if several devices had a fault together (see :py:attr:`PORT_RESET_DEVICES`), which points to a
+        problem of the port or of the bus rather than of a single device. Nothing is done for a
+        quarantined device (see :py:class:`CircuitBreaker`).
+        """
+        if self.quarantined:
+            # the device is not answering at all, and its quarantine protects the port already
+            return
+        self._in_fault = True
+        faulty = self._port_faults.record(self.unit_id, self.PORT_RESET_WINDOW)
+        if faulty >= min(self.PORT_RESET_DEVICES, len(self._port_faults.devices)):
+            self.log_warning('%d device(s) in fault on port %s, resetting it', faulty, self.transport.name)
+            self._port_faults.clear()
+            self.reset_port()
+        else:
+            self.resync_line()
+
+    def resync_line(self):
+        """ Resynchronises the line after a communication fault, without closing the port.
+
+        Pending data are discarded, including the late bytes of the faulty response, which are waited
+        for during the silent period marking the end of frames.
+        """
+        with self.transport.arbiter.transaction(PRIORITY_CONTROL):
+            self.transport.flush_output()
+            self.transport.flush_input()
+            time.sleep(self.transport.frame_silence)
+            self.transport.flush_input()
+            self.transport.mark_read()
+
+    def reset_port(self):
+        """ Resets the port by closing and reopening it, which interrupts the communications
+        with all the devices sharing it.
+        """
+        with self.transport.arbiter.transaction(PRIORITY_CONTROL):
+            self.transport.close()
+            time.sleep(self.poll_req_interval)
+            self.transport.open()
+            time.sleep(0.1)
+            self.transport.flush_input()
+            self.transport.flush_output()
+
+    def _recovered(self):
+        self._in_fault = False
+        self._port_faults.clear(self.unit_id)
+        self.log_info('communications recovered')
 
     def reset_device(self):
         pass
 
+    def read_register_array(self, start_register, count, datatype='uint16', byteorder=BIG_ENDIAN, wordswap=False,
+                            functioncode=3):
+        """ Reads a block of values of the same type, and decodes them in a single call.
+
+        The values are decoded by :py:func:`decode_register_array` straight from the received data.
+
+        :param ModbusRegister start_register: the register to start the read from
+        :param int count: the number of values
+        :param str datatype: the type of the values (see :py:class:`ModbusRegister`)
+        :param str byteorder: the byte order of the values (BIG_ENDIAN or LITTLE_ENDIAN)
+        :param bool wordswap: True if the 16 bits words of multi-registers values are stored least significant first
+        :param int functioncode: the function code to be used (3 or 4, default: 3)
+        :return: the values, as a NumPy array if available, as an :py:class:`array.array` otherwise
+        :raise HalError: in case of read error
+        """
+        try:
+            _, size = _DATATYPES[datatype]
+        except KeyError:
+            raise ValueError('unsupported data type : %s' % datatype)
+        start_addr = start_register.addr
+        reg_count = count * size
+        values = self._read_registers(
+            start_addr, reg_count, functioncode,
+            decoder=lambda raw: decode_register_array(raw, datatype, byteorder, wordswap)
+        )
+        if values is None:
+            raise HalError('read register failed (start=%d count=%d)' % (start_addr, reg_count))
+        return values
+
     def unpack_registers(self, start_register, reg_count=1, unpack_format='>h'):
         """ Reads and unpacks registers. 
         
@@ -171,7 +1454,48 @@ class RTUModbusHWDevice(Instrument, Loggable):
         :raise HalError: in case of read error
         """
         start_addr = start_register.addr
-        data = self._read_registers(start_addr, reg_count)
-        if data is None:
+        values = self._read_registers(start_addr, reg_count, decoder=get_struct(unpack_format).unpack_from)
+        if values is None:
             raise HalError('read register failed (start=%d count=%d)' % (start_addr, reg_count))
-        return struct.unpack_from(unpack_format, data)
+        return values
+
+    def write_read_registers(self, write_register, values, read_register, reg_count=1, unpack_format='>h'):
+        """ Writes registers and reads back registers in a single transaction (function code 23).
+
+        The device performs the write before the read, which allows for instance to write a setpoint
+        and to get the resulting status for the cost of a single round trip.
+
+        :param ModbusRegister write_register: the register to start the write from
+        :param values: the 16 bits values to be written (an iterable of int)
+        :param ModbusRegister read_register: the register to start the read from
+        :param int reg_count: the number of 16 bits registers to read (default: 1)
+        :param str unpack_format: unpack format of the read registers, as used by :py:meth:`struct.unpack`
+        :return: the read register(s) content as a tuple
+        :rtype: tuple
+        :raise HalError: in case of communication error
+        """
+        try:
+            data = self._genericCommand(23, read_register.addr, (write_register.addr, list(values)),
+                                        numberOfRegisters=reg_count, payloadformat='raw')
+        except (IOError, ValueError) as e:
+            raise _hal_error(self.unit_id, e)
+        return get_struct(unpack_format).unpack_from(data)
+
+    def write_register_bit(self, register, bit, value):
+        """ Sets or clears a single bit of a register, leaving the other ones unchanged.
+
+        This is done by a mask write (function code 22), which saves the read-modify-write
+        sequence and cannot overwrite changes done by another master in between.
+
+        :param ModbusRegister register: the register
+        :param int bit: the number of the bit, 0 being the least significant one
+        :param value: the new value of the bit (evaluated as a boolean)
+        :raise HalError: in case of communication error
+        """
+        if not 0 <= bit < 16:
+            raise ValueError('invalid bit number : %d' % bit)
+        mask = 1 << bit
+        try:
+            self.mask_write_register(register.addr, ~mask & 0xFFFF, mask if value else 0)
+        except (IOError, ValueError) as e:
+            raise _hal_error(self.unit_id, e)
@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" asyncio based Modbus communications and devices polling.
+
+This module requires Python 3.5 or later. It provides :py:class:`AsyncInstrument`, exposing the
+read and write methods of :py:class:`pycstbox.minimalmodbus.Instrument` as coroutines, and
+:py:class:`AsyncPoller`, which polls all the Modbus HAL devices from a single event loop, so that
+a slow or silent device on a bus does not delay the polling of the devices of the other buses.
+
+The frames are exchanged through asynchronous counterparts of the transports registered in
+:py:mod:`pycstbox.minimalmodbus`, obtained with :py:func:`get_async_transport`:
+
+- serial lines are read when the event loop reports the file descriptor as readable (POSIX only)
+- Modbus TCP gateways are accessed through a stream connection, the responses being dispatched
+  by transaction id, so that transactions with several devices behind the same gateway overlap
+
+Other transport types get their asynchronous counterpart with :py:func:`register_async_transport`
+(see :py:mod:`pycstbox.modbussimaio` for the loopback lines of the simulator).
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import socket
+import struct
+import threading
+import time
+import logging
+
+from pycstbox.hal import HalError
+from pycstbox.minimalmodbus import Instrument, SerialTransport, TcpTransport, NoResponseError, response_frame_size
+from pycstbox.minimalmodbus import MODE_RTU, MODE_TCP, MAX_IN_FLIGHT, MBAP_HEADER_SIZE, PRIORITY_POLL, PRIORITY_CONTROL
+from pycstbox.modbus import PollResultSlot, RetryPolicy, _hal_error
+
+_logger = logging.getLogger('modbus.aio')
+
+# asynchronous transports, keyed by event loop and synchronous transport they are bound to
+_ASYNC_TRANSPORTS = {}
+
+# asynchronous transport classes, keyed by the synchronous transport class they work with
+_ASYNC_TRANSPORT_CLASSES = {}
+
+
+def register_async_transport(transport_class, async_transport_class):
+    """ Registers the asynchronous transport class to be used with a synchronous transport class.
+
+    It is used for the transports of this class and of its sub-classes, unless they have their own one.
+
+    :param type transport_class: the synchronous transport class
+    :param type async_transport_class: the asynchronous transport class, taking the synchronous transport
+                                       as its single constructor argument
+    """
+    _ASYNC_TRANSPORT_CLASSES[transport_class] = async_transport_class
+
+
+def get_async_transport(transport):
+    """ Returns the asynchronous transport bound to a transport, creating it if needed.
+
+    Asynchronous transports use asyncio primitives, and thus belong to the event loop of the
+    calling thread.
+
+    :param Transport transport: the synchronous transport
+    :rtype: AsyncTransport
+    :raise ValueError: if the transport type is not supported
+    """
+    key = (asyncio.get_event_loop(), transport)
+    try:
+        return _ASYNC_TRANSPORTS[key]
+    except KeyError:
+        pass
+
+    for cls in type(transport).__mro__:
+        if cls in _ASYNC_TRANSPORT_CLASSES:
+            async_transport = _ASYNC_TRANSPORT_CLASSES[cls](transport)
+            break
+    else:
+        raise ValueError('no asynchronous transport for %r' % transport)
+
+    _ASYNC_TRANSPORTS[key] = async_transport
+    return async_transport
+
+
+async def close_async_transports():
+    """ Closes the asynchronous transports of the running event loop. """
+    loop = asyncio.get_event_loop()
+    for key in [key for key in _ASYNC_TRANSPORTS if key[0] is loop]:
+        await _ASYNC_TRANSPORTS.pop(key).close()
+
+
+class AsyncTransport(object):
+    """ Root class of asynchronous transports.
+
+    They carry the frames of the transport they are bound to, using its settings and
+    sharing its timing information.
+    """
+    def __init__(self, transport):
+        """
+        :param Transport transport: the synchronous transport
+        """
+        self.transport = transport
+        self.bus_lock = asyncio.Lock()
+        """ Lock to be held for exclusive use of the line. """
+
+    def __repr__(self):
+        return "%s<transport=%r>" % (self.__class__.__name__, self.transport)
+
+    def next_transaction_id(self):
+        """ Returns the transaction id to be used for the next request (Modbus TCP only). """
+        return 0
+
+    async def close(self):
+        """ Releases the resources used by the transport. """
+        pass
+
+    async def transact(self, request, size, priority=PRIORITY_POLL, mode=MODE_RTU, stats=None):
+        """ Sends a request and returns the response.
+
+        :param bytes request: the raw request frame
+        :param int size: the expected size of the response, None if unknown. In RTU mode, the end of responses
+                         of unknown size is detected by the inter-character silence.
+        :param int priority: the priority of the transaction (see :py:class:`pycstbox.minimalmodbus.BusArbiter`)
+        :param str mode: the Modbus mode of the frames. RTU responses are read only up to the
+                         size given by their header (see :py:func:`pycstbox.minimalmodbus.response_frame_size`)
+        :param ExchangeStats stats: the statistics of the instrument, in which the wait for the silent period
+                                    is counted in addition to the ones of the transport (optional)
+        :return: the received bytes (less than *size* if the timeout expired)
+        :rtype: bytes
+        :raise IOError: in case of communication error
+        """
+        raise NotImplementedError()
+
+    async def resync(self):
+        """ Discards the late bytes of a faulty response, so that they are not taken for the next one.
+
+        Nothing is needed by default, the responses being matched to their request.
+        """
+        pass
+
+
+class AsyncLineTransport(AsyncTransport):
+    """ Common part of the transports over a line shared by all its slaves, on which the
+    transactions are done one at a time and separated by the silent period.
+
+    The line is requested to the arbiter of the transport for each transaction, so that
+    synchronous instruments used by other threads can share it.
+    """
+    async def _acquire_line(self, priority):
+        """ Waits until the arbiter of the transport grants the line, which must then be released. """
+        arbiter = self.transport.arbiter
+        loop = asyncio.get_event_loop()
+        granted = loop.create_future()
+
+        def on_grant():
+            if granted.cancelled():
+                arbiter.release()
+            else:
+                granted.set_result(None)
+
+        if not arbiter.request(priority, lambda: loop.call_soon_threadsafe(on_grant)):
+            await granted
+
+    async def transact(self, request, size, priority=PRIORITY_POLL, mode=MODE_RTU, stats=None):
+        async with self.bus_lock:
+            arbiter = self.transport.arbiter
+            await self._acquire_line(priority)
+            try:
+                wait_time = self.transport.silent_period - self.transport.time_since_read()
+                if wait_time > 0:
+                    await asyncio.sleep(wait_time)
+                    self.transport.stats.silent_time += wait_time
+                    if stats is not None:
+                        stats.silent_time += wait_time
+                try:
+                    return await self._exchange(request, size, mode)
+                finally:
+                    self.transport.mark_read()
+            finally:
+                arbiter.release()
+
+    async def resync(self):
+        """ Discards the pending input, including the late bytes of the faulty response, which are waited
+        for during the silent period marking the end of frames.
+        """
+        async with self.bus_lock:
+            await self._acquire_line(PRIORITY_CONTROL)
+            try:
+                self.transport.flush_input()
+                await asyncio.sleep(self.transport.frame_silence)
+                self.transport.flush_input()
+                self.transport.mark_read()
+            finally:
+                self.transport.arbiter.release()
+
+    async def _exchange(self, request, size, mode):
+        raise NotImplementedError()
+
+
+class AsyncSerialTransport(AsyncLineTransport):
+    """ Asynchronous transport over a serial line.
+
+    The request is written in one go (it fits in the output buffer of the driver) and the response
+    is read as it arrives, the event loop watching the file descriptor of the port.
+    """
+    async def _exchange(self, request, size, mode):
+        serial_port = self.transport.serial
+        if not serial_port.isOpen():
+            serial_port.open()
+        serial_port.write(request)
+
+        loop = asyncio.get_event_loop()
+        fd = serial_port.fileno()
+        deadline = loop.time() + self.transport.timeout
+        until_silence = size is None and mode == MODE_RTU
+        response = bytearray()
+        expected = response_frame_size(response, size, mode)
+        while len(response) < expected:
+            if until_silence and response:
+                remaining = self.transport.frame_silence
+            else:
+                remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            readable = loop.create_future()
+            loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await asyncio.wait_for(readable, remaining)
+            except asyncio.TimeoutError:
+                break
+            finally:
+                loop.remove_reader(fd)
+            chunk = os.read(fd, expected - len(response))
+            if not chunk:
+                raise IOError('serial port %s disconnected' % self.transport.name)
+            response += chunk
+            expected = response_frame_size(response, size, mode)
+        return bytes(response)
+
+
+class AsyncTcpTransport(AsyncTransport):
+    """ Asynchronous transport to a Modbus TCP gateway.
+
+    It uses its own connection, opened on first use and re-opened after errors. Up to
+    :py:attr:`max_in_flight` transactions can be pending at the same time, the responses being
+    matched to the requests by their transaction id.
+    """
+    def __init__(self, transport, max_in_flight=MAX_IN_FLIGHT):
+        """
+        :param TcpTransport transport: the synchronous transport
+        :param int max_in_flight: the maximum number of pending transactions
+        """
+        super(AsyncTcpTransport, self).__init__(transport)
+        self.max_in_flight = max_in_flight
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._connect_lock = asyncio.Lock()
+        self._writer = None
+        self._dispatcher = None
+        self._pending = {}
+        self._transaction_id = 0
+
+    def next_transaction_id(self):
+        self._transaction_id = (self._transaction_id + 1) & 0xffff
+        return self._transaction_id
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            host, port = self.transport.host, self.transport.port
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.transport.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise IOError('Cannot connect to Modbus TCP gateway %s:%d (%s)' % (host, port, e))
+            writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._writer = writer
+            self._dispatcher = asyncio.ensure_future(self._dispatch(reader, writer))
+
+    async def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+
+    async def _dispatch(self, reader, writer):
+        """ Reads the responses and hands them to the pending transactions. """
+        error = IOError('connection to Modbus TCP gateway closed')
+        try:
+            while True:
+                header = await reader.readexactly(MBAP_HEADER_SIZE)
+                transaction_id, _, length = struct.unpack('>HHH', header[:6])
+                body = await reader.readexactly(length - 1)
+                future = self._pending.pop(transaction_id, None)
+                if future is not None and not future.done():
+                    future.set_result(header + body)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            error = IOError('connection to Modbus TCP gateway lost (%s)' % e)
+        finally:
+            self._disconnect(writer, error)
+
+    def _disconnect(self, writer, error):
+        if self._writer is writer:
+            self._writer = None
+            self._dispatcher = None
+        writer.close()
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def transact(self, request, size, priority=PRIORITY_POLL, mode=MODE_TCP, stats=None):
+        async with self._slots:
+            await self._connect()
+            transaction_id = struct.unpack('>H', request[:2])[0]
+            future = self._pending[transaction_id] = asyncio.get_event_loop().create_future()
+            self._writer.write(request)
+            try:
+                return await asyncio.wait_for(future, self.transport.timeout)
+            except asyncio.TimeoutError:
+                return b''
+            finally:
+                self._pending.pop(transaction_id, None)
+
+
+register_async_transport(SerialTransport, AsyncSerialTransport)
+register_async_transport(TcpTransport, AsyncTcpTransport)
+
+
+class AsyncInstrument(Instrument):
+    """ Instrument whose read and write methods are coroutines.
+
+    The methods have the same parameters as the ones of :py:class:`pycstbox.minimalmodbus.Instrument`
+    and must be awaited, the parameters being checked when the method is called. This applies also
+    to the execution of the requests prepared with :py:meth:`prepare`. The frames are
+    exchanged through the asynchronous transport bound to the one of the port.
+
+    :py:attr:`handle_local_echo`, :py:attr:`close_port_after_each_call` and :py:attr:`debug` are
+    not supported.
+    """
+    def __init__(self, port, slaveaddress, mode=None):
+        """
+        :param port: the port name or the transport (see :py:class:`pycstbox.minimalmodbus.Instrument`)
+        :param int slaveaddress: the address of the slave
+        :param str mode: the Modbus mode (defaults to the one of the transport)
+        """
+        super(AsyncInstrument, self).__init__(port, slaveaddress, mode)
+        self.async_transport = get_async_transport(self.transport)
+        # the prepared read requests, keyed by their parameters
+        self._prepared = {}
+
+    async def _genericCommand(self, functioncode, registeraddress, value=None,
+                              numberOfDecimals=0, numberOfRegisters=1, signed=False, payloadformat=None,
+                              numberOfBits=1):
+        if value is not None:
+            prepared = self.prepare(functioncode, registeraddress, value, numberOfDecimals, numberOfRegisters,
+                                    signed, payloadformat, numberOfBits)
+            return await self._executePrepared(prepared)
+
+        # reads are sent again and again by the pollers : their requests are prepared once
+        key = (self.address, self.mode, self.precalculate_read_size, functioncode, registeraddress,
+               numberOfDecimals, numberOfRegisters, signed, payloadformat, numberOfBits)
+        try:
+            prepared = self._prepared[key]
+        except KeyError:
+            prepared = self._prepared[key] = self.prepare(functioncode, registeraddress, None, numberOfDecimals,
+                                                          numberOfRegisters, signed, payloadformat, numberOfBits)
+        return await self._executePrepared(prepared)
+
+    async def _executePrepared(self, prepared, decoder=None):
+        transaction_id = self.async_transport.next_transaction_id() if self.mode == MODE_TCP else 0
+        response = await self._exchange(prepared.frame(transaction_id), prepared.number_of_bytes_to_read,
+                                        prepared.priority)
+        return prepared.parse_response(response, transaction_id, decoder)
+
+    async def _exchange(self, request, number_of_bytes_to_read, priority):
+        start = time.time()
+        response = await self.async_transport.transact(request, number_of_bytes_to_read, priority, self.mode,
+                                                       self.stats)
+        # the round trip includes the wait for the bus, and the silent period is counted by the transport
+        roundtrip = time.time() - start
+        self.transport.stats.record(len(request), len(response or b''), roundtrip)
+        if self.stats is not None:
+            self.stats.record(len(request), len(response or b''), roundtrip)
+        if not response:
+            raise NoResponseError('No communication with the instrument (no answer)')
+        return response
+
+
+async def read_blocks(instrument, blocks, hw_device=None):
+    """ Reads the content of register blocks.
+
+    The reads are issued together, so that they are pipelined if the transport allows it. The failed
+    ones are retried as told by the retry policy of the HW device, if any, which counts them in its
+    transactions metrics.
+
+    :param AsyncInstrument instrument: the instrument to read from
+    :param list blocks: the blocks to be read (:py:class:`pycstbox.modbus.RegisterBlock`)
+    :param hw_device: the :py:class:`pycstbox.modbus.RTUModbusHWDevice` whose retry policy must be
+        applied and whose circuit breaker and metrics must be informed of the outcome of the reads, if any
+    :return: the list of (block, raw content) pairs
+    :rtype: list
+    :raise HalError: in case of read error
+    """
+    received = {}
+    pending = blocks
+    attempt = 0
+    while pending:
+        start = time.time()
+        results = await asyncio.gather(
+            *[instrument.read_raw_registers(block.start, block.count, functioncode=block.functioncode)
+              for block in pending],
+            return_exceptions=True
+        )
+        failed = []
+        for block, data in zip(pending, results):
+            if hw_device is not None:
+                hw_device._count_transaction(block.functioncode)
+            if isinstance(data, (IOError, ValueError)):
+                if hw_device is not None:
+                    hw_device._count_error(data)
+                failed.append((block, data))
+            elif isinstance(data, Exception):
+                raise data
+            else:
+                received[block] = data
+        if not failed:
+            break
+
+        # the failed reads are retried together, provided all of them can be
+        if hw_device is None:
+            raise _hal_error(instrument.address, failed[0][1])
+        delays = [hw_device._retry_delay(error, attempt) for _, error in failed]
+        if None in delays:
+            error = failed[delays.index(None)][1]
+            hw_device._failed(error)
+            raise _hal_error(instrument.address, error)
+        attempt += 1
+        for (_, error), delay in zip(failed, delays):
+            hw_device._retrying(error, attempt, delay)
+        if any(RetryPolicy.error_class(error) == RetryPolicy.CORRUPTED for _, error in failed):
+            await instrument.async_transport.resync()
+        await asyncio.sleep(max(delays))
+        hw_device._retry_time += time.time() - start
+        pending = [block for block, _ in failed]
+
+    if hw_device is not None and hw_device.breaker.consecutive_timeouts:
+        hw_device._answered()
+    return [(block, received[block]) for block in blocks]
+
+
+class AsyncPoller(object):
+    """ Polls Modbus HAL devices from an asyncio event loop run by a background thread.
+
+    Each device gets a :py:class:`pycstbox.modbus.PollResultSlot`, which the poller fills with
+    the outcome of a new poll each time the framework has taken the previous one.
+
+    Devices whose HW device declares the registers it reads (see
+    :py:attr:`pycstbox.modbus.RTUModbusHWDevice.POLLED_REGISTERS`) are polled without blocking the
+    event loop: the registers are fetched with :py:class:`AsyncInstrument` and installed as prefetched
+    data before calling :py:meth:`pycstbox.modbus.RTUModbusHALDevice.poll_now`, which does then no I/O.
+    The other ones are polled by a worker thread dedicated to their port, holding the bus of the port
+    meanwhile, so that their blocking I/O does not stall the event loop.
+
+    This fallback does not bring the benefits of the asyncio transport: the polls of these devices
+    are serialized on their port, each one keeping the bus for its whole duration (the async reads
+    of the other devices of the port wait meanwhile), and a thread is used per port having such
+    devices. Drivers should thus declare their polled registers whenever possible.
+    """
+    def __init__(self, hal_devices, logger=None):
+        """
+        :param hal_devices: the devices to be polled (iterable of :py:class:`pycstbox.modbus.RTUModbusHALDevice`)
+        :param logger: the logger to be used (default: module logger)
+        """
+        self.hal_devices = list(hal_devices)
+        self.logger = logger or _logger
+        self._loop = None
+        self._thread = None
+        self._terminated = False
+        self._wakeups = []
+        self._executors = {}
+
+    def start(self):
+        """ Starts the poller thread and delegates the polling of the devices to it. """
+        self._loop = asyncio.new_event_loop()
+        self._terminated = False
+        self._wakeups = []
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,), name='modbus-aio-poller')
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        """ Stops the poller and goes back to direct polling of the devices. """
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._terminate)
+        self._thread.join()
+        self._thread = None
+        for hal_device in self.hal_devices:
+            hal_device.attach_poll_slot(None)
+
+    def _terminate(self):
+        self._terminated = True
+        for wakeup in self._wakeups:
+            wakeup.set()
+
+    def _run(self, started):
+        asyncio.set_event_loop(self._loop)
+        try:
+            # the slots are attached before start() returns, so that the framework does not poll the devices
+            tasks = []
+            for hal_device in self.hal_devices:
+                slot, wakeup = self._make_slot()
+                hal_device.attach_poll_slot(slot)
+                tasks.append(self._loop.create_task(self._poll_device(hal_device, slot, wakeup)))
+            started.set()
+            self.logger.info('asyncio poller started for %d devices', len(tasks))
+            if tasks:
+                self._loop.run_until_complete(asyncio.wait(tasks))
+            self._loop.run_until_complete(close_async_transports())
+        finally:
+            started.set()
+            for executor in self._executors.values():
+                executor.shutdown()
+            self._executors = {}
+            self._loop.close()
+            self.logger.info('asyncio poller stopped')
+
+    def _executor(self, transport):
+        """ Returns the executor running the blocking polls of the devices of a port, creating it if needed.
+
+        A single worker is used per port, since its devices cannot be polled concurrently anyway.
+        """
+        try:
+            return self._executors[transport.name]
+        except KeyError:
+            executor = self._executors[transport.name] = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            return executor
+
+    def _make_slot(self):
+        wakeup = asyncio.Event()
+        self._wakeups.append(wakeup)
+        loop = self._loop
+
+        def notify():
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                # the loop is closed
+                pass
+
+        return PollResultSlot(wakeup=notify), wakeup
+
+    async def _poll_device(self, hal_device, slot, wakeup):
+        hw_device = hal_device.hw_device
+        try:
+            async_transport = get_async_transport(hw_device.transport)
+        except (AttributeError, ValueError) as e:
+            self.logger.error('device %s cannot be polled asynchronously (%s)', hal_device.device_id, e)
+            hal_device.attach_poll_slot(None)
+            return
+
+        instrument = None
+        if hw_device.POLLED_REGISTERS:
+            instrument = AsyncInstrument(hw_device.transport, hw_device.address, hw_device.mode)
+            instrument.stats = hw_device.stats
+
+        while not self._terminated:
+            wakeup.clear()
+            if not slot.empty:
+                await wakeup.wait()
+                continue
+
+            try:
+                if instrument is not None:
+                    # the probes of a quarantined device are done the same way, without blocking the loop
+                    hw_device._check_quarantine()
+                    hw_device.start_poll_cycle()
+                    blocks = hw_device.plan_register_reads(hw_device.POLLED_REGISTERS,
+                                                           hw_device.POLLED_REGISTERS_FUNCTIONCODE)
+                    hw_device.install_prefetched(await read_blocks(instrument, blocks, hw_device))
+                    events = hal_device.poll_now()
+                else:
+                    async with async_transport.bus_lock:
+                        events = await self._loop.run_in_executor(self._executor(hw_device.transport),
+                                                                  hal_device.poll_now)
+            except (HalError, IOError, ValueError) as e:
+                slot.put(error=e)
+            except Exception as e:
+                self.logger.exception(e)
+                slot.put(error=e)
+            else:
+                slot.put(events)
+            finally:
+                hw_device.clear_prefetch()
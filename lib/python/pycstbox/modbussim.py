@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Simulated Modbus lines, slaves and gateways, for testing and benchmarking the stack without hardware.
+
+The simulated lines are registered as the transports of :py:mod:`pycstbox.minimalmodbus` are
+(see :py:func:`pycstbox.minimalmodbus.register_transport`), so that instruments and devices use
+them transparently.
+"""
+
+import itertools
+import socket
+import struct
+import threading
+import time
+
+from pycstbox.minimalmodbus import Transport, BAUDRATE, TIMEOUT, TCP_URL_PREFIX, BROADCAST_ADDRESS, MBAP_HEADER_SIZE
+from pycstbox.minimalmodbus import _EMPTY_FRAME, _BITTIMES_PER_CHARACTERTIME
+from pycstbox.minimalmodbus import _calculateCrc, _calculate_minimum_silent_period, _checkSlaveaddress
+from pycstbox.minimalmodbus import _stringToFrame, _frameToString, _bitlistToBytestring, _bytestringToBitlist
+
+
+class LoopbackTransport(Transport):
+    """In-memory transport, delivering the requests to simulated slaves.
+
+    The wire time of the frames is emulated according to the baudrate, so that the timing
+    of a real RS485 line is reproduced without any hardware. This is intended for benchmarking
+    and load-testing the stack.
+
+    Args:
+        * name (str): The port name.
+        * baudrate (int): The emulated line speed. Use None for an infinitely fast line.
+        * timeout (float): The read timeout in seconds.
+        * turnaround_time (float): The time (in seconds) taken by the slaves to process a request.
+
+    Slaves are callables accepting the raw request frame and returning the raw response
+    frame, or None if they do not reply. See :class:`SimulatedSlave`.
+
+    """
+
+    def __init__(self, name='loopback', baudrate=BAUDRATE, timeout=TIMEOUT, turnaround_time=0):
+        super(LoopbackTransport, self).__init__(name)
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.turnaround_time = turnaround_time
+        self.slaves = {}
+        self._pending = _EMPTY_FRAME
+        self._pending_start = 0
+
+    def attach(self, slaveaddress, slave):
+        """Connect a simulated slave to the line.
+
+        Args:
+            * slaveaddress (int): The address the slave answers to.
+            * slave (callable): The slave.
+
+        """
+        _checkSlaveaddress(slaveaddress)
+        self.slaves[slaveaddress] = slave
+
+    @property
+    def character_time(self):
+        """The wire time of a character (in seconds)."""
+        if not self.baudrate:
+            return 0
+        return _BITTIMES_PER_CHARACTERTIME / float(self.baudrate)
+
+    def flush_input(self):
+        self._pending = _EMPTY_FRAME
+
+    def write(self, data):
+        self._pending = _EMPTY_FRAME
+        if not data:
+            return
+
+        slaveaddress = bytearray(data[:1])[0]
+        if slaveaddress == BROADCAST_ADDRESS:
+            for slave in self.slaves.values():
+                slave(data)     # broadcast requests are not answered
+            return
+
+        slave = self.slaves.get(slaveaddress)
+        response = slave(data) if slave else None
+        if response:
+            self._pending = response
+            self._pending_start = time.time() + len(data) * self.character_time + self.turnaround_time
+
+    def read(self, size):
+        data, ready_time = self.receive(size)
+        now = time.time()
+        if ready_time > now:
+            time.sleep(ready_time - now)
+        return data
+
+    def receive(self, size):
+        """Take the bytes a read of *size* bytes would return, without waiting for them.
+
+        Args:
+            size (int): The number of bytes to be read.
+
+        Returns:
+            A tuple (data, ready_time), *ready_time* being the time at which the read would complete.
+
+        """
+        now = time.time()
+        deadline = now + self.timeout
+        character_time = self.character_time
+
+        count = min(size, len(self._pending))
+        ready_time = self._pending_start + count * character_time
+        if ready_time > deadline:
+            # the timeout expires before the requested bytes are received
+            if character_time:
+                count = max(0, int((deadline - self._pending_start) / character_time))
+            else:
+                count = 0
+            ready_time = deadline
+        elif count < size:
+            # as pySerial does, wait for the timeout if less bytes than requested are available
+            ready_time = deadline
+
+        data, self._pending = self._pending[:count], self._pending[count:]
+        self._pending_start += count * character_time
+        return data, ready_time
+
+    def read_until_silence(self, size):
+        data, ready_time = self.receive_until_silence(size)
+        now = time.time()
+        if ready_time > now:
+            time.sleep(ready_time - now)
+        return data
+
+    def receive_until_silence(self, size):
+        """Take the bytes :meth:`read_until_silence` would return, without waiting for them.
+
+        Args:
+            size (int): The maximum number of bytes to be read.
+
+        Returns:
+            A tuple (data, ready_time), *ready_time* being the time at which the read would complete.
+
+        """
+        deadline = time.time() + self.timeout
+        if not self._pending or self._pending_start > deadline:
+            self._pending = _EMPTY_FRAME
+            return _EMPTY_FRAME, deadline
+
+        data, self._pending = self._pending[:size], self._pending[size:]
+        self._pending_start += len(data) * self.character_time
+        return data, self._pending_start + self.frame_silence
+
+    @property
+    def silent_period(self):
+        if not self.baudrate:
+            return 0
+        return _calculate_minimum_silent_period(self.baudrate)
+
+
+class SimulatedSlave(object):
+    """A simulated Modbus RTU slave, serving a bank of registers and a bank of bits.
+
+    It supports the function codes 3, 4, 6, 16, 22 and 23, both register kinds (holding and input)
+    sharing the same bank, and the function codes 1, 2, 5 and 15, both bit kinds (coils and
+    discrete inputs) sharing the same bank. Unmapped registers and bits are answered with an
+    "illegal data address" exception.
+
+    Args:
+        * slaveaddress (int): The address of the slave.
+        * registers (dict): The initial content of the registers, keyed by address.
+        * bits (dict): The initial content of the bits (0 or 1), keyed by address.
+
+    """
+    ILLEGAL_FUNCTION = 1
+    ILLEGAL_DATA_ADDRESS = 2
+
+    def __init__(self, slaveaddress, registers=None, bits=None):
+        self.address = slaveaddress
+        self.registers = dict(registers or {})
+        self.bits = dict(bits or {})
+
+    def __call__(self, request):
+        frame = bytearray(request)
+        if len(frame) < 4 or _calculateCrc(frame) != 0:
+            return None     # a real slave ignores corrupted frames
+
+        adu = struct.pack('>B', self.address) + self.process(bytes(frame[1:-2]))
+        return adu + struct.pack('<H', _calculateCrc(bytearray(adu)))
+
+    def process(self, pdu):
+        """Process a request PDU.
+
+        Args:
+            pdu (bytes): The request function code and data.
+
+        Returns:
+            The response PDU (bytes).
+
+        """
+        functioncode = bytearray(pdu[:1])[0]
+        start, count = struct.unpack('>HH', pdu[1:5])
+
+        try:
+            if functioncode in (1, 2):
+                packed = _stringToFrame(_bitlistToBytestring([self.bits[addr] for addr in range(start, start + count)]))
+                return struct.pack('>BB', functioncode, len(packed)) + packed
+
+            elif functioncode in (3, 4):
+                values = [self.registers[addr] for addr in range(start, start + count)]
+                return struct.pack('>BB%dH' % count, functioncode, count * 2, *values)
+
+            elif functioncode == 5:
+                if start not in self.bits:
+                    raise KeyError(start)
+                self.bits[start] = 1 if count == 0xFF00 else 0
+                return pdu[:5]
+
+            elif functioncode == 6:
+                if start not in self.registers:
+                    raise KeyError(start)
+                self.registers[start] = count    # the "count" field holds the value for FC6
+                return pdu[:5]
+
+            elif functioncode == 15:
+                values = _bytestringToBitlist(_frameToString(pdu[6:]), count)
+                for addr in range(start, start + count):
+                    if addr not in self.bits:
+                        raise KeyError(addr)
+                self.bits.update(zip(range(start, start + count), values))
+                return pdu[:5]
+
+            elif functioncode == 16:
+                values = struct.unpack('>%dH' % count, pdu[6:6 + count * 2])
+                for addr in range(start, start + count):
+                    if addr not in self.registers:
+                        raise KeyError(addr)
+                self.registers.update(zip(range(start, start + count), values))
+                return pdu[:5]
+
+            elif functioncode == 22:
+                and_mask, or_mask = count, struct.unpack('>H', pdu[5:7])[0]
+                self.registers[start] = (self.registers[start] & and_mask) | (or_mask & ~and_mask & 0xFFFF)
+                return pdu[:7]
+
+            elif functioncode == 23:
+                write_start, write_count = struct.unpack('>HH', pdu[5:9])
+                values = struct.unpack('>%dH' % write_count, pdu[10:10 + write_count * 2])
+                for addr in itertools.chain(range(write_start, write_start + write_count), range(start, start + count)):
+                    if addr not in self.registers:
+                        raise KeyError(addr)
+                self.registers.update(zip(range(write_start, write_start + write_count), values))
+                values = [self.registers[addr] for addr in range(start, start + count)]
+                return struct.pack('>BB%dH' % count, functioncode, count * 2, *values)
+
+            else:
+                return struct.pack('>BB', functioncode | 0x80, self.ILLEGAL_FUNCTION)
+
+        except KeyError:
+            return struct.pack('>BB', functioncode | 0x80, self.ILLEGAL_DATA_ADDRESS)
+
+
+class SimulatedTcpGateway(object):
+    """A simulated Modbus TCP gateway, serving simulated slaves on a local socket.
+
+    Each connection is served by its own thread. The gateway is intended for testing and
+    benchmarking the TCP transports.
+
+    When a turnaround time is given, each request is answered after this delay by its own
+    thread, emulating a gateway fronting independent RTU segments. Pipelined requests are
+    thus processed concurrently and their responses can come out of order.
+
+    Args:
+        * host (str): The address to listen on.
+        * port (int): The TCP port to listen on (0 for a free one).
+        * turnaround_time (float): The delay (in seconds) before answering a request.
+
+    """
+    GATEWAY_TARGET_FAILED = 0x0B
+
+    def __init__(self, host='127.0.0.1', port=0, turnaround_time=0):
+        self.turnaround_time = turnaround_time
+        self.slaves = {}
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(5)
+        self.host, self.port = self._server.getsockname()
+        self._terminate = False
+
+    @property
+    def url(self):
+        """The URL of the gateway, to be used as port name."""
+        return '{}{}:{}'.format(TCP_URL_PREFIX, self.host, self.port)
+
+    def attach(self, slave):
+        """Connect a simulated slave (see :class:`SimulatedSlave`) to the gateway."""
+        self.slaves[slave.address] = slave
+
+    def start(self):
+        thread = threading.Thread(target=self._accept_loop, name='modbus-tcp-sim')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._terminate = True
+        self._server.close()
+
+    def _accept_loop(self):
+        while not self._terminate:
+            try:
+                conn, _ = self._server.accept()
+            except socket.error:
+                break
+            thread = threading.Thread(target=self._serve, args=(conn,), name='modbus-tcp-sim-conn')
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        lock = threading.Lock()
+        try:
+            while not self._terminate:
+                header = self._receive(conn, MBAP_HEADER_SIZE)
+                if header is None:
+                    break
+                transaction_id, protocol, length, unit = struct.unpack('>HHHB', header)
+                pdu = self._receive(conn, length - 1)
+                if pdu is None:
+                    break
+                args = (conn, lock, transaction_id, protocol, unit, pdu)
+                if self.turnaround_time:
+                    thread = threading.Thread(target=self._answer, args=args, name='modbus-tcp-sim-req')
+                    thread.daemon = True
+                    thread.start()
+                else:
+                    self._answer(*args)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def _answer(self, conn, lock, transaction_id, protocol, unit, pdu):
+        if self.turnaround_time:
+            time.sleep(self.turnaround_time)
+        slave = self.slaves.get(unit)
+        with lock:
+            if slave:
+                response = slave.process(pdu)
+            else:
+                response = struct.pack('>BB', bytearray(pdu[:1])[0] | 0x80, self.GATEWAY_TARGET_FAILED)
+            try:
+                conn.sendall(struct.pack('>HHHB', transaction_id, protocol, len(response) + 1, unit) + response)
+            except socket.error:
+                pass
+
+    @staticmethod
+    def _receive(conn, size):
+        chunks = []
+        while size > 0:
+            chunk = conn.recv(size)
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            size -= len(chunk)
+        return _EMPTY_FRAME.join(chunks)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" asyncio support of the simulated lines of :py:mod:`pycstbox.modbussim`.
+
+This module requires Python 3.5 or later. Importing it registers :py:class:`AsyncLoopbackTransport`
+as the asynchronous counterpart of :py:class:`pycstbox.modbussim.LoopbackTransport`, so that
+:py:mod:`pycstbox.modbusaio` can poll devices over simulated lines. It is kept apart from
+:py:mod:`pycstbox.modbussim`, which stays usable without asyncio.
+"""
+
+import asyncio
+import time
+
+from pycstbox.minimalmodbus import MODE_RTU, response_frame_size
+from pycstbox.modbusaio import AsyncLineTransport, register_async_transport
+from pycstbox.modbussim import LoopbackTransport
+
+
+class AsyncLoopbackTransport(AsyncLineTransport):
+    """ Asynchronous transport over a :py:class:`pycstbox.modbussim.LoopbackTransport`.
+
+    The wire time is emulated with ``asyncio.sleep``.
+    """
+    async def _exchange(self, request, size, mode):
+        self.transport.write(request)
+        if size is None and mode == MODE_RTU:
+            response, ready_time = self.transport.receive_until_silence(response_frame_size(b'', None))
+            wait_time = ready_time - time.time()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            return response
+
+        response = b''
+        expected = response_frame_size(response, size, mode)
+        while len(response) < expected:
+            wanted = expected - len(response)
+            chunk, ready_time = self.transport.receive(wanted)
+            wait_time = ready_time - time.time()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            response += chunk
+            if len(chunk) < wanted:
+                break
+            expected = response_frame_size(response, size, mode)
+        return response
+
+
+register_async_transport(LoopbackTransport, AsyncLoopbackTransport)
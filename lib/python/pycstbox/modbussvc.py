@@ -20,15 +20,54 @@
 """
 
 from pycstbox.hal.network import DeviceNetworkSvc
+from pycstbox.modbus import get_hal_devices, clear_hal_devices, ThreadedPoller
 
 SERVICE_NAME = "ModbusDriver"
 
+POLLER_SEQUENTIAL = 'sequential'
+POLLER_THREADS = 'threads'
+POLLER_ASYNC = 'async'
+POLLERS = (POLLER_SEQUENTIAL, POLLER_THREADS, POLLER_ASYNC)
+
 
 class ModbusSvc(DeviceNetworkSvc):
     """ This class implements the model of the service managing the sub-network
     built with Modbus products.
+
+    With the ``threads`` poller, the devices of each port are polled by a dedicated worker thread
+    (see :py:class:`pycstbox.modbus.ThreadedPoller`), so that independent buses are polled
+    concurrently. With the ``async`` one, the devices of all the coordinators are polled from a
+    single asyncio event loop (see :py:class:`pycstbox.modbusaio.AsyncPoller`, Python 3 only).
+    In both cases, the framework gets the outcome of these polls. With the default ``sequential``
+    one, the framework polls the devices itself.
     """
-    def __init__(self, conn):
+    def __init__(self, conn, poller=POLLER_SEQUENTIAL):
         """ :param Connection conn: D-Bus connection (see service.ServiceObject.__init__())
+        :param str poller: the devices poller to be used (one of POLLERS)
         """
+        if poller not in POLLERS:
+            raise ValueError('invalid poller: %s' % poller)
         super(ModbusSvc, self).__init__(conn, SERVICE_NAME, coord_types=['modbus'])
+        self.poller_type = poller
+        self._poller = None
+
+    def load_configuration(self, cfg):
+        # the devices of a previous configuration must not be polled anymore
+        clear_hal_devices()
+        super(ModbusSvc, self).load_configuration(cfg)
+
+    def start(self):
+        if self.poller_type == POLLER_THREADS:
+            self._poller = ThreadedPoller(get_hal_devices())
+            self._poller.start()
+        elif self.poller_type == POLLER_ASYNC:
+            from pycstbox.modbusaio import AsyncPoller
+            self._poller = AsyncPoller(get_hal_devices())
+            self._poller.start()
+        super(ModbusSvc, self).start()
+
+    def stop(self):
+        super(ModbusSvc, self).stop()
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Common fixtures of the Modbus stack tests.
+
+The modules of this repository are made importable as part of the ``pycstbox`` package, together
+with the ones of the CSTBox framework if it is installed. The tests of the modules depending on the
+framework (:py:mod:`pycstbox.modbus` and :py:mod:`pycstbox.modbusaio`) are skipped otherwise.
+"""
+
+import itertools
+import os
+import sys
+
+import pytest
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib', 'python')
+sys.path.insert(0, LIB_DIR)
+
+import pycstbox
+
+if os.path.join(LIB_DIR, 'pycstbox') not in list(pycstbox.__path__):
+    # the framework package is installed: the modules of this repository extend it
+    pycstbox.__path__.append(os.path.join(LIB_DIR, 'pycstbox'))
+
+from pycstbox import minimalmodbus
+from pycstbox import modbussim
+
+_port_numbers = itertools.count()
+
+
+@pytest.fixture
+def port_name():
+    """ A port name not used by the other tests, the transports being registered globally. """
+    return 'test%d' % next(_port_numbers)
+
+
+@pytest.fixture
+def line(port_name):
+    """ A registered loopback line, with an infinitely fast wire and a short timeout. """
+    transport = modbussim.LoopbackTransport(port_name, baudrate=None, timeout=0.05)
+    minimalmodbus.register_transport(port_name, transport)
+    return transport
+
+
+@pytest.fixture
+def slave(line):
+    """ A simulated slave at address 1 on the loopback line, with registers 0 to 99 holding their address. """
+    slave = modbussim.SimulatedSlave(1, dict((addr, addr) for addr in range(100)),
+                                     dict((addr, addr % 2) for addr in range(100)))
+    line.attach(1, slave)
+    return slave
+
+
+@pytest.fixture
+def gateway():
+    """ A running simulated Modbus TCP gateway, serving the slave at address 1. """
+    gateway = modbussim.SimulatedTcpGateway()
+    gateway.attach(modbussim.SimulatedSlave(1, dict((addr, addr) for addr in range(300))))
+    gateway.start()
+    minimalmodbus.register_tcp_gateway(gateway.url, timeout=0.2)
+    yield gateway
+    gateway.stop()
+
+
+class FaultySlave(object):
+    """ Wraps a simulated slave, altering its next responses.
+
+    :var str mode: 'corrupted' (wrong CRC), 'busy' (exception 6) or 'silent' (no response)
+    :var int count: the number of responses to be altered
+    """
+    def __init__(self, slave):
+        self.slave = slave
+        self.mode = None
+        self.count = 0
+        self.requests = 0
+
+    def fail(self, mode, count=1):
+        self.mode, self.count = mode, count
+
+    def __call__(self, request):
+        self.requests += 1
+        response = self.slave(request)
+        if self.count <= 0:
+            return response
+        self.count -= 1
+        if self.mode == 'silent':
+            return None
+        if self.mode == 'corrupted':
+            frame = bytearray(response)
+            frame[-1] ^= 0xFF
+            return bytes(frame)
+        adu = bytearray([self.slave.address, bytearray(request)[1] | 0x80, 6])
+        crc = minimalmodbus._calculateCrc(adu)
+        return bytes(adu + bytearray([crc & 0xFF, crc >> 8]))
+
+
+@pytest.fixture
+def faulty_slave(line, slave):
+    """ The simulated slave of the loopback line, whose responses can be altered. """
+    faulty = FaultySlave(slave)
+    line.attach(1, faulty)
+    return faulty
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests of the protocol layer (pycstbox.minimalmodbus) over the simulated lines. """
+
+import threading
+import time
+
+import pytest
+
+from pycstbox import minimalmodbus
+from pycstbox.minimalmodbus import Instrument, BatchRead, MODE_RTU, MODE_TCP
+from pycstbox.minimalmodbus import PRIORITY_CONTROL, PRIORITY_POLL, PRIORITY_CONFIG
+from pycstbox.minimalmodbus import NoResponseError, ChecksumError, SlaveReportedException
+from pycstbox import modbussim
+
+READ_REQUEST = b'\x01\x03\x00\x00\x00\x01\x84\x0a'
+
+
+class TestCrc(object):
+    def test_known_frame(self):
+        assert minimalmodbus._calculateCrc(bytearray(READ_REQUEST[:-2])) == 0x0a84
+
+    def test_residue_of_valid_frame_is_zero(self):
+        assert minimalmodbus._calculateCrc(bytearray(READ_REQUEST)) == 0
+
+    def test_odd_length(self):
+        frame = bytearray(b'\x01\x03\x02\x00\x2a')
+        crc = minimalmodbus._calculateCrc(frame)
+        assert minimalmodbus._calculateCrc(frame + bytearray([crc & 0xff, crc >> 8])) == 0
+
+    def test_string_version(self):
+        assert minimalmodbus._calculateCrcString('\x01\x03\x00\x00\x00\x01') == '\x84\x0a'
+
+
+class TestFraming(object):
+    def test_rtu_request(self):
+        request = minimalmodbus._embedPayload(1, MODE_RTU, 3, '\x00\x00\x00\x01')
+        assert request == READ_REQUEST.decode('latin1')
+
+    def test_tcp_request(self):
+        request = minimalmodbus._embedPayload(1, MODE_TCP, 3, '\x00\x00\x00\x01', transaction_id=7)
+        assert request == '\x00\x07\x00\x00\x00\x06\x01\x03\x00\x00\x00\x01'
+
+    def test_rtu_response(self):
+        payload = minimalmodbus._extractPayload('\x01\x03\x02\x00\x2a\x39\x9b', 1, MODE_RTU, 3)
+        assert payload == '\x02\x00\x2a'
+
+    def test_rtu_response_bad_crc(self):
+        with pytest.raises(ChecksumError):
+            minimalmodbus._extractPayload('\x01\x03\x02\x00\x2a\x39\x9c', 1, MODE_RTU, 3)
+
+    def test_exception_response(self):
+        with pytest.raises(SlaveReportedException) as info:
+            minimalmodbus._extractPayload('\x01\x83\x02\xc0\xf1', 1, MODE_RTU, 3)
+        assert info.value.exception_code == SlaveReportedException.ILLEGAL_DATA_ADDRESS
+
+    def test_rtu_response_bytes(self):
+        payload = minimalmodbus._extractPayloadBytes(b'\x01\x03\x02\x00\x2a\x39\x9b', 1, MODE_RTU, 3)
+        assert bytes(payload) == b'\x02\x00\x2a'
+
+    def test_response_frame_size(self):
+        assert minimalmodbus.response_frame_size(b'\x01\x03\x02', 7) == 7
+        assert minimalmodbus.response_frame_size(b'\x01\x83', 7) == 5
+        assert minimalmodbus.response_frame_size(b'', 12, MODE_TCP) == 12
+
+
+class TestInstrument(object):
+    def test_read_register(self, port_name, slave):
+        assert Instrument(port_name, 1).read_register(42) == 42
+
+    def test_read_registers(self, port_name, slave):
+        assert Instrument(port_name, 1).read_registers(10, 3) == [10, 11, 12]
+
+    def test_read_raw_registers(self, port_name, slave):
+        assert Instrument(port_name, 1).read_raw_registers(10, 2) == b'\x00\x0a\x00\x0b'
+
+    def test_write_registers(self, port_name, slave):
+        Instrument(port_name, 1).write_registers(5, [500, 600])
+        assert (slave.registers[5], slave.registers[6]) == (500, 600)
+
+    def test_bits(self, port_name, slave):
+        instrument = Instrument(port_name, 1)
+        instrument.write_bits(0, [1, 1, 0])
+        assert instrument.read_bits(0, 4, functioncode=1) == [1, 1, 0, 1]
+
+    def test_mask_write(self, port_name, slave):
+        slave.registers[3] = 0x00f0
+        Instrument(port_name, 1).mask_write_register(3, 0xfff0, 0x0001)
+        assert slave.registers[3] == 0x00f1
+
+    def test_read_write_registers(self, port_name, slave):
+        assert Instrument(port_name, 1).read_write_registers(20, 2, 20, [7, 8]) == [7, 8]
+
+    def test_prepared_request(self, port_name, slave):
+        prepared = Instrument(port_name, 1).prepare(3, 0, numberOfRegisters=2, payloadformat='registers')
+        assert prepared.execute() == [0, 1]
+        slave.registers[0] = 9
+        assert prepared.execute() == [9, 1]
+
+    def test_prepared_request_bytes(self, port_name, slave):
+        prepared = Instrument(port_name, 1).prepare(3, 0, numberOfRegisters=1)
+        assert prepared.raw_request == READ_REQUEST
+        assert prepared.execute() == 0
+
+    def test_prepared_request_frames(self, port_name, line):
+        prepared = Instrument(port_name, 1).prepare(3, 0, numberOfRegisters=1)
+        assert prepared.frame() == READ_REQUEST
+        assert prepared.parse_response(b'\x01\x03\x02\x00\x2a\x39\x9b') == 42
+
+    def test_prepared_request_decoder(self, port_name, line, slave):
+        prepared = Instrument(port_name, 1).prepare(3, 10, numberOfRegisters=2, payloadformat='registers')
+        data = prepared.execute(decoder=lambda data: (type(data), bytes(data)))
+        assert data == (memoryview, b'\x00\x0a\x00\x0b')
+
+    def test_illegal_address(self, port_name, slave):
+        with pytest.raises(SlaveReportedException) as info:
+            Instrument(port_name, 1).read_register(500)
+        assert info.value.exception_code == SlaveReportedException.ILLEGAL_DATA_ADDRESS
+
+    def test_no_response(self, port_name, line):
+        with pytest.raises(NoResponseError):
+            Instrument(port_name, 2).read_register(0)
+
+    def test_corrupted_response(self, port_name, faulty_slave):
+        faulty_slave.fail('corrupted')
+        with pytest.raises(ChecksumError):
+            Instrument(port_name, 1).read_register(0)
+
+    def test_exchange_stats(self, port_name, line, slave):
+        Instrument(port_name, 1).read_registers(0, 2)
+        assert line.stats.exchanges == 1
+        assert line.stats.bytes_sent == 8
+        assert line.stats.bytes_received == 9
+
+    def test_exception_response_read_early(self, port_name, line, slave):
+        line.baudrate, line.timeout = 19200, 1.
+        start = time.time()
+        with pytest.raises(SlaveReportedException):
+            Instrument(port_name, 1).read_register(500)
+        assert time.time() - start < 0.5
+
+    def test_end_of_frame_detected_by_silence(self, port_name, line, slave):
+        line.baudrate, line.timeout = 19200, 1.
+        instrument = Instrument(port_name, 1)
+        instrument.precalculate_read_size = False
+        start = time.time()
+        instrument.write_register(10, 5)
+        assert time.time() - start < 0.5
+        assert slave.registers[10] == 5
+
+
+class TestBusArbiter(object):
+    def serve(self, arbiter, requests, busy_time=0):
+        """ Queues requests while the line is busy, and returns the order in which they are served. """
+        served = []
+        assert arbiter.request(PRIORITY_POLL, None)
+        for priority, name in requests:
+            assert not arbiter.request(priority, lambda name=name: served.append(name))
+        time.sleep(busy_time)
+        for _ in requests:
+            arbiter.release()
+        arbiter.release()
+        return served
+
+    def test_priority_order(self, line):
+        requests = [(PRIORITY_CONFIG, 'config'), (PRIORITY_POLL, 'poll1'), (PRIORITY_CONTROL, 'control'),
+                    (PRIORITY_POLL, 'poll2')]
+        assert self.serve(line.arbiter, requests) == ['control', 'poll1', 'poll2', 'config']
+
+    def test_no_starvation(self, line):
+        line.arbiter.max_wait = 0.01
+        requests = [(PRIORITY_CONFIG, 'config'), (PRIORITY_CONTROL, 'control')]
+        assert self.serve(line.arbiter, requests, busy_time=0.02) == ['config', 'control']
+
+    def test_suspended(self, line):
+        arbiter = line.arbiter
+        served = []
+
+        def other():
+            with arbiter.transaction():
+                served.append(True)
+
+        arbiter.acquire()
+        arbiter.acquire()
+        with arbiter.suspended():
+            thread = threading.Thread(target=other)
+            thread.start()
+            thread.join(1)
+            assert served
+        # still owned with the same nesting
+        arbiter.release()
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join(0.1)
+        assert len(served) == 1
+        arbiter.release()
+        thread.join(1)
+        assert len(served) == 2
+
+    def test_suspended_not_owner(self, line):
+        with line.arbiter.suspended():
+            with line.arbiter.transaction():
+                pass
+
+
+class TestBroadcast(object):
+    def test_all_slaves_written(self, port_name, line, slave):
+        other = modbussim.SimulatedSlave(2, {0: 0})
+        line.attach(2, other)
+        minimalmodbus.broadcast(port_name, 6, 0, 77, turnaround_delay=0)
+        assert slave.registers[0] == other.registers[0] == 77
+
+    def test_read_rejected(self, port_name, line):
+        with pytest.raises(ValueError):
+            minimalmodbus.broadcast(port_name, 3, 0, 1)
+
+    def test_broadcast_address_rejected_elsewhere(self, port_name, line):
+        with pytest.raises(ValueError):
+            minimalmodbus._embedPayload(minimalmodbus.BROADCAST_ADDRESS, MODE_RTU, 6, '\x00\x00\x00\x01')
+        with pytest.raises(ValueError):
+            Instrument(port_name, minimalmodbus.BROADCAST_ADDRESS).write_register(0, 1)
+
+    def test_tcp_rejected(self, gateway):
+        with pytest.raises(ValueError):
+            minimalmodbus.broadcast(gateway.url, 6, 0, 1)
+
+
+class TestTcp(object):
+    def test_batch(self, gateway):
+        reads = [BatchRead(1, addr, 2, 3) for addr in (0, 100, 200)]
+        results = minimalmodbus.read_registers_batch(gateway.url, reads)
+        assert [minimalmodbus._bytestringToValuelist(minimalmodbus._frameToString(data), 2)
+                for data in results] == [[0, 1], [100, 101], [200, 201]]
+        # the requests are prepared once
+        assert minimalmodbus.read_registers_batch(gateway.url, reads) == results
+        assert len(minimalmodbus.get_transport(gateway.url).batch_reads) == 3
+
+    def test_errors_reported_by_read(self, gateway):
+        reads = [BatchRead(1, 0, 1, 3), BatchRead(2, 0, 1, 3), BatchRead(1, 1000, 1, 3)]
+        results = minimalmodbus.read_registers_batch(gateway.url, reads)
+        assert not isinstance(results[0], Exception)
+        assert isinstance(results[1], SlaveReportedException)
+        assert results[2].exception_code == SlaveReportedException.ILLEGAL_DATA_ADDRESS
+
+    def test_instrument(self, gateway):
+        assert Instrument(gateway.url, 1).read_registers(10, 2) == [10, 11]
+
+    def test_transaction_ids_unique_across_threads(self):
+        transport = minimalmodbus.TcpTransport('localhost')
+        ids = []
+
+        def allocate():
+            ids.extend(transport.next_transaction_id() for _ in range(1000))
+
+        threads = [threading.Thread(target=allocate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(ids) == list(range(1, 4001))
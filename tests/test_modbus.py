@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests of the devices support layer (pycstbox.modbus) over the simulated lines. """
+
+import struct
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('pycstbox.hal')
+
+from pycstbox import modbus
+from pycstbox.modbus import RTUModbusHWDevice, ModbusRegister, TypedModbusRegister, RegisterBlock, BlockDecoder
+from pycstbox.modbus import plan_register_blocks
+from pycstbox.modbus import decode_register_array, SlaveExceptionError, CircuitBreaker, DeviceQuarantinedError
+from pycstbox.modbus import RetryPolicy, RTUModbusHALDevice, ThreadedPoller, clear_hal_devices
+from pycstbox.minimalmodbus import NoResponseError, ChecksumError, SlaveReportedException
+from pycstbox.hal.device import CommunicationError, CRCError
+
+
+class Device(RTUModbusHWDevice):
+    QUARANTINE_THRESHOLD = 2
+    QUARANTINE_MIN_BACKOFF = 60.
+
+
+@pytest.fixture
+def device(port_name, slave):
+    return Device(port_name, 1, 'test')
+
+
+class TestRetryPolicy(object):
+    def test_error_classes(self):
+        assert RetryPolicy.error_class(NoResponseError()) == RetryPolicy.TIMEOUT
+        assert RetryPolicy.error_class(ChecksumError()) == RetryPolicy.CORRUPTED
+        busy = SlaveReportedException('busy', 3, SlaveReportedException.SLAVE_DEVICE_BUSY)
+        assert RetryPolicy.error_class(busy) == RetryPolicy.BUSY
+        acknowledge = SlaveReportedException('acknowledge', 3, SlaveReportedException.ACKNOWLEDGE)
+        assert RetryPolicy.error_class(acknowledge) is None
+        illegal = SlaveReportedException('illegal', 3, SlaveReportedException.ILLEGAL_DATA_ADDRESS)
+        assert RetryPolicy.error_class(illegal) is None
+
+    def test_retries_limit(self):
+        policy = RetryPolicy(retries={RetryPolicy.CORRUPTED: 2}, jitter=0)
+        assert policy.delay(ChecksumError(), 0, 0) == pytest.approx(0.005)
+        assert policy.delay(ChecksumError(), 1, 0) == pytest.approx(0.01)
+        assert policy.delay(ChecksumError(), 2, 0) is None
+
+    def test_budget(self):
+        policy = RetryPolicy(jitter=0, budget=0.1)
+        assert policy.delay(ChecksumError(), 0, 0.099) is None
+
+
+class TestCircuitBreaker(object):
+    def test_quarantine_after_threshold(self):
+        breaker = CircuitBreaker(threshold=2, min_backoff=10.)
+        assert not breaker.timed_out()
+        assert breaker.timed_out()
+        assert breaker.quarantined and not breaker.allow()
+
+    def test_backoff_doubles_on_failed_probes(self):
+        breaker = CircuitBreaker(threshold=1, min_backoff=1., max_backoff=3.)
+        breaker.timed_out()
+        breaker.timed_out()
+        assert breaker.backoff == 2.
+        breaker.timed_out()
+        assert breaker.backoff == 3.
+
+    def test_answer_ends_quarantine(self):
+        breaker = CircuitBreaker(threshold=1)
+        breaker.timed_out()
+        assert breaker.answered()
+        assert not breaker.quarantined and breaker.quarantines == 1
+
+
+class TestModbusRegister(object):
+    def test_positional_construction(self):
+        register = ModbusRegister(10, 2, False, True)
+        assert (register.addr, register.size, register.cfgreg, register.signed) == (10, 2, False, True)
+        assert register.datatype is None and not register.wordswap
+
+    def test_tuple_compatibility(self):
+        assert ModbusRegister(10, 2) == (10, 2, False, False)
+        assert len(ModbusRegister(10, 2)) == 4
+        addr, size, cfgreg, signed = ModbusRegister(10, 2, signed=True)
+        assert (addr, size, cfgreg, signed) == (10, 2, False, True)
+
+    def test_typed_register(self):
+        register = TypedModbusRegister(10, datatype='float32', wordswap=True)
+        assert isinstance(register, ModbusRegister)
+        assert (register.size, register.unpack_format, register.wordswap) == (2, 'f', True)
+        assert register != ModbusRegister(10, 2)
+        with pytest.raises(ValueError):
+            TypedModbusRegister(10, 1, datatype='float32')
+
+
+class TestBlocksPlanning(object):
+    def test_contiguous_registers_merged(self):
+        blocks = plan_register_blocks([ModbusRegister(0), ModbusRegister(1, 2), ModbusRegister(3)], 9600)
+        assert [(b.start, b.count) for b in blocks] == [(0, 4)]
+
+    def test_max_block_size(self):
+        blocks = plan_register_blocks([ModbusRegister(addr) for addr in range(200)], 9600)
+        assert [(b.start, b.count) for b in blocks] == [(0, 125), (125, 75)]
+
+    def test_gaps_not_bridged_by_default(self):
+        blocks = plan_register_blocks([ModbusRegister(0), ModbusRegister(2)], 9600)
+        assert [(b.start, b.count) for b in blocks] == [(0, 1), (2, 1)]
+
+    def test_unbounded_gap(self):
+        blocks = plan_register_blocks([ModbusRegister(0), ModbusRegister(2)], 9600, max_gap=None)
+        assert [(b.start, b.count) for b in blocks] == [(0, 3)]
+
+    def test_max_gap(self):
+        registers = [ModbusRegister(0), ModbusRegister(3)]
+        assert len(plan_register_blocks(registers, 9600, max_gap=1)) == 2
+        assert len(plan_register_blocks(registers, 9600, max_gap=2)) == 1
+
+    def test_equal_registers_of_different_classes_rejected(self):
+        class Scaled(ModbusRegister):
+            @staticmethod
+            def decode(raw):
+                return raw / 10.
+
+        assert len(plan_register_blocks([ModbusRegister(0), ModbusRegister(0)], 9600)[0].registers) == 1
+        with pytest.raises(ValueError):
+            plan_register_blocks([Scaled(0), ModbusRegister(0)], 9600)
+
+
+class TestBlockDecoder(object):
+    def decode(self, registers, data):
+        block = RegisterBlock(registers[0].addr, len(data) // 2, 3, tuple(registers))
+        return BlockDecoder(block).decode(data)
+
+    def test_gaps_skipped(self):
+        registers = [ModbusRegister(0), ModbusRegister(2, signed=True)]
+        assert self.decode(registers, struct.pack('>HHh', 1, 2, -3)) == {registers[0]: 1, registers[1]: -3}
+
+    def test_datatypes(self):
+        registers = [TypedModbusRegister(0, datatype='float32'),
+                     TypedModbusRegister(2, datatype='uint32', wordswap=True)]
+        data = struct.pack('>fHH', 1.5, 0x5678, 0x1234)
+        assert self.decode(registers, data) == {registers[0]: 1.5, registers[1]: 0x12345678}
+
+    def test_custom_decode(self):
+        class Scaled(ModbusRegister):
+            @staticmethod
+            def decode(raw):
+                return raw / 10.
+
+        register = Scaled(0)
+        assert self.decode([register], struct.pack('>H', 25)) == {register: 2.5}
+
+
+
+class TestRegisterArray(object):
+    @pytest.mark.parametrize('use_numpy', [False, None])
+    def test_uint16(self, use_numpy):
+        assert list(decode_register_array(b'\x00\x01\xff\xff', use_numpy=use_numpy)) == [1, 0xffff]
+
+    @pytest.mark.parametrize('use_numpy', [False, None])
+    def test_float32_word_swapped(self, use_numpy):
+        raw = struct.pack('>HHHH', *(struct.unpack('>HH', struct.pack('>f', 1.5))[::-1] +
+                                    struct.unpack('>HH', struct.pack('>f', -2.))[::-1]))
+        values = decode_register_array(raw, 'float32', wordswap=True, use_numpy=use_numpy)
+        assert list(values) == [1.5, -2.]
+
+
+class TestDevice(object):
+    def test_read_register_values(self, device):
+        registers = [ModbusRegister(1), ModbusRegister(2, 2), ModbusRegister(10, signed=True)]
+        values = device.read_register_values(registers)
+        assert values == {registers[0]: 1, registers[1]: (2 << 16) + 3, registers[2]: 10}
+        assert device.total_reads == 2
+
+    def test_device_widened_gap(self, device):
+        device.max_gap = 10
+        registers = [ModbusRegister(1), ModbusRegister(10)]
+        assert device.read_register_values(registers) == {registers[0]: 1, registers[1]: 10}
+        assert device.total_reads == 1
+
+    def test_unpack_registers(self, device):
+        assert device.unpack_registers(ModbusRegister(4), 2, '>HH') == (4, 5)
+
+    def test_read_register_array(self, device):
+        assert list(device.read_register_array(ModbusRegister(0), 4)) == [0, 1, 2, 3]
+
+    def test_slave_exception(self, device):
+        with pytest.raises(SlaveExceptionError):
+            device.unpack_registers(ModbusRegister(1000), 1, '>H')
+
+    def test_no_response(self, port_name, line):
+        with pytest.raises(CommunicationError):
+            RTUModbusHWDevice(port_name, 2, 'test').unpack_registers(ModbusRegister(0), 1, '>H')
+
+    def test_corrupted_response_retried(self, device, faulty_slave):
+        faulty_slave.fail('corrupted', 2)
+        assert device.unpack_registers(ModbusRegister(4), 1, '>H') == (4,)
+        assert faulty_slave.requests == 3
+        assert device.total_retries == 2
+        assert device.errors_by_class == {RetryPolicy.CORRUPTED: 2}
+
+    def test_busy_device_retried(self, device, faulty_slave):
+        faulty_slave.fail('busy', 1)
+        assert device.unpack_registers(ModbusRegister(4), 1, '>H') == (4,)
+        assert faulty_slave.requests == 2
+
+    def test_bus_released_during_backoff(self, device, faulty_slave, monkeypatch):
+        served = threading.Event()
+        served_during_backoff = []
+
+        def other():
+            with device.transport.arbiter.transaction():
+                served.set()
+
+        class Clock(object):
+            time = staticmethod(time.time)
+
+            @staticmethod
+            def sleep(delay):
+                threading.Thread(target=other).start()
+                served_during_backoff.append(served.wait(0.5))
+
+        monkeypatch.setattr(modbus, 'time', Clock)
+        faulty_slave.fail('busy', 1)
+        assert device.read_register_values([ModbusRegister(4)]) == {ModbusRegister(4): 4}
+        assert served_during_backoff == [True]
+
+    def test_retry_budget_renewed_outside_poll_cycles(self, device, faulty_slave):
+        device._retry_time = device.RETRY_BUDGET
+        faulty_slave.fail('corrupted', 1)
+        with pytest.raises(CRCError):
+            device.unpack_registers(ModbusRegister(4), 1, '>H')
+        device._retry_budget_start -= device.RETRY_BUDGET_WINDOW
+        faulty_slave.fail('corrupted', 1)
+        assert device.unpack_registers(ModbusRegister(4), 1, '>H') == (4,)
+
+    def test_retries_exhausted(self, device, faulty_slave):
+        faulty_slave.fail('corrupted', 10)
+        with pytest.raises(CRCError):
+            device.unpack_registers(ModbusRegister(4), 1, '>H')
+        assert faulty_slave.requests == 1 + device.retries
+
+    def test_illegal_address_not_retried(self, device, faulty_slave):
+        with pytest.raises(SlaveExceptionError):
+            device.unpack_registers(ModbusRegister(1000), 1, '>H')
+        assert faulty_slave.requests == 1
+
+    def test_quarantine(self, device, faulty_slave):
+        faulty_slave.fail('silent', 100)
+        for _ in range(Device.QUARANTINE_THRESHOLD):
+            with pytest.raises(CommunicationError):
+                device.unpack_registers(ModbusRegister(0), 1, '>H')
+        assert device.quarantined
+        requests = faulty_slave.requests
+        with pytest.raises(DeviceQuarantinedError):
+            device.unpack_registers(ModbusRegister(0), 1, '>H')
+        assert faulty_slave.requests == requests
+
+    def test_quarantine_rejections_counted_apart(self, device, faulty_slave):
+        faulty_slave.fail('silent', 100)
+        for _ in range(Device.QUARANTINE_THRESHOLD):
+            with pytest.raises(CommunicationError):
+                device.unpack_registers(ModbusRegister(0), 1, '>H')
+        errors = device.total_errors
+        with pytest.raises(DeviceQuarantinedError):
+            device.unpack_registers(ModbusRegister(0), 1, '>H')
+        assert device.total_rejected == 1
+        assert device.total_errors == errors == sum(device.errors_by_class.values())
+
+    def test_write_register_bit(self, device, slave):
+        slave.registers[7] = 0x0100
+        device.write_register_bit(ModbusRegister(7), 0, True)
+        assert slave.registers[7] == 0x0101
+        assert (device.total_reads, device.total_writes) == (0, 1)
+
+    def test_block_decoder_custom_decode(self, device):
+        class Scaled(ModbusRegister):
+            @staticmethod
+            def decode(raw):
+                return raw / 10.
+
+        register = Scaled(25)
+        assert device.read_register_values([register]) == {register: 2.5}
+        # a plain register with the same fields is equal, but has its own plan and decoder
+        assert device.read_register_values([ModbusRegister(25)]) == {register: 25}
+        assert device.read_register_values([register]) == {register: 2.5}
+        # in the same read, their values could not be told apart
+        with pytest.raises(ValueError):
+            device.read_register_values([register, ModbusRegister(25)])
+
+    def test_float_register(self, device, slave):
+        high, low = struct.unpack('>HH', struct.pack('>f', 1.5))
+        slave.registers[30], slave.registers[31] = high, low
+        register = TypedModbusRegister(30, datatype='float32')
+        assert device.read_register_values([register]) == {register: 1.5}
+
+
+class TestNoCopy(object):
+    """ The values decoded straight from the receive buffer must not be views on it. """
+    def test_register_array_not_aliasing_receive_buffer(self, device, slave):
+        values = device.read_register_array(ModbusRegister(0), 4)
+        assert list(values) == [0, 1, 2, 3]
+        device.transport.receive_buffer[:] = b'\xff' * len(device.transport.receive_buffer)
+        device.read_register_array(ModbusRegister(50), 4)
+        assert list(values) == [0, 1, 2, 3]
+
+    @pytest.mark.parametrize('use_numpy', [False, None])
+    def test_decoded_array_not_aliasing_raw_data(self, use_numpy):
+        raw = bytearray(b'\x00\x01\x00\x02')
+        values = decode_register_array(memoryview(raw), 'uint16', use_numpy=use_numpy)
+        raw[:] = b'\xff\xff\xff\xff'
+        assert list(values) == [1, 2]
+
+    def test_block_values_not_aliasing_receive_buffer(self, device, slave):
+        registers = [ModbusRegister(0), TypedModbusRegister(1, 2, datatype='uint32')]
+        values = device.read_register_values(registers)
+        device.transport.receive_buffer[:] = b'\xff' * len(device.transport.receive_buffer)
+        assert values == {registers[0]: 0, registers[1]: (1 << 16) + 2}
+
+
+class TestTcpDevice(object):
+    @pytest.fixture
+    def device(self, gateway):
+        return Device(gateway.url, 1, 'test')
+
+    def test_batch_read(self, device):
+        registers = [ModbusRegister(0), ModbusRegister(200)]
+        assert device.read_register_values(registers) == {registers[0]: 0, registers[1]: 200}
+        assert device.total_reads == 2
+
+    def test_dead_gateway(self, device, gateway):
+        gateway.stop()
+        with pytest.raises(CommunicationError):
+            device.read_register_values([ModbusRegister(0), ModbusRegister(200)])
+        assert device.total_errors == device.total_reads == 1
+        assert device.errors_by_class == {'other': 1}
+
+    def test_gateway_dead_after_connection(self, device, gateway):
+        registers = [ModbusRegister(0), ModbusRegister(200)]
+        device.read_register_values(registers)
+        gateway.stop()
+        with pytest.raises(CommunicationError):
+            device.read_register_values(registers)
+        assert device.total_errors >= 1
+
+
+class TestRecovery(object):
+    @pytest.fixture
+    def devices(self, port_name, slave, monkeypatch):
+        resets = []
+        monkeypatch.setattr(RTUModbusHWDevice, 'reset_port', lambda self: resets.append(self.unit_id))
+        devices = [RTUModbusHWDevice(port_name, address, 'test') for address in (1, 2, 3)]
+        return devices, resets
+
+    def test_single_fault_keeps_port_open(self, devices):
+        devices, resets = devices
+        devices[1].reset_communications()
+        assert not resets
+        assert devices[0].unpack_registers(ModbusRegister(4), 1, '>H') == (4,)
+
+    def test_port_reset_when_several_devices_in_fault(self, devices):
+        devices, resets = devices
+        for device in devices[:RTUModbusHWDevice.PORT_RESET_DEVICES]:
+            device.reset_communications()
+        assert resets == [devices[RTUModbusHWDevice.PORT_RESET_DEVICES - 1].unit_id]
+
+    def test_reload_forgets_port_devices(self, port_name, slave):
+        RTUModbusHWDevice(port_name, 2, 'test')
+        clear_hal_devices()
+        device = RTUModbusHWDevice(port_name, 1, 'test')
+        assert device._port_faults.devices == {1}
+
+
+class TestThreadedPoller(object):
+    class Config(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    class SlowDevice(RTUModbusHWDevice):
+        def __init__(self, *args, **kwargs):
+            super(TestThreadedPoller.SlowDevice, self).__init__(*args, **kwargs)
+            self.polls = 0
+
+        def poll(self):
+            time.sleep(0.2)
+            self.polls += 1
+
+    def test_poll_does_not_wait(self, port_name, slave):
+        hw_device = self.SlowDevice(port_name, 1, 'test')
+        hal_device = RTUModbusHALDevice(self.Config(port=port_name), self.Config(uid='dev1'))
+        hal_device._hwdev = hw_device
+        poller = ThreadedPoller([hal_device])
+        poller.start()
+        try:
+            start = time.time()
+            assert hal_device.poll() is None
+            assert time.time() - start < 0.1
+            # the outcome of the poll is kept until the framework takes it
+            time.sleep(0.3)
+            assert hw_device.polls == 1
+            hal_device.poll()
+            time.sleep(0.3)
+            assert hw_device.polls == 2
+        finally:
+            poller.stop()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests of the asyncio instrument and poller (pycstbox.modbusaio) over the simulated lines. """
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('pycstbox.hal')
+
+from pycstbox.hal.device import CommunicationError
+from pycstbox.modbus import RTUModbusHWDevice, RTUModbusHALDevice, ModbusRegister
+from pycstbox.modbusaio import AsyncInstrument, AsyncPoller, close_async_transports, read_blocks
+from pycstbox import modbussim
+import pycstbox.modbussimaio  # registers the asynchronous loopback transport
+
+
+def run(port, slaveaddress, method, *args):
+    """ Calls a method of an asynchronous instrument created in a new event loop. """
+    async def call():
+        try:
+            return await getattr(AsyncInstrument(port, slaveaddress), method)(*args)
+        finally:
+            await close_async_transports()
+    return asyncio.run(call())
+
+
+def test_read_registers(port_name, slave):
+    assert run(port_name, 1, 'read_registers', 10, 3) == [10, 11, 12]
+
+
+def test_write_register(port_name, slave):
+    run(port_name, 1, 'write_register', 5, 500)
+    assert slave.registers[5] == 500
+
+
+def test_tcp_read_registers(gateway):
+    assert run(gateway.url, 1, 'read_registers', 100, 2) == [100, 101]
+
+
+def test_read_requests_prepared_once(port_name, slave):
+    async def call():
+        try:
+            instrument = AsyncInstrument(port_name, 1)
+            for _ in range(2):
+                assert await instrument.read_registers(10, 2) == [10, 11]
+            await instrument.write_register(5, 500)
+            return instrument._prepared
+        finally:
+            await close_async_transports()
+    assert len(asyncio.run(call())) == 1
+
+
+class Config(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class BlockingDevice(RTUModbusHWDevice):
+    """ A device without POLLED_REGISTERS, polled by the blocking fallback of the poller. """
+    active = 0
+    max_active = 0
+
+    def __init__(self, *args, **kwargs):
+        super(BlockingDevice, self).__init__(*args, **kwargs)
+        self.values = []
+        self.threads = set()
+
+    def poll(self):
+        cls = type(self)
+        cls.active += 1
+        cls.max_active = max(cls.max_active, cls.active)
+        try:
+            self.threads.add(threading.current_thread().name)
+            self.values.append(self.unpack_registers(ModbusRegister(self.address), 1, '>H')[0])
+            time.sleep(0.005)
+        finally:
+            cls.active -= 1
+
+
+def make_hal_device(port_name, hw_device):
+    hal_device = RTUModbusHALDevice(Config(port=port_name), Config(uid='dev%d' % hw_device.address))
+    hal_device._hwdev = hw_device
+    return hal_device
+
+
+def test_blocking_fallback(port_name, line, slave):
+    line.attach(2, modbussim.SimulatedSlave(2, {2: 2}))
+    hw_devices = [BlockingDevice(port_name, address, 'test') for address in (1, 2)]
+    hal_devices = [make_hal_device(port_name, hw_device) for hw_device in hw_devices]
+    BlockingDevice.max_active = 0
+    poller = AsyncPoller(hal_devices)
+    poller.start()
+    try:
+        deadline = time.time() + 5
+        while any(len(hw_device.values) < 3 for hw_device in hw_devices) and time.time() < deadline:
+            for hal_device in hal_devices:
+                hal_device.poll()
+            time.sleep(0.005)
+    finally:
+        poller.stop()
+
+    for hw_device in hw_devices:
+        assert len(hw_device.values) >= 3 and set(hw_device.values) == {hw_device.address}
+        # polled by the worker of the port, not by the event loop thread nor the caller
+        assert len(hw_device.threads) == 1
+        assert hw_device.threads.isdisjoint({'modbus-aio-poller', threading.current_thread().name})
+    assert hw_devices[0].threads == hw_devices[1].threads
+    # the devices of a port are polled one at a time
+    assert BlockingDevice.max_active == 1
+
+
+class PolledDevice(RTUModbusHWDevice):
+    """ A device declaring the registers it reads, polled from the event loop. """
+    POLLED_REGISTERS = (ModbusRegister(0), ModbusRegister(1), ModbusRegister(10))
+
+    def __init__(self, *args, **kwargs):
+        super(PolledDevice, self).__init__(*args, **kwargs)
+        self.values = []
+        self.threads = set()
+
+    def poll(self):
+        self.threads.add(threading.current_thread().name)
+        self.prefetch(self.POLLED_REGISTERS)
+        self.values.append(tuple(self.unpack_registers(reg, 1, '>H')[0] for reg in self.POLLED_REGISTERS))
+
+
+def test_event_loop_polling(port_name, slave):
+    hw_device = PolledDevice(port_name, 1, 'test')
+    hal_device = make_hal_device(port_name, hw_device)
+    poller = AsyncPoller([hal_device])
+    poller.start()
+    try:
+        deadline = time.time() + 5
+        while len(hw_device.values) < 3 and time.time() < deadline:
+            hal_device.poll()
+            time.sleep(0.005)
+    finally:
+        poller.stop()
+
+    assert len(hw_device.values) >= 3 and set(hw_device.values) == {(0, 1, 10)}
+    assert hw_device.threads == {'modbus-aio-poller'}
+    # two blocks per poll, read by the poller only : the device itself used the installed data
+    assert hw_device.total_reads == 2 * len(hw_device.values)
+
+
+def read_polled_blocks(hw_device, with_device=True):
+    """ Reads the blocks of the polled registers of a device in a new event loop. """
+    async def call():
+        try:
+            instrument = AsyncInstrument(hw_device.transport, hw_device.address)
+            blocks = hw_device.plan_register_reads(hw_device.POLLED_REGISTERS)
+            return await read_blocks(instrument, blocks, hw_device if with_device else None)
+        finally:
+            await close_async_transports()
+    return dict((block.start, bytes(data)) for block, data in asyncio.run(call()))
+
+
+@pytest.mark.parametrize('fault', ['corrupted', 'busy'])
+def test_read_blocks_retried(port_name, faulty_slave, fault):
+    hw_device = PolledDevice(port_name, 1, 'test')
+    faulty_slave.fail(fault)
+    assert read_polled_blocks(hw_device) == {0: b'\x00\x00\x00\x01', 10: b'\x00\x0a'}
+    assert faulty_slave.requests == 3
+    assert hw_device.total_retries == 1
+    assert hw_device.errors_by_class == {fault: 1}
+
+
+@pytest.mark.parametrize('with_device', [True, False])
+def test_read_blocks_timeout(port_name, faulty_slave, with_device):
+    hw_device = PolledDevice(port_name, 1, 'test')
+    faulty_slave.fail('silent', count=100)
+    with pytest.raises(CommunicationError):
+        read_polled_blocks(hw_device, with_device)
+    if with_device:
+        # each of the two blocks is retried, then the circuit breaker is told about the failure
+        assert hw_device.total_retries == 2 * hw_device.TIMEOUT_RETRIES
+        assert hw_device.breaker.consecutive_timeouts == 1
+    else:
+        assert hw_device.total_reads == 0